@@ -0,0 +1,171 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from utils.cli.output import out, yellow, green, bold
+
+__author__ = 'Kevin Dubois'
+
+"""
+Stand-in ssh servers on this machine, to try gpull.py against a fleet (eg. several --shards) without real servers.
+Every stand-in host listens on its own port, accepts any user and password, and runs commands in its own directory
+with clones of the given repositories in www/. sudo gets replaced by a shim that just runs the command.
+"""
+
+# a sudo that ignores its options (-S, -u user) and runs the command as the current user
+SUDO_SHIM = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -S) shift ;;
+        -u) shift 2 ;;
+        *) break ;;
+    esac
+done
+exec "$@"
+"""
+
+
+class StandinServer(paramiko.ServerInterface):
+    def __init__(self, host_dir, path):
+        self.host_dir = host_dir
+        self.path = path
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_port_forward_request(self, address, port):
+        return False  # no --relay through the stand-ins
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.run, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def run(self, channel, command):
+        env = dict(os.environ, PATH=self.path)
+        try:
+            process = subprocess.Popen(['sh', '-c', command], cwd=self.host_dir, env=env,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in iter(process.stdout.readline, b''):
+                channel.sendall(line)
+            channel.send_exit_status(process.wait())
+        finally:
+            channel.close()
+
+
+class FleetStandin(object):
+    def __init__(self):
+        self.root = None
+        self.host_key = None
+        self.path = None
+
+    def main(self):
+        """Parse arguments and then call the appropriate function(s)."""
+        parser = argparse.ArgumentParser(description="""Run stand-in ssh servers to try gpull.py against.""")
+
+        parser.add_argument('-n', '--hosts', type=int, default=8, metavar="hosts",
+                            help="""number of stand-in servers (default 8)""")
+
+        parser.add_argument('--port', type=int, default=2200, metavar="port",
+                            help="""port of the first server; the others get the next ports (default 2200)""")
+
+        parser.add_argument('-r', '--repos', nargs="*", default=[], metavar="url",
+                            help="""repositories to clone into www/ on every server""")
+
+        parser.add_argument('-d', '--dir', default=None, metavar="dir",
+                            help="""directory for the servers' files (default: a new temporary directory)""")
+
+        args = parser.parse_args()
+
+        self.root = args.dir or tempfile.mkdtemp(prefix='gpull-fleet-')
+        self.host_key = paramiko.RSAKey.generate(2048)
+
+        shim_dir = os.path.join(self.root, 'bin')
+        if not os.path.isdir(shim_dir):
+            os.makedirs(shim_dir)
+        sudo = os.path.join(shim_dir, 'sudo')
+        with open(sudo, 'w') as f:
+            f.write(SUDO_SHIM)
+        os.chmod(sudo, os.stat(sudo).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        self.path = shim_dir + os.pathsep + os.environ.get('PATH', '')
+
+        urls = []
+        for port in range(args.port, args.port + args.hosts):
+            host_dir = os.path.join(self.root, str(port))
+            self.clone(args.repos, os.path.join(host_dir, 'www'))
+            self.listen(port, host_dir)
+            urls.append("127.0.0.1:{}".format(port))
+
+        out(0, green("{} stand-in server(s) running in {}".format(args.hosts, self.root)))
+        out(0, yellow("Add them to the Servers in settings.yaml:"))
+        out(0, " standin:\n    url: [{}]\n    env: local\n    group: group1\n    git_user: www-data".format(
+            ", ".join("'{}'".format(url) for url in urls)))
+        out(0, yellow("and update them with eg.: ") +
+            bold("python gpull.py -s standin -p ./www --shards 4 -j 4") + " (Ctrl-C to stop the servers)")
+
+        try:
+            threading.Event().wait(10 ** 9)
+        finally:
+            if args.dir is None:
+                shutil.rmtree(self.root, ignore_errors=True)
+
+    def clone(self, repos, www_dir):
+        if not os.path.isdir(www_dir):
+            os.makedirs(www_dir)
+        for repo in repos:
+            target = os.path.join(www_dir, os.path.basename(repo.rstrip('/')).replace('.git', ''))
+            if not os.path.isdir(target):
+                subprocess.check_call(['git', 'clone', '--quiet', repo, target])
+
+    def listen(self, port, host_dir):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', port))
+        sock.listen(100)
+
+        def serve(client):
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=StandinServer(host_dir, self.path))
+
+        def accept():
+            while True:
+                client, address = sock.accept()
+                thread = threading.Thread(target=serve, args=(client, ))
+                thread.daemon = True
+                thread.start()
+
+        thread = threading.Thread(target=accept)
+        thread.daemon = True
+        thread.start()
+
+
+if __name__ == "__main__":
+    try:
+        FleetStandin().main()
+    except KeyboardInterrupt:
+        out(0, "Stopped by user.")
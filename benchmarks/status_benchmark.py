@@ -0,0 +1,147 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from utils.cli.output import out, yellow, green, bold
+
+__author__ = 'Kevin Dubois'
+
+"""
+Benchmark the status checks of gpull_local.py on a big working tree:
+the old human readable checks, the porcelain checks, and the --fast-status checks.
+"""
+
+
+class StatusBenchmark(object):
+    def __init__(self):
+        self.repo_path = None
+
+    def main(self):
+        """Parse arguments and then call the appropriate function(s)."""
+        parser = argparse.ArgumentParser(description="""Benchmark gpull's status checks on a big working tree.""")
+
+        parser.add_argument('-f', '--files', type=int, default=100000, metavar="files",
+                            help="""number of tracked files to create (default 100000)""")
+
+        parser.add_argument('-u', '--untracked', type=int, default=50000, metavar="untracked",
+                            help="""number of untracked files to create, eg. uploads and cache (default 50000)""")
+
+        parser.add_argument('-r', '--runs', type=int, default=5, metavar="runs",
+                            help="""number of times to run every check (default 5)""")
+
+        parser.add_argument('-p', '--path', default=None, metavar="path",
+                            help="""reuse (or create) the test repository here instead of in a temp directory""")
+
+        args = parser.parse_args()
+
+        keep = args.path is not None
+        self.repo_path = args.path or tempfile.mkdtemp(prefix='gpull-status-benchmark-')
+
+        try:
+            if not os.path.isdir(os.path.join(self.repo_path, '.git')):
+                self.create_repository(args.files, args.untracked)
+
+            checks = [
+                ('status -uno + status (old)', ["git status -uno", "git status"], False),
+                ('status --porcelain', ["git status --porcelain"], False),
+                ('fast status', ["git status --porcelain --untracked-files=no"], True),
+            ]
+            for name, commands, fast in checks:
+                self.configure(fast)
+                timings = self.time_commands(commands, args.runs)
+                out(1, "{}: min {:.3f}s, median {:.3f}s".format(
+                    bold(name.ljust(28)), min(timings), sorted(timings)[len(timings) // 2]))
+        finally:
+            if not keep:
+                shutil.rmtree(self.repo_path, ignore_errors=True)
+
+    def create_repository(self, files, untracked):
+        """
+        Create a repository with lots of tracked files, and lots of untracked files next to them
+        :return: void
+        """
+        out(0, yellow("Creating {} tracked and {} untracked files in {}".format(files, untracked, self.repo_path)))
+        start = time.time()
+
+        if not os.path.isdir(self.repo_path):
+            os.makedirs(self.repo_path)
+        self.exec_shell("git init -q")
+
+        write_files(os.path.join(self.repo_path, 'vendor'), files)
+        self.exec_shell("git add -A")
+        self.exec_shell("git -c user.name=gpull -c user.email=gpull@localhost commit -q -m benchmark")
+        write_files(os.path.join(self.repo_path, 'uploads'), untracked)
+
+        out(1, green("done in {:.1f}s".format(time.time() - start)))
+
+    def configure(self, fast):
+        """
+        Turn the caches gpull_local.py --fast-status enables on or off
+        :param fast: bool
+        :return: void
+        """
+        for key in ('core.untrackedCache', 'core.preloadIndex', 'core.fsmonitor'):
+            try:
+                self.exec_shell("git config --unset " + key)
+            except subprocess.CalledProcessError:
+                pass  # wasn't set
+
+        if fast:
+            self.exec_shell("git config core.untrackedCache true")
+            self.exec_shell("git config core.preloadIndex true")
+            try:
+                self.exec_shell("git fsmonitor--daemon status")
+                supported = True
+            except subprocess.CalledProcessError as e:
+                supported = b'not supported' not in e.output
+            if supported:
+                self.exec_shell("git config core.fsmonitor true")
+
+        # warm up the caches (and the file system monitor) so every check starts from the same state
+        self.exec_shell("git status --porcelain")
+
+    def time_commands(self, commands, runs):
+        """
+        :return: list of seconds every run took
+        """
+        timings = []
+        for _ in range(runs):
+            start = time.time()
+            for command in commands:
+                self.exec_shell(command)
+            timings.append(time.time() - start)
+
+        return timings
+
+    def exec_shell(self, command):
+        """Execute a shell command in the test repository and get the output."""
+        return subprocess.check_output(shlex.split(command), cwd=self.repo_path, stderr=subprocess.STDOUT)
+
+
+def write_files(root, count, per_dir=500):
+    """
+    Write count small files under root, per_dir files per directory
+    :return: void
+    """
+    for i in range(count):
+        directory = os.path.join(root, 'dir{}'.format(i // per_dir))
+        if i % per_dir == 0 and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'file{}.txt'.format(i)), 'w') as f:
+            f.write('{}\n'.format(i))
+
+
+if __name__ == "__main__":
+    try:
+        StatusBenchmark().main()
+    except KeyboardInterrupt:
+        out(0, "Stopped by user.")
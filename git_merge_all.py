@@ -3,18 +3,30 @@
 import argparse
 import utils.cli.git_utils as gpull
 from utils.cli.output import out, blue, yellow, green, bold, red
+from utils.checkpoint import Checkpoint
 from utils.config import Config
+from utils.metrics import Metrics
+from utils import merge_check
 
 __author__ = 'Kevin Dubois'
 __version__ = '0.0.1'
 
 
+def is_false(value):
+    """
+    :param value: string value of a true/false option, eg. of -o False
+    :return: bool
+    """
+    return str(value).lower() in ('false', '0', 'no')
+
+
 class GitMergeAll(object):
     def __init__(self):
         """instantiate default variables to be used in the class"""
         self.gitutils = gpull.GitUtils()
         config = Config()
         self.default_working_dir = config.get_default_merge_dir()
+        self.repositories = config.repositories
 
     def main(self):
         """Parse arguments and then call the appropriate function(s)."""
@@ -33,23 +45,111 @@ class GitMergeAll(object):
         parser.add_argument('-w', '--working-dir', nargs='?', metavar="working_dir", required=False, default=None,
                             help="""Working Directory (to stage the merge)""")
 
+        parser.add_argument('-c', '--check', action='store_true', default=False,
+                            help="""Dry run: only report which repositories would merge cleanly, conflict,
+                            are already merged or are missing a branch. Nothing gets checked out or pushed.""")
+
+        parser.add_argument('--metrics', default=None, metavar="path",
+                            help="""write Prometheus metrics of this run to this .prom file or directory
+                            (defaults to MetricsDir in settings.yaml)""")
+
+        parser.add_argument('--metrics-push', default=None, metavar="url",
+                            help="""push Prometheus metrics of this run to this Pushgateway, eg. http://localhost:9091""")
+
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help="""continue the last merge with the same arguments that got interrupted or failed:
+                            only merge the repositories it didn't merge successfully""")
+
         args = parser.parse_args()
 
         if args.working_dir is None:
             args.working_dir = self.default_working_dir
 
+        # -o False comes in as a string
+        args.one_way = not is_false(args.one_way)
+
+        metrics = Metrics('git_merge_all', args.metrics, args.metrics_push)
+        if metrics.enabled():
+            self.gitutils.metrics = metrics
+
         try:
-            self.merge_branches(args.branch, args.to_branch, args.one_way, args.working_dir)
+            if args.check:
+                self.check_branches(args.branch, args.to_branch, args.one_way)
+            else:
+                self.merge_with_checkpoint(args)
 
         except Exception as e:
             out(0, red(e))
 
+    def merge_with_checkpoint(self, args):
+        """
+        Merge the branches, keeping track of the repositories that got merged so the merge can be resumed
+        :return: bool
+        """
+        params = {'branch': args.branch, 'to_branch': args.to_branch, 'one_way': args.one_way,
+                  'working_dir': args.working_dir, 'repositories': self.repositories}
+        checkpoint = Checkpoint('git_merge_all', params, args.resume)
+        self.gitutils.checkpoint = checkpoint
+
+        status = 'failed'
+        try:
+            self.merge_branches(args.branch, args.to_branch, args.one_way, args.working_dir)
+            if all(result['status'] in ('merged', 'skipped') for result in self.gitutils.merge_results):
+                status = 'finished'
+        finally:
+            checkpoint.finish(status)
+            if status != 'finished':
+                out(1, yellow("Run git_merge_all.py again with the same arguments and --resume to only retry "
+                              "the repositories that didn't merge."))
+
+        return status == 'finished'
+
+    def check_branches(self, branch, to_branch, one_way=True):
+        """
+        Report what merging would do in every repository, without touching any working tree
+        :return: bool True if every repository can be merged without conflicts
+        """
+        checker = merge_check.MergeCheck()
+        directions = [(branch, to_branch)]
+        if one_way is False:
+            directions.insert(0, (to_branch, branch))
+
+        mergeable = True
+        for from_branch, into_branch in directions:
+            out(1, blue("Checking merge from {} into {}".format(from_branch, into_branch)))
+
+            for result in checker.check_all(self.repositories, from_branch, into_branch):
+                status = result['status']
+                line = bold(result['repo']) + ": "
+                if status == merge_check.CLEAN:
+                    out(2, line + green(status))
+                elif status == merge_check.ALREADY_MERGED:
+                    out(2, line + blue(status))
+                elif status == merge_check.MISSING_BRANCH:
+                    out(2, line + yellow("{} ({})".format(status, ", ".join(result['branches']))))
+                elif status == merge_check.CONFLICTED:
+                    out(2, line + red(status))
+                    for path in result['files']:
+                        out(3, red(path))
+                    mergeable = False
+                else:
+                    out(2, line + red(status))
+                    out(3, red(result['error']))
+                    mergeable = False
+
+        if mergeable:
+            out(1, green("All repositories can be merged without conflicts."))
+        else:
+            out(1, red("Some repositories cannot be merged automatically."))
+
+        return mergeable
+
     def merge_branches(self, branch, to_branch, one_way=True, working_dir='var/release'):
 
         if one_way is False:
             # first  merge to branch into the working branch
             out(1, blue("Pulling from {} and merging into {}".format(to_branch, branch)))
-            output = self.gitutils.git_merge_all(to_branch, branch. working_dir)
+            output = self.gitutils.git_merge_all(to_branch, branch, working_dir)
 
             if output is False:
                 raise Exception("Aborting!! Could not run shell command :(")
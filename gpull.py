@@ -2,11 +2,18 @@
 # -*- coding: utf-8 -*-
 import argparse
 import getpass
+import os
+import sys
+import tempfile
 
 import utils.cli.git_utils as git_utils
 from utils import server_config
+from utils.checkpoint import Checkpoint
 from utils.cli.output import out, yellow, bold
 from utils.config import Config
+from utils.manifest import format_targets, parse_targets
+from utils.metrics import Metrics
+from utils import shards
 
 __author__ = 'Kevin Dubois'
 __version__ = '1.0.0'
@@ -58,18 +65,141 @@ class GitPull(object):
         parser.add_argument('-u', '--remote-user', nargs='?', default=None, metavar="your ssh username",
                             help="""ssh into into git server with this user""")
 
+        parser.add_argument('--relay', action='store_true', default=False,
+                            help="""fetch every repository once on this machine, and have the servers fetch
+                            from here (through their ssh connection) instead of from the git server""")
+
+        parser.add_argument('-j', '--jobs', type=int, default=1, metavar="jobs",
+                            help="""number of servers to update at the same time (default 1)""")
+
+        parser.add_argument('--fast-status', action='store_true', default=False,
+                            help="""check for local changes without scanning for untracked files, and enable
+                            git's untracked cache, index preloading and file system monitor in every repository""")
+
+        parser.add_argument('--host-changelogs', action='store_true', default=False,
+                            help="""show the changes every server pulled, instead of computing every change once
+                            on this machine and showing it with the list of servers it applies to""")
+
+        parser.add_argument('--two-phase', action='store_true', default=False,
+                            help="""fetch on every server first, without touching the working trees, and only once
+                            every server is ready, fast-forward or check out the working trees on all of them at once""")
+
+        parser.add_argument('--shard', type=shards.parse_shard, default=None, metavar="index/count",
+                            help="""only update the servers of this shard, eg. 2/4: the servers are split over the
+                            shards by consistent hashing, so every controller can run its own shard""")
+
+        parser.add_argument('--results-file', default=None, metavar="path",
+                            help="""write the results of this run (eg. of one shard) to this file, to merge them
+                            with --merge-results later""")
+
+        parser.add_argument('--merge-results', nargs="+", default=None, metavar="path",
+                            help="""instead of updating anything, merge the results files of the shards of a run
+                            into one report""")
+
+        parser.add_argument('--shards', type=int, default=None, metavar="count",
+                            help="""split this run over this many controller processes on this machine, and
+                            merge their results into one report""")
+
+        parser.add_argument('--manifest', default=None, metavar="environment",
+                            help="""instead of pulling, converge every server on the commits of this environment's
+                            manifest (see Manifests in settings.yaml); repositories that are already on their commit
+                            aren't touched at all""")
+
+        parser.add_argument('--converge', nargs='+', default=None, metavar="repo=commit",
+                            help="""like --manifest, with the commits given here (used by --shards, to have every
+                            shard converge on the commits the manifest was resolved to once)""")
+
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help="""continue the last run with the same arguments that got interrupted or failed:
+                            only update the servers it didn't update successfully""")
+
+        parser.add_argument('--repo', nargs="*", metavar="repo", default=None,
+                            help="""only update these repositories, and only on the servers that have them according
+                            to the inventory (servers that weren't crawled recently get crawled first)""")
+
+        parser.add_argument('--crawl', action='store_true', default=False,
+                            help="""refresh the inventory of repositories, remotes and branches on the servers
+                            instead of updating them""")
+
+        parser.add_argument('--metrics', default=None, metavar="path",
+                            help="""write Prometheus metrics of this run to this .prom file or directory
+                            (defaults to MetricsDir in settings.yaml)""")
+
+        parser.add_argument('--metrics-push', default=None, metavar="url",
+                            help="""push Prometheus metrics of this run to this Pushgateway, eg. http://localhost:9091""")
+
+        parser.add_argument('--no-metrics', action='store_true', default=False,
+                            help="""don't write or push metrics of this run, not even to MetricsDir""")
+
         args = parser.parse_args()
 
+        if args.manifest is not None or args.converge is not None:
+            if args.two_phase:
+                parser.error("--manifest and --converge can't be combined with --two-phase")
+        if args.two_phase and (args.shards is not None or args.shard is not None):
+            # every shard would apply as soon as its own servers are ready, not once all servers are
+            parser.error("--two-phase can't be combined with --shards or --shard")
+        if args.manifest is not None and not Config().get_manifest(args.manifest):
+            parser.error("there is no manifest for {} in settings.yaml".format(args.manifest))
+        if args.converge is not None:
+            try:
+                converge = parse_targets(args.converge)
+            except ValueError as e:
+                parser.error(str(e))
+
         out(0, (yellow(bold("gpull") + ": remotely pull git repos")))
 
-        if args.servers is not None:
-            pw = getpass.getpass("Your ssh password:")  # Prompt user for ssh password
-        else:
+        gitutils = git_utils.GitUtils()
+        gitutils.host_changelogs = args.host_changelogs
+        metrics = Metrics('gpull', args.metrics, args.metrics_push, args.no_metrics)
+        if metrics.enabled():
+            gitutils.metrics = metrics
+
+        if args.merge_results is not None:
+            gitutils.merge_shard_results(args.merge_results)
+            return
+
+        if args.servers is None:
             pw = None  # No password needed to update your local folders
+        elif os.environ.get(shards.PASSWORD_ENV) is not None:
+            pw = os.environ[shards.PASSWORD_ENV]  # we are a shard, started by --shards
+        else:
+            pw = getpass.getpass("Your ssh password:")  # Prompt user for ssh password
 
-        gitutils = git_utils.GitUtils()
+        # a run can only be resumed with the same parameters, so that's what the checkpoint is kept by
+        params = dict((name, getattr(args, name)) for name in ('path', 'branch', 'force', 'all', 'remote', 'servers',
+                                                               'repo', 'two_phase', 'shard', 'fast_status',
+                                                               'manifest', 'converge'))
+
+        if args.shards is not None:
+            # the shards get the same arguments, but write their own results and leave the metrics to us
+            shard_args = shards.strip_options(sys.argv[1:], ['--shards', '--shard', '--results-file', '--metrics',
+                                                             '--metrics-push']) + ['--no-metrics']
+            if args.manifest is not None:
+                # resolve the manifest once, so every shard converges on the same commits
+                gitutils.manifest = args.manifest
+                # so --resume gives the shards the commits they started on, and they can resume their own checkpoints
+                gitutils.checkpoint = Checkpoint('gpull-shards', params, args.resume)
+                if not gitutils.resolve_manifest():
+                    return
+                shard_args = shards.strip_options(shard_args, ['--manifest']) + \
+                    ['--converge'] + format_targets(gitutils.converge).split()
+            results_files = shards.run_shards(os.path.abspath(__file__), shard_args, args.shards,
+                                              tempfile.mkdtemp(prefix='gpull-shards-'), pw)
+            finished = gitutils.merge_shard_results(results_files)
+            if gitutils.checkpoint is not None:
+                gitutils.checkpoint.finish('finished' if finished else 'failed')
+            return
+
+        gitutils.shard = args.shard
+        gitutils.results_file = args.results_file
+        gitutils.manifest = args.manifest
+        if args.converge is not None:
+            gitutils.converge = converge
+        gitutils.checkpoint = Checkpoint('gpull', params, args.resume)
         gitutils.remote_pull(args.path, args.branch, args.force, args.servers, args.remote_user, pw, args.all,
-                             args.remote)
+                             args.remote, args.relay, args.jobs, args.fast_status, args.host_changelogs,
+                             args.repo, args.crawl, args.two_phase)
 
 
 if __name__ == "__main__":
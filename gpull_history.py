@@ -0,0 +1,143 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+import argparse
+import datetime
+
+from utils.cli.output import out, blue, yellow, green, bold, red
+from utils.run_history import RunHistory, parse_since, STATUS_FAILED
+
+__author__ = 'Kevin Dubois'
+__version__ = '1.0.0'
+
+"""gpull_history: query the history of previous gpull runs"""
+
+
+class GitPullHistory(object):
+    def __init__(self):
+        """instantiate default variables to be used in the class"""
+        self.history = RunHistory()
+
+    def main(self):
+        """Parse arguments and then call the appropriate function(s)."""
+
+        parser = argparse.ArgumentParser(description="""Query the history of previous gpull runs.""")
+
+        subparsers = parser.add_subparsers(dest='query')
+
+        changes = subparsers.add_parser('changes', help="""repositories that moved to a different commit""")
+        changes.add_argument('-s', '--since', default='1h', metavar="since",
+                             help="""how far back to look, eg. 30m, 1h, 7d (default 1h)""")
+        changes.add_argument('--host', default=None, metavar="host", help="""only show changes on this host""")
+        changes.add_argument('--repo', default=None, metavar="repo", help="""only show changes to this repo""")
+
+        slowest = subparsers.add_parser('slowest', help="""slowest repositories to update""")
+        slowest.add_argument('-s', '--since', default='7d', metavar="since",
+                             help="""how far back to look, eg. 30m, 1h, 7d (default 7d)""")
+        slowest.add_argument('-l', '--limit', type=int, default=10, metavar="limit",
+                             help="""number of repositories to show (default 10)""")
+        slowest.add_argument('--fetch', action='store_true', default=False,
+                             help="""sort by fetch time instead of total update time""")
+        slowest.add_argument('--repo', default=None, metavar="repo", help="""only show this repo""")
+
+        hooks = subparsers.add_parser('hooks', help="""slowest post-update hooks""")
+        hooks.add_argument('-s', '--since', default='7d', metavar="since",
+                           help="""how far back to look, eg. 30m, 1h, 7d (default 7d)""")
+        hooks.add_argument('-l', '--limit', type=int, default=10, metavar="limit",
+                           help="""number of hooks to show (default 10)""")
+        hooks.add_argument('--repo', default=None, metavar="repo", help="""only show the hooks of this repo""")
+
+        failures = subparsers.add_parser('failures', help="""failure rates per repository or host""")
+        failures.add_argument('-s', '--since', default='7d', metavar="since",
+                              help="""how far back to look, eg. 30m, 1h, 7d (default 7d)""")
+        failures.add_argument('--hosts', action='store_true', default=False,
+                              help="""group by host instead of by repository""")
+
+        args = parser.parse_args()
+
+        if self.history.conn is None:
+            out(0, red("Run history is not available."))
+            return
+
+        since = parse_since(args.since)
+
+        if args.query == 'changes':
+            self.show_changes(since, args.host, args.repo)
+        elif args.query == 'slowest':
+            self.show_slowest(since, args.limit, 'fetch_duration' if args.fetch else 'duration', args.repo)
+        elif args.query == 'hooks':
+            self.show_hooks(since, args.limit, args.repo)
+        elif args.query == 'failures':
+            self.show_failures(since, 'host' if args.hosts else 'repo')
+        else:
+            parser.print_help()
+
+    def show_changes(self, since, host=None, repo=None):
+        rows = self.history.recent_changes(since, host, repo)
+
+        if not rows:
+            out(0, blue("No changes."))
+            return
+
+        out(0, yellow("{} change(s):".format(len(rows))))
+        for row in rows:
+            out(1, "{} {} {}: {} -> {}{}".format(
+                format_time(row['started_at']), bold(row['host']), bold(row['repo']),
+                describe(row['branch_before'], row['sha_before']),
+                green(describe(row['branch_after'], row['sha_after'])),
+                red(" (update failed)") if row['status'] == STATUS_FAILED else ''))
+
+    def show_slowest(self, since, limit, column, repo=None):
+        rows = self.history.slowest_repos(since, limit, column, repo)
+
+        if not rows:
+            out(0, blue("No updates recorded."))
+            return
+
+        out(0, yellow("Slowest repositories ({}):".format('fetch' if column == 'fetch_duration' else 'update')))
+        for row in rows:
+            out(1, "{}: average {:.2f}s, slowest {:.2f}s over {} update(s)".format(
+                bold(row['repo']), row['average'], row['slowest'], row['updates']))
+
+    def show_hooks(self, since, limit, repo=None):
+        rows = self.history.slowest_hooks(since, limit, repo)
+
+        if not rows:
+            out(0, blue("No hooks recorded."))
+            return
+
+        out(0, yellow("Slowest post-update hooks:"))
+        for row in rows:
+            line = "{} {}: average {:.2f}s, slowest {:.2f}s over {} run(s)".format(
+                bold(row['repo']), bold(row['name']), row['average'], row['slowest'], row['runs'])
+            if row['failed']:
+                line += red(", {} failed".format(row['failed']))
+            out(1, line)
+
+    def show_failures(self, since, by):
+        rows = self.history.failure_rates(since, by)
+
+        if not rows:
+            out(0, blue("No updates recorded."))
+            return
+
+        out(0, yellow("Failure rates per {}:".format(by)))
+        for row in rows:
+            rate = 100.0 * row['failed'] / row['total']
+            line = "{}: {:.1f}% ({} of {})".format(bold(row['name']), rate, row['failed'], row['total'])
+            out(1, red(line) if row['failed'] else line)
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def describe(branch, sha):
+    return "{}@{}".format(branch or '?', sha[:8] if sha else 'none')
+
+
+if __name__ == "__main__":
+    try:
+        GitPullHistory = GitPullHistory()
+        GitPullHistory.main()
+    except KeyboardInterrupt:
+        out(0, "Stopped by user.")
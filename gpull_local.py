@@ -6,9 +6,21 @@ import argparse
 import os
 import shlex
 import subprocess
+import time
 
+from utils.admission import admission, is_throttled, NETWORK_COMMANDS
+from utils.cli import report
 from utils.cli.output import out, blue, yellow, green, bold, red
 from utils.config import Config
+from utils.hooks import HookRunner, STATUS_DONE as HOOK_DONE, STATUS_FAILED as HOOK_FAILED
+from utils.host_health import HostHealth, is_transient, remote_host, retry
+from utils.manifest import is_commit_id, parse_targets, pick_ref
+from utils.maintenance import MaintenanceScheduler, STATUS_DONE as MAINTENANCE_DONE, \
+    STATUS_FAILED as MAINTENANCE_FAILED
+from utils.metrics import Metrics
+from utils.mirror import mirror_name
+from utils.run_history import RunHistory, STATUS_UNCHANGED, STATUS_UPDATED, STATUS_FAILED, STATUS_SKIPPED
+from utils.worktrees import Worktrees
 
 # Import smtplib for the actual sending function
 import smtplib
@@ -19,6 +31,14 @@ from email.mime.text import MIMEText
 __author__ = 'Kevin Dubois'
 __version__ = '1.0.0'
 
+# attempts to make at fetching or pulling before giving up on a repository
+FETCH_ATTEMPTS = 3
+
+# ref that --prefetch leaves the commit to fast-forward to in, for --apply
+PREFETCH_REF = 'refs/gpull/prefetch'
+# a repository that has everything --apply needs
+STATUS_READY = 'ready'
+
 """
 gpull: pull git repositories locally
 """
@@ -37,6 +57,32 @@ class GitPullLocal(object):
         self.branch = None
         self.git_user = None
         self.branch_changes = []
+        # results of every repository we touched, see update_repository
+        self.results = []
+        # print machine readable results for gpull.py instead of keeping our own run history
+        self.report = False
+        # skip untracked files when checking for local changes, and let git cache what it can, see configure_fast_status
+        self.fast_status = False
+        self.git_version = None
+        # leave the changelog out of the output; gpull.py computes it once for all servers instead
+        self.changelog = True
+        self.fsmonitor = None
+        # base url of the controller's fetch relay (eg. git://127.0.0.1:9418), used instead of the GitServer
+        self.relay = None
+        # names of the repositories the relay serves, or None if it serves all of them
+        self.relay_repos = None
+        # failure history of the remotes we fetch from, to skip the ones that keep failing
+        self.health = HostHealth()
+        # Prometheus metrics of this run, see record_metrics
+        self.metrics = None
+        # number of retried network operations, per git command
+        self.retries = {}
+        # whether the remote throttled a network operation of the repository being updated, see exec_remote
+        self.throttled = False
+        # only move the repositories to what --prefetch fetched, without talking to the remote
+        self.apply = False
+        # repo => commit id or ref to converge every repository on, instead of pulling; see converge_repository
+        self.converge = None
         self.email_host = self.config.email_settings['email_host']
         self.email_from = self.config.email_settings['email_from']
 
@@ -67,6 +113,72 @@ class GitPullLocal(object):
         parser.add_argument('-n', '--name', nargs='?', default=None, metavar="Name of user running this script",
                             help="""This name will appear on the email that gets sent out if branches were changed""")
 
+        parser.add_argument('--report', action='store_true', default=False,
+                            help="""print machine readable results for gpull.py instead of recording them
+                            in the local run history""")
+
+        parser.add_argument('--fast-status', action='store_true', default=False,
+                            help="""check for local changes without scanning for untracked files, and enable
+                            git's untracked cache, index preloading and file system monitor in every repository.
+                            Can also be enabled per repository with FastStatus in settings.yaml""")
+
+        parser.add_argument('--no-changelog', action='store_true', default=False,
+                            help="""don't print the changes that were pulled, only report the commits the
+                            repositories moved from and to (gpull.py shows the changes once for all servers)""")
+
+        parser.add_argument('--inventory', action='store_true', default=False,
+                            help="""instead of pulling, report the repositories under the given paths, with their
+                            remotes and branches (used by gpull.py to keep its inventory of servers up to date)""")
+
+        parser.add_argument('--prefetch', action='store_true', default=False,
+                            help="""first phase of a two-phase update: fetch the branch (-b, or the current one) into
+                            every repository and check it can be applied, without touching the working trees""")
+
+        parser.add_argument('--apply', action='store_true', default=False,
+                            help="""second phase of a two-phase update: fast-forward or check out every repository to
+                            what --prefetch fetched, without talking to the remote""")
+
+        parser.add_argument('--converge', nargs='+', default=None, metavar="repo=commit",
+                            help="""instead of pulling, move every repository to the commit (full id) or ref given
+                            for it, fetching only that commit when it's missing. Repositories that are already on
+                            their commit, or that aren't listed, aren't touched at all""")
+
+        parser.add_argument('--manifest', default=None, metavar="environment",
+                            help="""--converge on the commits or refs of this environment's manifest, see Manifests
+                            in settings.yaml""")
+
+        parser.add_argument('--worktrees', action='store_true', default=False,
+                            help="""instead of pulling, set up and update a worktree per branch of the repositories
+                            that have Worktrees in settings.yaml, without touching the one that is being served
+                            (eg. from cron, so switching branches with -b is just a symlink swap)""")
+
+        parser.add_argument('--maintenance', action='store_true', default=False,
+                            help="""instead of pulling, run repository maintenance (incremental repack, commit-graph
+                            and multi-pack-index writes, pruning) on the repositories that need it.
+                            Use -f to maintain every repository, whether it needs it or not.""")
+
+        parser.add_argument('--budget', type=int, default=600, metavar="seconds",
+                            help="""with --maintenance, don't start any new maintenance after this many seconds
+                            (default 600)""")
+
+        parser.add_argument('-j', '--jobs', type=int, default=2, metavar="jobs",
+                            help="""with --maintenance, number of repositories to maintain at the same time
+                            (default 2)""")
+
+        parser.add_argument('--relay', default=None, metavar="relay url",
+                            help="""fetch from this gpull.py relay (eg. git://127.0.0.1:9418) instead of
+                            from the origin remote""")
+
+        parser.add_argument('--relay-repos', nargs='*', default=None, metavar="repo",
+                            help="""only fetch these repositories from the --relay, and the others from origin""")
+
+        parser.add_argument('--metrics', default=None, metavar="path",
+                            help="""write Prometheus metrics of this run to this .prom file or directory
+                            (defaults to MetricsDir in settings.yaml)""")
+
+        parser.add_argument('--metrics-push', default=None, metavar="url",
+                            help="""push Prometheus metrics of this run to this Pushgateway, eg. http://localhost:9091""")
+
         args = parser.parse_args()
 
         if args.path is not None:
@@ -74,8 +186,8 @@ class GitPullLocal(object):
 
         self.force = True if args.force is None else args.force
 
-        if args.all:
-            self.all_dirs = args.all
+        if args.all is None or args.all:
+            self.all_dirs = True if args.all is None else args.all
 
         if args.branch is not None:
             self.branch = args.branch
@@ -83,7 +195,54 @@ class GitPullLocal(object):
         if args.user is not None:
             self.git_user = args.user
 
-        self.update_directories()
+        self.report = args.report
+        self.relay = args.relay
+        self.relay_repos = args.relay_repos
+        self.fast_status = args.fast_status
+        self.changelog = not args.no_changelog
+
+        if args.maintenance:
+            self.maintain_repositories(args.jobs, args.budget)
+            return
+
+        if args.inventory:
+            self.inventory_repositories()
+            return
+
+        if args.prefetch:
+            self.prefetch_repositories()
+            return
+
+        if args.worktrees:
+            self.update_worktrees()
+            return
+
+        self.apply = args.apply
+
+        if args.converge is not None:
+            try:
+                self.converge = parse_targets(args.converge)
+            except ValueError as e:
+                parser.error(str(e))
+        elif args.manifest is not None:
+            self.converge = self.config.get_manifest(args.manifest)
+            if not self.converge:
+                out(0, red("There is no manifest for {} in settings.yaml".format(args.manifest)))
+                return
+
+        metrics = Metrics('gpull_local', args.metrics, args.metrics_push)
+        if metrics.enabled():
+            self.metrics = metrics
+
+        started_at = time.time()
+        try:
+            if self.report:
+                self.update_directories()
+            else:
+                self.update_directories_with_history()
+        finally:
+            if self.metrics is not None:
+                self.record_metrics(started_at)
 
         if args.email is not None:
             self.email_changes(args.email, args.name)
@@ -95,6 +254,393 @@ class GitPullLocal(object):
             path_name = os.path.split(path)[1]  # directory name; "x" in /path/to/x/
             self.update_directory(path, path_name)
 
+    def update_directories_with_history(self):
+        """Update the directories, and record the results in the local run history."""
+        history = RunHistory()
+        history.start_run('gpull_local', self.branch, self.git_user)
+        started_at = time.time()
+        status = STATUS_FAILED
+        try:
+            self.update_directories()
+            if not any(result['status'] == STATUS_FAILED for result in self.results):
+                status = 'finished'
+        finally:
+            hostname = socket.gethostname()
+            history.record_host(hostname, None, status, started_at, time.time() - started_at)
+            for result in self.results:
+                history.record_repo(hostname, result)
+            history.finish_run(status)
+
+    def record_metrics(self, started_at):
+        """
+        Write the Prometheus metrics of this run
+        :param started_at: float unix timestamp
+        :return: void
+        """
+        self.metrics.record_run(started_at, self.results)
+        for operation, count in self.retries.items():
+            self.metrics.inc('gpull_retries_total', {'operation': operation}, count)
+        self.metrics.write()
+
+    def find_repositories(self):
+        """
+        Find the repositories in the list of directories supplied by command arguments,
+        the same way update_directory does.
+        :return: list of (path, name) tuples
+        """
+        repositories = []
+        for dir_path in self.dir_list:
+            dir_path = os.path.abspath(dir_path.replace('\\', '\\\\'))  # convert relative to absolute path
+            dir_name = os.path.split(dir_path)[1]  # directory name; "x" in /path/to/x/
+
+            if not self.is_valid_directory(dir_path):
+                out(0, red("{} '{}' is not a valid directory".format('directory', bold(dir_path))))
+            elif self.directory_is_git_repo(dir_path):
+                repositories.append((dir_path, dir_name))
+            elif self.all_dirs is False:
+                for repo_name in self.config.repositories:
+                    repo_path = os.path.join(dir_path, repo_name)
+                    if self.directory_is_git_repo(repo_path):
+                        repositories.append((repo_path, repo_name))
+            else:
+                for item in sorted(os.listdir(dir_path)):
+                    repo_path = os.path.join(dir_path, item)
+                    if self.directory_is_git_repo(repo_path):
+                        repositories.append((repo_path, os.path.join(dir_name, item)))
+
+        return repositories
+
+    def inventory_repositories(self):
+        """
+        Print an inventory record for every repository under the given paths
+        :return: list of inventory record dicts
+        """
+        records = []
+        for repo_path, repo_name in self.find_repositories():
+            os.chdir(repo_path)
+            origin_url = self.origin_url()
+
+            remotes = {}
+            try:
+                for line in self.exec_shell("git remote -v").splitlines():
+                    parts = line.split()
+                    if len(parts) == 3 and parts[2] == '(fetch)':
+                        remotes[parts[0]] = parts[1]
+            except subprocess.CalledProcessError:
+                pass  # no remotes
+            try:
+                branches = self.exec_shell("git for-each-ref --format=%(refname:short) refs/heads").split()
+            except subprocess.CalledProcessError:
+                branches = []
+
+            record = {
+                'repo': mirror_name(origin_url, os.path.basename(repo_path)),
+                'path': repo_path,
+                'name': repo_name,
+                'origin_url': origin_url,
+                'remotes': remotes,
+                'branch': self.get_branch(),
+                'branches': branches,
+                'head': self.get_head(),
+            }
+            records.append(record)
+
+            if self.report:
+                report.emit('inventory', **record)
+            else:
+                out(1, bold(record['repo']) + ": {} on {} ({})".format(
+                    repo_path, record['branch'], (record['head'] or 'no commits')[:8]))
+
+        if self.report:
+            # tells gpull.py the crawl got to the end, so a host without repositories isn't mistaken for a failure
+            report.emit('inventoried', repos=len(records))
+
+        return records
+
+    def prefetch_repositories(self):
+        """
+        Fetch what --apply needs into every repository under the given paths, and check it can be applied
+        :return: bool True if every repository is ready
+        """
+        results = []
+        for repo_path, repo_name in self.find_repositories():
+            out(1, bold(repo_name) + ":")
+            os.chdir(repo_path)
+            self.throttled = False
+            result = self.prefetch_repository(repo_path, repo_name)
+            if self.throttled:
+                result['throttled'] = True
+            results.append(result)
+
+            if result['status'] == STATUS_READY:
+                out(2, green("ready to move from {} to {} on {}".format(
+                    (result['sha_before'] or 'nothing')[:8], result['target'][:8], result['branch'])))
+            else:
+                out(2, red("not ready: ") + result['error'])
+            if self.report:
+                report.emit('prefetch', **result)
+
+        if self.report:
+            # tells gpull.py every repository got its prefetch record, and gpull_local.py didn't stop halfway
+            report.emit('prefetched', repos=len(results))
+
+        return all(result['status'] == STATUS_READY for result in results)
+
+    def prefetch_repository(self, repo_path, repo_name):
+        """
+        Fetch the branch to update a single repository to, and remember the commit to fast-forward to.
+        Only the remote tracking branches and PREFETCH_REF change; the working tree and branches stay as they are.
+        :return: dict result, with status STATUS_READY or STATUS_FAILED
+        """
+        current_branch = self.get_branch()
+        branch = self.branch or current_branch
+        result = {'repo': repo_name, 'path': repo_path, 'branch': branch, 'sha_before': self.get_head(),
+                  'target': None, 'status': STATUS_FAILED}
+
+        if not branch or branch == 'HEAD':
+            result['error'] = 'not on a branch'
+            return result
+
+        remote = remote_host(self.origin_url() or '')
+        if not self.health.allow(remote):
+            result['error'] = 'remote {} {}'.format(remote, self.health.skipped[remote])
+            return result
+
+        git = self.remote_git()
+        self.step(repo_name, 'fetch')
+        fetch_start = time.time()
+        try:
+            try:
+                self.exec_remote(git + " fetch origin")
+            except subprocess.CalledProcessError:
+                if git == "git":
+                    raise
+                # the relay doesn't have this repository, so go to the origin remote directly
+                self.exec_remote("git fetch origin")
+        except subprocess.CalledProcessError as e:
+            self.record_fetch_failure(remote, e)
+            result['error'] = 'cannot fetch:\n' + e.output.decode('UTF-8').strip()
+            return result
+        finally:
+            result['fetch_duration'] = time.time() - fetch_start
+        self.health.record_success(remote)
+
+        try:
+            result['target'] = self.exec_shell(
+                "git rev-parse --verify --quiet refs/remotes/origin/{}^{{commit}}".format(branch)).strip()
+        except subprocess.CalledProcessError:
+            result['error'] = 'branch {} does not exist on origin'.format(branch)
+            return result
+
+        # make sure --apply won't have to stop halfway
+        if branch != current_branch and self.branch_exists(branch):
+            base = "refs/heads/" + branch
+        else:
+            base = "HEAD" if branch == current_branch else None
+        if base is not None and not self.is_ancestor(base, result['target']):
+            result['error'] = 'cannot fast-forward {} to origin/{}'.format(branch, branch)
+            return result
+        moving = branch != current_branch or result['target'] != result['sha_before']
+        if moving and not self.force and self.has_local_changes(self.use_fast_status(repo_path, repo_name)):
+            result['error'] = 'there are uncommitted changes'
+            return result
+
+        self.exec_shell("git update-ref {} {}".format(PREFETCH_REF, result['target']))
+        result['status'] = STATUS_READY
+
+        return result
+
+    def apply_repository(self, repo_path, repo_name, result):
+        """
+        Move a single repository to the commit --prefetch fetched, without talking to the remote
+        :param repo_path:
+        :param repo_name:
+        :param result: dict of results for the run history, updated in place
+        :return: bool
+        """
+        try:
+            target = self.exec_shell("git rev-parse --verify --quiet {}^{{commit}}".format(PREFETCH_REF)).strip()
+        except subprocess.CalledProcessError:
+            out(2, red("Error: ") + "nothing was prefetched")
+            result['status'] = STATUS_FAILED
+            result['error'] = 'nothing was prefetched'
+            return False
+
+        current_branch = self.get_branch()
+        branch = self.branch or current_branch
+        result['branch_before'] = current_branch
+
+        self.step(repo_name, 'apply')
+        try:
+            if self.force:
+                out(2, green(self.exec_shell("git reset --hard HEAD")))
+            if branch != current_branch:
+                out(2, yellow("switching from {} to {}".format(current_branch, branch)))
+                # creates the branch from origin/<branch> if it doesn't exist locally yet
+                out(2, yellow(self.exec_shell("git checkout {}{}".format("-f " if self.force else "", branch))))
+                self.branch_changes.append([repo_name, current_branch, branch])
+            apply_result = self.exec_shell("git merge --ff-only " + target)
+        except subprocess.CalledProcessError as e:
+            out(2, red(e.output.decode('UTF-8')))
+            result['status'] = STATUS_FAILED
+            result['error'] = 'cannot apply'
+            return False
+
+        self.exec_shell("git update-ref -d " + PREFETCH_REF)
+        out(2, blue(apply_result))
+
+        return True
+
+    def update_worktrees(self):
+        """
+        Set up and update the worktrees of every repository under the given paths that has Worktrees in
+        settings.yaml. The worktree that is being served doesn't get touched; that's what a regular pull is for.
+        :return: bool True if every worktree is up to date
+        """
+        updated = True
+        for repo_path, repo_name in self.find_repositories():
+            branches = self.worktree_branches(repo_path, repo_name)
+            if not branches:
+                continue
+
+            out(1, bold(repo_name) + ":")
+            worktrees = Worktrees(repo_path, self.exec_shell)
+            os.chdir(repo_path)
+            try:
+                if not worktrees.is_set_up():
+                    branch = self.get_branch()
+                    if not branch or branch == 'HEAD':
+                        out(2, red("Error: ") + "not on a branch, so it can't be served from a worktree")
+                        updated = False
+                        continue
+                    worktrees.set_up(branch)
+                    out(2, green("Now serving {} from {}".format(branch, worktrees.path(branch))))
+                    os.chdir(repo_path)  # the repository moved into its worktree directory
+
+                self.step(repo_name, 'fetch')
+                git = self.remote_git()
+                try:
+                    self.exec_remote(git + " fetch origin")
+                except subprocess.CalledProcessError:
+                    if git == "git":
+                        raise
+                    # the relay doesn't have this repository, so go to the origin remote directly
+                    self.exec_remote("git fetch origin")
+
+                served = worktrees.served_branch()
+                for branch in branches:
+                    self.step(repo_name, 'worktree ' + branch)
+                    if not worktrees.exists(branch):
+                        worktrees.add(branch)
+                        out(2, green("{}: added {}".format(branch, worktrees.path(branch))))
+                    elif branch == served:
+                        out(2, blue("{}: being served, leaving it to gpull".format(branch)))
+                    else:
+                        update_result = worktrees.update(branch).strip().splitlines()
+                        out(2, blue("{}: {}".format(branch, update_result[-1] if update_result else 'up to date')))
+            except subprocess.CalledProcessError as e:
+                out(2, red("Error: ") + e.output.decode('UTF-8'))
+                updated = False
+            except OSError as e:
+                out(2, red("Error: ") + str(e))
+                updated = False
+
+        return updated
+
+    def worktree_branches(self, repo_path, repo_name):
+        """
+        :return: list of the branches to keep a worktree of, from Worktrees in settings.yaml
+        """
+        # with -a, repositories are named after their directory too, eg. www/repo2
+        return self.config.get_worktrees(repo_name) or self.config.get_worktrees(os.path.basename(repo_path))
+
+    def get_worktrees(self, repo_path, repo_name):
+        """
+        :return: Worktrees of a repository that is served from its worktrees | None
+        """
+        if not self.worktree_branches(repo_path, repo_name):
+            return None
+
+        worktrees = Worktrees(repo_path, self.exec_shell)
+        return worktrees if worktrees.is_set_up() else None
+
+    def switch_worktree(self, repo_path, repo_name, worktrees, current_branch, branch, result):
+        """
+        Switch branches by fast-forwarding the branch's worktree and then pointing the served path at it
+        :return: bool
+        """
+        if not self.force and self.has_local_changes(self.use_fast_status(repo_path, repo_name)):
+            out(2, red("Could not switch branch: ") + "there are uncommitted changes, use -f to switch anyway")
+            result['status'] = STATUS_FAILED
+            result['error'] = 'cannot switch to branch {}'.format(branch)
+            return False
+
+        try:
+            out(2, blue(worktrees.update(branch).strip()))
+            worktrees.switch(branch)
+        except subprocess.CalledProcessError as e:
+            out(2, red("Could not update the worktree of {}: \n".format(branch) + e.output.decode('UTF-8')))
+            result['status'] = STATUS_FAILED
+            result['error'] = 'cannot switch to branch {}'.format(branch)
+            return False
+        except OSError as e:
+            out(2, red("Could not switch branch: ") + str(e))
+            result['status'] = STATUS_FAILED
+            result['error'] = 'cannot switch to branch {}'.format(branch)
+            return False
+
+        out(2, green("Switched from {} to {} by serving {}".format(current_branch, branch, worktrees.path(branch))))
+        self.branch_changes.append([repo_name, current_branch, branch])
+        result['served_worktree'] = worktrees.path(branch)
+        # carry on in the worktree that is being served now
+        os.chdir(repo_path)
+
+        return True
+
+    def branch_exists(self, branch):
+        try:
+            self.exec_shell("git rev-parse --verify --quiet refs/heads/" + branch)
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    def is_ancestor(self, ancestor, commit):
+        try:
+            self.exec_shell("git merge-base --is-ancestor {} {}".format(ancestor, commit))
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    def maintain_repositories(self, jobs, budget):
+        """
+        Run maintenance on the repositories that need it
+        :param jobs: int number of repositories to maintain at the same time
+        :param budget: int seconds after which no new maintenance gets started
+        :return: list of result dicts
+        """
+        repositories = self.find_repositories()
+        out(0, yellow("Checking {} repositories for maintenance (budget {}s, {} at a time):".format(
+            len(repositories), budget, jobs)))
+
+        def show(result):
+            line = bold(result['repo']) + ": "
+            if result['status'] == MAINTENANCE_DONE:
+                out(1, line + green("maintained in {:.1f}s ({}); loose objects {} -> {}, packs {} -> {}".format(
+                    result['duration'], result['reason'], result['loose_objects'][0], result['loose_objects'][1],
+                    result['packs'][0], result['packs'][1])))
+            elif result['status'] == MAINTENANCE_FAILED:
+                out(1, line + red("maintenance failed: " + result['error']))
+            else:
+                out(1, line + yellow("skipped: " + result['error']))
+
+        scheduler = MaintenanceScheduler(self.git_user, jobs=max(1, jobs), budget=budget, force=bool(self.force))
+        results = scheduler.run(repositories, show)
+
+        maintained = len([result for result in results if result['status'] == MAINTENANCE_DONE])
+        out(0, green("Maintained {} of {} repositories.".format(maintained, len(repositories))))
+
+        return results
+
     def update_directory(self, dir_path, dir_name):
         """First, make sure the specified object is actually a directory, then
         determine whether the directory is a git repo on its own or a directory
@@ -159,11 +705,14 @@ class GitPullLocal(object):
         if self.is_valid_directory(git_subfolder):  # check for path/to/repository/.git
             return True
 
+        if os.path.isfile(git_subfolder):  # a worktree, see update_worktrees
+            return True
+
         return False
 
     def update_repository(self, repo_path, repo_name):
         """
-        Update a single git repository by pulling from the remote.
+        Update a single git repository, and keep track of what happened to it.
         :param repo_path:
         :param repo_name:
         :return: bool
@@ -172,6 +721,309 @@ class GitPullLocal(object):
 
         # cd into our folder so git commands target the correct repo
         os.chdir(repo_path)
+
+        started_at = time.time()
+        sha_before = self.get_head()
+        self.throttled = False
+        target = None
+        if self.converge is not None:
+            target = self.converge_target(repo_path, repo_name)
+            if target is not None and not is_commit_id(target):
+                # a branch or tag (eg. from --manifest): compare HEAD with the commit it points to on origin
+                target = self.resolve_ref(target) or target
+            if target is None or target == sha_before:
+                # converged already: that single rev-parse is all it takes
+                return self.record_converged(repo_path, repo_name, started_at, sha_before, target)
+
+        result = {
+            'repo': repo_name,
+            'path': repo_path,
+            'started_at': started_at,
+            'sha_before': sha_before,
+            'status': STATUS_UNCHANGED,
+            'origin_url': self.origin_url(),
+        }
+        # measure how much the fetches added to the object store, but only when someone's going to look at it
+        object_size = self.object_store_size() if self.metrics is not None else None
+
+        try:
+            if self.apply:
+                pulled = self.apply_repository(repo_path, repo_name, result)
+            elif self.converge is not None:
+                pulled = self.converge_repository(repo_name, target, result)
+            else:
+                pulled = self.pull_repository(repo_path, repo_name, result)
+            # also after a branch switch that found nothing new to pull: the working tree changed all the same
+            if result['status'] != STATUS_FAILED:
+                self.run_hooks(repo_name, result)
+            return pulled
+        except Exception as e:
+            result['status'] = STATUS_FAILED
+            result['error'] = str(e)
+            raise
+        finally:
+            result['sha_after'] = self.get_head()
+            result['branch_after'] = self.get_branch()
+            result['duration'] = time.time() - result['started_at']
+            if object_size is not None:
+                result['bytes_fetched'] = max(0, self.object_store_size() - object_size)
+            if result['status'] != STATUS_FAILED and result['sha_after'] != result['sha_before']:
+                result['status'] = STATUS_UPDATED
+            if self.throttled:
+                result['throttled'] = True
+            self.results.append(result)
+            if self.report:
+                report.emit('repo', **result)
+
+    def converge_target(self, repo_path, repo_name):
+        """
+        :return: string commit id or ref the manifest wants a repository on | None if it isn't in the manifest
+        """
+        if repo_name in self.converge:
+            return self.converge[repo_name]
+
+        return self.converge.get(os.path.basename(repo_path))
+
+    def resolve_ref(self, ref):
+        """
+        Look up the commit a ref points to on origin, without fetching anything
+        :param ref: string branch or tag
+        :return: string commit id | None if origin doesn't have it or can't be reached
+        """
+        try:
+            return pick_ref(self.exec_remote("git ls-remote origin " + ref), ref)
+        except subprocess.CalledProcessError:
+            return None
+
+    def record_converged(self, repo_path, repo_name, started_at, sha, target):
+        """
+        Record a repository that --converge leaves alone, without running anything else in it
+        :param sha: string commit the repository is on
+        :param target: string commit the manifest wants it on | None if it isn't in the manifest
+        :return: bool
+        """
+        if target is None:
+            out(2, blue("Not in the manifest, leaving it as it is."))
+        else:
+            out(2, blue("Already on {}.".format(sha[:8])))
+
+        result = {
+            'repo': repo_name,
+            'path': repo_path,
+            'started_at': started_at,
+            'sha_before': sha,
+            'sha_after': sha,
+            'target': target,
+            'status': STATUS_UNCHANGED,
+            'duration': time.time() - started_at,
+        }
+        if self.throttled:
+            result['throttled'] = True
+        self.results.append(result)
+        if self.report:
+            report.emit('repo', **result)
+
+        return True
+
+    def converge_repository(self, repo_name, target, result):
+        """
+        Move a single repository to the commit the manifest wants it on, fetching only that commit if it's missing.
+        The current branch (or -b) gets reset to the commit, so a manifest can also roll a repository back.
+        :param repo_name:
+        :param target: string commit id or ref
+        :param result: dict of results for the run history, updated in place
+        :return: bool
+        """
+        current_branch = self.get_branch()
+        result['branch_before'] = current_branch
+        result['target'] = target
+
+        commit = target if is_commit_id(target) and self.has_commit(target) else None
+        if commit is None:
+            remote = remote_host(result['origin_url'] or '')
+            if not self.health.allow(remote):
+                out(2, red("Skipping: ") + "remote {} {}".format(remote, self.health.skipped[remote]))
+                result['status'] = STATUS_SKIPPED
+                result['error'] = 'remote {} is failing'.format(remote)
+                return False
+
+            self.step(repo_name, 'fetch')
+            fetch_start = time.time()
+            try:
+                commit = self.fetch_commit(self.remote_git(), target)
+            except subprocess.CalledProcessError as e:
+                out(2, red("Error: ") + "cannot fetch {}:\n".format(target) + e.output.decode('UTF-8'))
+                self.record_fetch_failure(remote, e)
+                result['status'] = STATUS_FAILED
+                result['error'] = 'cannot fetch {}'.format(target)
+                return False
+            finally:
+                result['fetch_duration'] = time.time() - fetch_start
+            self.health.record_success(remote)
+
+            if commit is None:
+                out(2, red("Error: ") + "{} does not exist on origin".format(target))
+                result['status'] = STATUS_FAILED
+                result['error'] = '{} does not exist on origin'.format(target)
+                return False
+
+        if commit == result['sha_before']:
+            out(2, blue("Already on {}.".format(commit[:8])))
+            return True
+
+        if not self.force and self.has_local_changes(self.use_fast_status(result['path'], repo_name)):
+            out(2, red("Error: ") + "there are uncommitted changes, use -f to discard them")
+            result['status'] = STATUS_FAILED
+            result['error'] = 'there are uncommitted changes'
+            return False
+
+        branch = self.branch or current_branch
+        self.step(repo_name, 'checkout')
+        try:
+            if branch and branch != 'HEAD':
+                self.exec_shell("git checkout {}-B {} {}".format("-f " if self.force else "", branch, commit))
+            else:
+                self.exec_shell("git checkout {}--detach {}".format("-f " if self.force else "", commit))
+        except subprocess.CalledProcessError as e:
+            out(2, red("Could not check out {}: \n".format(commit) + e.output.decode('UTF-8')))
+            result['status'] = STATUS_FAILED
+            result['error'] = 'cannot check out {}'.format(commit)
+            return False
+
+        if branch != current_branch:
+            self.branch_changes.append([repo_name, current_branch, branch])
+        out(2, green("Moved from {} to {}".format((result['sha_before'] or 'nothing')[:8], commit[:8])) +
+            (" on " + branch if branch and branch != 'HEAD' else ""))
+
+        return True
+
+    def fetch_commit(self, git, target):
+        """
+        Fetch a single commit or ref from the remote, instead of everything
+        :param git: string git command to fetch with, see remote_git
+        :param target: string commit id or ref
+        :return: string commit id | None if the remote doesn't have it
+        """
+        commands = [git + " fetch --no-tags origin " + target]
+        if git != "git":
+            # the relay doesn't have this repository, so go to the origin remote directly
+            commands.append("git fetch --no-tags origin " + target)
+        if is_commit_id(target):
+            # not every server lets us fetch a single commit by its id
+            commands.append("git fetch origin")
+
+        for i, command in enumerate(commands):
+            try:
+                self.exec_remote(command)
+                break
+            except subprocess.CalledProcessError:
+                if i == len(commands) - 1:
+                    raise
+
+        if is_commit_id(target):
+            return target if self.has_commit(target) else None
+        try:
+            return self.exec_shell("git rev-parse --verify --quiet FETCH_HEAD^{commit}").strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    def has_commit(self, commit):
+        try:
+            self.exec_shell("git cat-file -e {}^{{commit}}".format(commit))
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    def run_hooks(self, repo_name, result):
+        """
+        Run the post-update hooks of a repository whose paths were changed by the pull
+        :param repo_name: string
+        :param result: dict of results for the run history, updated in place
+        :return: void
+        """
+        try:
+            hooks = self.config.get_post_update_hooks(repo_name) or \
+                self.config.get_post_update_hooks(mirror_name(result['origin_url'], repo_name))
+        except AttributeError as e:
+            # a configuration mistake only fails this repository, not the rest of the run
+            out(2, red("Error: ") + str(e))
+            result['status'] = STATUS_FAILED
+            result['error'] = str(e)
+            return
+        if not hooks:
+            return
+
+        sha_after = self.get_head()
+        if result.get('served_worktree'):
+            # the hooks never ran in a worktree that just started being served, so run all of them
+            changed_files = None
+        elif not result['sha_before'] or sha_after == result['sha_before']:
+            return
+        else:
+            changed_files = self.exec_shell(
+                "git diff --name-only {} {}".format(result['sha_before'], sha_after)).splitlines()
+
+        def show(hook_result):
+            line = "hook " + bold(hook_result['name']) + ": "
+            if hook_result['status'] == HOOK_DONE:
+                out(2, line + green("done in {:.1f}s".format(hook_result['duration'])))
+            elif hook_result['status'] == HOOK_FAILED:
+                out(2, line + red("failed after {:.1f}s:\n{}".format(hook_result['duration'], hook_result['error'])))
+            else:
+                out(2, line + "skipped, " + hook_result['error'])
+
+        self.step(repo_name, 'hooks')
+        result['hooks'] = HookRunner(self.exec_shell).run(hooks, changed_files, show)
+
+        failed = [hook_result['name'] for hook_result in result['hooks'] if hook_result['status'] == HOOK_FAILED]
+        if failed:
+            result['status'] = STATUS_FAILED
+            result['error'] = 'post-update hook {} failed'.format(', '.join(failed))
+
+    def object_store_size(self):
+        """
+        Get the size of the object store of the current repository
+        :return: int bytes
+        """
+        size = 0
+        try:
+            for line in self.exec_shell("git count-objects -v").splitlines():
+                key, _, value = line.partition(':')
+                if key in ('size', 'size-pack'):
+                    size += int(value) * 1024  # git reports KiB
+        except (subprocess.CalledProcessError, ValueError):
+            pass
+
+        return size
+
+    def get_head(self):
+        """
+        Get the commit the current repository is on
+        :return: string sha | None
+        """
+        try:
+            return self.exec_shell("git rev-parse HEAD").strip()
+        except subprocess.CalledProcessError:
+            return None  # no commits yet
+
+    def get_branch(self):
+        """
+        Get the branch the current repository is on
+        :return: string | None
+        """
+        try:
+            return self.exec_shell("git rev-parse --abbrev-ref HEAD").strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    def pull_repository(self, repo_path, repo_name, result):
+        """
+        Update a single git repository by pulling from the remote.
+        :param repo_path:
+        :param repo_name:
+        :param result: dict of results for the run history, updated in place
+        :return: bool
+        """
         try:
             # what branch are we on?
             curr_branch = self.exec_shell("git rev-parse --abbrev-ref HEAD")
@@ -183,12 +1035,42 @@ class GitPullLocal(object):
         if curr_branch:
             curr_branch = curr_branch.strip(' \t\b\n\r')
 
+        result['branch_before'] = curr_branch or None
+
+        # git command to use for anything that talks to the remote
+        git = self.remote_git()
+
+        # don't bother with remotes that keep failing, until it's time to probe them again
+        remote = remote_host(self.origin_url() or '')
+        if not self.health.allow(remote):
+            out(2, red("Skipping: ") + "remote {} {}".format(remote, self.health.skipped[remote]))
+            result['status'] = STATUS_SKIPPED
+            result['error'] = 'remote {} is failing'.format(remote)
+            return False
+
+        self.step(repo_name, 'fetch')
+        fetch_start = time.time()
         try:
             # check if there is anything to pull, but don't do it yet
-            dry_fetch = self.exec_shell("git fetch --dry-run")
+            try:
+                dry_fetch = self.exec_remote(git + " fetch --dry-run")
+            except subprocess.CalledProcessError:
+                if git == "git":
+                    raise
+                # the relay doesn't have this repository, so go to the origin remote directly
+                out(2, yellow("warning: ") + "could not fetch from relay, fetching from origin instead")
+                git = "git"
+                dry_fetch = self.exec_remote(git + " fetch --dry-run")
         except subprocess.CalledProcessError as e:
             out(2, red("Error: ") + "cannot fetch; do you have a remote repository configured correctly?\n" + e.output.decode('UTF-8'))
+            self.record_fetch_failure(remote, e)
+            result['status'] = STATUS_FAILED
+            result['error'] = 'cannot fetch'
             return
+        finally:
+            result['fetch_duration'] = time.time() - fetch_start
+
+        self.health.record_success(remote)
 
         # if a specific branch was passed in, then make sure that's what we're on.
         if self.branch and curr_branch:
@@ -197,36 +1079,48 @@ class GitPullLocal(object):
             # if we're not on the required branch, then check it out.
             if branch != curr_branch:
                 out(2, yellow("branch to switch from: " + curr_branch + "\nbranch to switch to: " + branch))
+                self.step(repo_name, 'checkout ' + branch)
                 try:
                     # need to fetch first
-                    git_fetch_txt = self.exec_shell("git fetch")
+                    git_fetch_txt = self.exec_remote(git + " fetch")
                     if git_fetch_txt:
                         out(2, yellow(git_fetch_txt.strip()))
                 except subprocess.CalledProcessError as e:
                     out(2, red("Could not fetch: \n" + e.output.decode('UTF-8')))
+                    result['status'] = STATUS_FAILED
+                    result['error'] = 'cannot fetch'
                     return False
 
-                # get list of remote branches
-                remote_branches = self.exec_shell("git branch -a")
-
-                # see if the desired branch exists remotely, otherwise skip this process.
-                if "remotes/origin/"+branch in remote_branches:
-                    out(2, green('Attempting to switch branch from ' + curr_branch + ' to ' + branch))
-                    if self.force:
-                        git_checkout_txt = self.exec_shell("git checkout -f " + branch)
-                        out(2, yellow(git_checkout_txt))
-                    else:
-                        try:
-                            git_checkout_txt = self.exec_shell("git checkout " + branch)
-                            out(2, yellow(git_checkout_txt))
-                        except subprocess.CalledProcessError as e:
-                            out(2, red("Could not check out branch: \n" + e.output.decode('UTF-8')))
-                            return False
-                    self.branch_changes.append([repo_name, curr_branch, branch])
-                    # set curr_branch to the branch we just changed to.
+                worktrees = self.get_worktrees(repo_path, repo_name)
+                if worktrees is not None and worktrees.exists(branch):
+                    # serve the branch's own worktree instead of checking it out in the served one
+                    if not self.switch_worktree(repo_path, repo_name, worktrees, curr_branch, branch, result):
+                        return False
                     curr_branch = branch
                 else:
-                    out(2, red("branch {} does not exist. skipping checkout.".format(branch, repo_path)))
+                    # get list of remote branches
+                    remote_branches = self.exec_shell("git branch -a")
+
+                    # see if the desired branch exists remotely, otherwise skip this process.
+                    if "remotes/origin/"+branch in remote_branches:
+                        out(2, green('Attempting to switch branch from ' + curr_branch + ' to ' + branch))
+                        if self.force:
+                            git_checkout_txt = self.exec_shell("git checkout -f " + branch)
+                            out(2, yellow(git_checkout_txt))
+                        else:
+                            try:
+                                git_checkout_txt = self.exec_shell("git checkout " + branch)
+                                out(2, yellow(git_checkout_txt))
+                            except subprocess.CalledProcessError as e:
+                                out(2, red("Could not check out branch: \n" + e.output.decode('UTF-8')))
+                                result['status'] = STATUS_FAILED
+                                result['error'] = 'cannot check out branch {}'.format(branch)
+                                return False
+                        self.branch_changes.append([repo_name, curr_branch, branch])
+                        # set curr_branch to the branch we just changed to.
+                        curr_branch = branch
+                    else:
+                        out(2, red("branch {} does not exist. skipping checkout.".format(branch, repo_path)))
 
         try:
             last_commit = self.exec_shell("git log -n 1 --pretty=\"%ar\"")
@@ -234,18 +1128,21 @@ class GitPullLocal(object):
         except subprocess.CalledProcessError:
             last_commit = "never"  # couldn't get a log, so no commits
 
+        self.step(repo_name, 'status')
+        fast_status = self.use_fast_status(repo_path, repo_name)
+        if fast_status:
+            self.configure_fast_status()
+
         if not dry_fetch:
-            # try git status, just to make sure a fetch didn't happen without a pull:
-            status = self.exec_shell("git status -uno")
-            if "Your branch is behind" not in status:
+            # make sure a fetch didn't happen without a pull:
+            if not self.is_behind_upstream():
                 out(2, blue("No new changes.") + " Last commit was {}.".format(last_commit))
                 return False
 
         # stuffs have happened!
         out(2, "There are new changes upstream...")
-        status = self.exec_shell("git status")
 
-        if not status.endswith("nothing to commit (working directory clean)"):
+        if self.has_local_changes(fast_status):
             out(2, red("Warning: ") + "you have uncommitted changes in this repository!")
             if self.force:
                 out(2, red("Since force is enabled, I will now reset your branch:"))
@@ -253,8 +1150,10 @@ class GitPullLocal(object):
                 out(2, green(reset_result))
 
         out(2, green("Pulling changes..."))
+        self.step(repo_name, 'pull')
+        pull_start = time.time()
         try:
-            result = self.exec_shell("git pull")
+            pull_result = self.exec_remote(git + " pull")
         except subprocess.CalledProcessError as e:
             try:
                 # if pull fails to pull because remote branch is not configured correctly:
@@ -263,25 +1162,194 @@ class GitPullLocal(object):
                     set_remote_branch = self.exec_shell(
                         "git branch --set-upstream-to {} origin/{}".format(curr_branch, curr_branch))
                     out(2, green(set_remote_branch))
-                    result = self.exec_shell("git pull")
+                    pull_result = self.exec_remote(git + " pull")
                 elif self.force and 'Your local changes to the following files would be overwritten' in e.output:
                     reset_result = self.exec_shell("git reset --hard HEAD")
                     out(2, green(reset_result))
-                    result = self.exec_shell("git pull")
+                    pull_result = self.exec_remote(git + " pull")
                 else:
                     out(2, red(e.output))
+                    result['status'] = STATUS_FAILED
+                    result['error'] = 'cannot pull'
                     return False
             except subprocess.CalledProcessError as e:
                 out(2, red(e.output))
+                result['status'] = STATUS_FAILED
+                result['error'] = 'cannot pull'
                 return False
+        finally:
+            result['pull_duration'] = time.time() - pull_start
 
-        if result:
-            if 'Already up-to-date' in result:
+        if pull_result and not self.changelog:
+            out(2, green("Pulled changes."))
+        elif pull_result:
+            if 'Already up-to-date' in pull_result:
                 out(2, "No new changes in your branch. However, upstream the following changes happened:")
             else:
                 out(2, "The following changes were made {}:".format(last_commit))
 
-            out(2, blue(result))
+            out(2, blue(pull_result))
+
+        return True
+
+    def use_fast_status(self, repo_path, repo_name):
+        """
+        Check whether the fast status checks are enabled for a repository, on the command line or in settings.yaml
+        :param repo_path: string
+        :param repo_name: string
+        :return: bool
+        """
+        if self.fast_status:
+            return True
+
+        fast_status_repos = self.config.get_fast_status()
+        # with -a, repositories are named after their directory too, eg. www/repo2
+        return fast_status_repos is True or repo_name in fast_status_repos or \
+            os.path.basename(repo_path) in fast_status_repos
+
+    def configure_fast_status(self):
+        """
+        Enable git's untracked cache, index preloading and (if git supports it) its builtin file system monitor
+        in the current repository, so git status doesn't need to look at every file in the working tree.
+        :return: void
+        """
+        settings = [('core.untrackedCache', 'true'), ('core.preloadIndex', 'true')]
+        if self.supports_fsmonitor():
+            settings.append(('core.fsmonitor', 'true'))
+
+        for key, value in settings:
+            try:
+                current = self.exec_shell("git config --get " + key).strip()
+            except subprocess.CalledProcessError:
+                current = None  # not set yet
+            if current != value:
+                self.exec_shell("git config {} {}".format(key, value))
+
+    def get_git_version(self):
+        """
+        Get the version of git, eg. (2, 39, 5)
+        :return: tuple of ints
+        """
+        if self.git_version is None:
+            self.git_version = git_version(self.exec_shell)
+
+        return self.git_version
+
+    def supports_fsmonitor(self):
+        """
+        Check whether git has a builtin file system monitor on this platform (git 2.36+, not on every OS)
+        :return: bool
+        """
+        if self.fsmonitor is None:
+            if self.get_git_version() < (2, 36):
+                # older versions would try to run 'true' as a file system monitor hook
+                self.fsmonitor = False
+            else:
+                try:
+                    output = self.exec_shell("git fsmonitor--daemon status")
+                except subprocess.CalledProcessError as e:
+                    output = e.output.decode('UTF-8')
+                self.fsmonitor = 'not supported' not in output
+
+        return self.fsmonitor
+
+    def is_behind_upstream(self):
+        """
+        Check whether the upstream branch has commits that the current branch doesn't
+        :return: bool
+        """
+        try:
+            return int(self.exec_shell("git rev-list --count HEAD..@{u}").strip()) > 0
+        except (subprocess.CalledProcessError, ValueError):
+            return False  # no upstream branch configured
+
+    def has_local_changes(self, fast_status=False):
+        """
+        Check for uncommitted changes in the current repository, using git's machine readable status output
+        :param fast_status: bool if true, only look at tracked files
+        :return: bool
+        """
+        command = "git status --porcelain"
+        if fast_status:
+            command += " --untracked-files=no"
+
+        return self.exec_shell(command).strip() != ''
+
+    def step(self, repo_name, step):
+        """
+        Let gpull.py know what we are doing, so it can show it on its dashboard
+        :param repo_name: string
+        :param step: string eg. 'fetch'
+        :return: void
+        """
+        if self.report:
+            report.emit('step', repo=repo_name, step=step)
+
+    def origin_url(self):
+        """
+        Get the url of the origin remote of the current repository
+        :return: string | None
+        """
+        try:
+            return self.exec_shell("git config --get remote.origin.url").strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    def exec_remote(self, command):
+        """
+        Execute a git command that talks to the remote, retrying transient network errors with backoff.
+        :param command: string
+        :return: string output
+        """
+        operation = next((arg for arg in command.split() if arg in NETWORK_COMMANDS), 'git')
+
+        def on_retry(attempt, e, delay):
+            self.retries[operation] = self.retries.get(operation, 0) + 1
+            error = e.output.decode('UTF-8') if isinstance(e, subprocess.CalledProcessError) else str(e)
+            out(2, yellow("warning: ") + "{} failed, retrying in {:.1f}s:\n{}".format(command, delay, error.strip()))
+
+        # every attempt waits for the remote to admit it, so retries don't pile onto a remote that is throttling us
+        remote = self.origin_url()
+        try:
+            return retry(lambda: admission().run(remote, lambda: self.exec_shell(command)), FETCH_ATTEMPTS,
+                         on_retry=on_retry)
+        except subprocess.CalledProcessError as e:
+            # reported with the repository, so gpull.py can slow down the servers it updates at the same time
+            if is_throttled(e):
+                self.throttled = True
+            raise
+
+    def record_fetch_failure(self, remote, e):
+        """
+        Count a failed fetch against the health of the remote host, but only if it looks like the host's fault:
+        errors of a single repository (not found, access denied) mean the host answered just fine
+        :param remote: string host
+        :param e: subprocess.CalledProcessError
+        :return: void
+        """
+        if is_transient(e):
+            self.health.record_failure(remote, e.output.decode('UTF-8'))
+        else:
+            self.health.record_success(remote)
+
+    def remote_git(self):
+        """
+        Get the git command to use for fetches and pulls in the current repository: when a relay is set,
+        fetch from the relay's mirror of this repository instead of from the origin remote.
+        :return: string
+        """
+        if self.relay is None:
+            return "git"
+
+        origin_url = self.origin_url()
+        if origin_url is None:
+            return "git"  # no origin remote, so nothing to relay
+
+        if self.relay_repos is not None and mirror_name(origin_url) not in self.relay_repos:
+            return "git"  # the controller couldn't update its mirror of this repository
+
+        # rewrite the origin url to the relay url; this leaves the remote's configuration itself untouched
+        return "git -c url.{}/{}.git.insteadOf={}".format(self.relay.rstrip('/'), mirror_name(origin_url), origin_url)
 
     def exec_shell(self, command):
         """Execute a shell command and get the output."""
@@ -338,6 +1406,22 @@ class GitPullLocal(object):
                 out(0, red("Error sending email:\nMessage: "+str(e)+"\n")+bold("Email Content:\n")+msg.as_string())
 
 
+def git_version(exec_shell):
+    """
+    Get the version of git
+    :param exec_shell: function to run shell commands with
+    :return: tuple of ints, eg. (2, 39, 5)
+    """
+    version = exec_shell("git --version").strip().split()[-1]
+    numbers = []
+    for part in version.split('.'):
+        if not part.isdigit():
+            break
+        numbers.append(int(part))
+
+    return tuple(numbers)
+
+
 if __name__ == "__main__":
     try:
         GitPull = GitPullLocal()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from utils.checkpoint import Checkpoint
+
+__author__ = 'Kevin Dubois'
+
+PARAMS = {'servers': ['test-all'], 'manifest': 'production'}
+CONVERGE = {'gpull': '1' * 40, 'repo2': '2' * 40}
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.dir, 'checkpoints.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_resume_skips_completed_items(self):
+        checkpoint = Checkpoint('gpull', PARAMS, db_path=self.db_path)
+        checkpoint.save('web1', True, {'status': 'finished'})
+        checkpoint.save('web2', False, {'status': 'failed'})
+        checkpoint.finish('failed')
+
+        resumed = Checkpoint('gpull', PARAMS, resume=True, db_path=self.db_path)
+        self.assertEqual(resumed.resumed, 1)
+        self.assertEqual(resumed.completed('web1'), {'status': 'finished'})
+        self.assertIsNone(resumed.completed('web2'))
+
+    def test_resume_recalls_what_the_run_remembered(self):
+        Checkpoint('gpull', PARAMS, db_path=self.db_path).remember('converge', CONVERGE)
+
+        resumed = Checkpoint('gpull', PARAMS, resume=True, db_path=self.db_path)
+        self.assertEqual(resumed.recall('converge'), CONVERGE)
+
+    def test_new_run_forgets_what_the_last_one_remembered(self):
+        Checkpoint('gpull', PARAMS, db_path=self.db_path).remember('converge', CONVERGE)
+
+        self.assertIsNone(Checkpoint('gpull', PARAMS, db_path=self.db_path).recall('converge'))
+
+    def test_other_parameters_dont_share_values(self):
+        Checkpoint('gpull', PARAMS, db_path=self.db_path).remember('converge', CONVERGE)
+
+        other = dict(PARAMS, manifest='staging')
+        self.assertIsNone(Checkpoint('gpull', other, resume=True, db_path=self.db_path).recall('converge'))
+
+    def test_finished_run_forgets_everything(self):
+        checkpoint = Checkpoint('gpull', PARAMS, db_path=self.db_path)
+        checkpoint.remember('converge', CONVERGE)
+        checkpoint.save('web1', True, {'status': 'finished'})
+        checkpoint.finish('finished')
+
+        resumed = Checkpoint('gpull', PARAMS, resume=True, db_path=self.db_path)
+        self.assertEqual(resumed.resumed, 0)
+        self.assertIsNone(resumed.recall('converge'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import shlex
+import subprocess
+import unittest
+
+from utils import hooks
+
+__author__ = 'Kevin Dubois'
+
+
+def hook(name, after=None, paths=None):
+    return {'name': name, 'command': name, 'after': after or [], 'paths': paths}
+
+
+def names(levels):
+    return [sorted(h['name'] for h in level) for level in levels]
+
+
+class DependencyLevelsTest(unittest.TestCase):
+
+    def test_independent_hooks_share_a_level(self):
+        self.assertEqual(names(hooks.dependency_levels([hook('a'), hook('b')])), [['a', 'b']])
+
+    def test_hooks_come_after_their_dependencies(self):
+        levels = hooks.dependency_levels([hook('cache', ['deps', 'assets']), hook('assets', ['deps']), hook('deps')])
+        self.assertEqual(names(levels), [['deps'], ['assets'], ['cache']])
+
+    def test_unknown_dependency(self):
+        self.assertRaises(ValueError, hooks.dependency_levels, [hook('a', ['nope'])])
+
+    def test_cycle(self):
+        self.assertRaises(ValueError, hooks.dependency_levels, [hook('a', ['b']), hook('b', ['a'])])
+
+
+class MatchesTest(unittest.TestCase):
+
+    def test_directory_and_glob(self):
+        self.assertTrue(hooks.matches('assets/js/app.js', ['assets/']))
+        self.assertTrue(hooks.matches('composer.lock', ['composer.*']))
+        self.assertFalse(hooks.matches('src/assets.php', ['assets/']))
+
+
+class HookRunnerTest(unittest.TestCase):
+
+    def run_hooks(self, to_run, changed_files, failing=()):
+        ran = []
+
+        def exec_shell(command):
+            name = command.split()[-1]
+            ran.append(name)
+            if name in failing:
+                raise subprocess.CalledProcessError(1, command, b'boom')
+            return ''
+
+        results = hooks.HookRunner(exec_shell, jobs=1).run(to_run, changed_files)
+        return dict((result['name'], result['status']) for result in results), ran
+
+    def test_skips_hooks_without_matching_changes(self):
+        statuses, ran = self.run_hooks([hook('deps', paths=['composer.lock']), hook('cache')], ['README.md'])
+        self.assertEqual(statuses, {'deps': hooks.STATUS_SKIPPED, 'cache': hooks.STATUS_DONE})
+
+    def test_runs_every_hook_without_changed_files(self):
+        statuses, ran = self.run_hooks([hook('deps', paths=['composer.lock'])], None)
+        self.assertEqual(statuses, {'deps': hooks.STATUS_DONE})
+
+    def test_skips_hooks_after_a_failed_one(self):
+        statuses, ran = self.run_hooks([hook('deps'), hook('cache', ['deps'])], [], failing=['deps'])
+        self.assertEqual(statuses, {'deps': hooks.STATUS_FAILED, 'cache': hooks.STATUS_SKIPPED})
+        self.assertEqual(ran, ['deps'])
+
+    def test_hooks_run_with_a_timeout(self):
+        commands = []
+        runner = hooks.HookRunner(lambda command: commands.append(command) or '', jobs=1, timeout=60)
+        runner.run([hook('deps'), dict(hook('assets'), timeout=900)], None)
+        self.assertEqual(commands, ["timeout -k {} 60 sh -c deps".format(hooks.KILL_AFTER),
+                                    "timeout -k {} 900 sh -c assets".format(hooks.KILL_AFTER)])
+
+    def test_hung_hook_gets_killed(self):
+        def exec_shell(command):
+            return subprocess.check_output(shlex.split(command), stderr=subprocess.STDOUT)
+
+        result = hooks.HookRunner(exec_shell, timeout=1).run([{'name': 'hang', 'command': 'sleep 30'}], None)[0]
+        self.assertEqual(result['status'], hooks.STATUS_FAILED)
+        self.assertEqual(result['error'], 'timed out after 1s')
+        self.assertLess(result['duration'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+from utils import manifest
+
+__author__ = 'Kevin Dubois'
+
+BRANCH = '1' * 40
+TAG = '2' * 40
+PEELED = '3' * 40
+OTHER = '4' * 40
+
+
+class PickRefTest(unittest.TestCase):
+
+    def test_branch_before_tag(self):
+        output = "{}\trefs/tags/release\n{}\trefs/heads/release\n".format(TAG, BRANCH)
+        self.assertEqual(manifest.pick_ref(output, 'release'), BRANCH)
+
+    def test_annotated_tag_is_peeled(self):
+        output = "{}\trefs/tags/v1.4.2\n{}\trefs/tags/v1.4.2^{{}}\n".format(TAG, PEELED)
+        self.assertEqual(manifest.pick_ref(output, 'v1.4.2'), PEELED)
+
+    def test_lightweight_tag(self):
+        self.assertEqual(manifest.pick_ref("{}\trefs/tags/v1.4.2\n".format(TAG), 'v1.4.2'), TAG)
+
+    def test_full_ref_name(self):
+        output = "{}\trefs/heads/master\n".format(BRANCH)
+        self.assertEqual(manifest.pick_ref(output, 'refs/heads/master'), BRANCH)
+
+    def test_ignores_refs_that_only_end_the_same(self):
+        output = "{}\trefs/remotes/origin/master\n{}\trefs/heads/feature/master\n".format(OTHER, OTHER)
+        self.assertIsNone(manifest.pick_ref(output, 'master'))
+
+    def test_ignores_errors(self):
+        self.assertIsNone(manifest.pick_ref("fatal: repository not found\n", 'master'))
+        self.assertIsNone(manifest.pick_ref("", 'master'))
+
+
+class ParseTargetsTest(unittest.TestCase):
+
+    def test_parse_and_format(self):
+        targets = manifest.parse_targets(['gpull=' + BRANCH, 'repo2=v1.4.2'])
+        self.assertEqual(targets, {'gpull': BRANCH, 'repo2': 'v1.4.2'})
+        self.assertEqual(manifest.parse_targets(manifest.format_targets(targets).split()), targets)
+
+    def test_ref_may_contain_equals_sign(self):
+        self.assertEqual(manifest.parse_targets(['repo=a=b']), {'repo': 'a=b'})
+
+    def test_invalid(self):
+        for value in ('gpull', 'gpull=', '=master'):
+            self.assertRaises(ValueError, manifest.parse_targets, [value])
+
+
+class ResolveTest(unittest.TestCase):
+
+    def test_resolves_refs_and_keeps_commit_ids(self):
+        commands = []
+
+        def ls_remote(command):
+            commands.append(command)
+            return "{}\trefs/heads/master\n".format(BRANCH) if command.endswith(' master') else ''
+
+        resolved, errors = manifest.resolve({'a': OTHER, 'b': 'master', 'c': 'missing'},
+                                            lambda repo: 'git@server:' + repo + '.git', ls_remote)
+        self.assertEqual(resolved, {'a': OTHER, 'b': BRANCH})
+        self.assertEqual(list(errors), ['c'])
+        self.assertEqual(len(commands), 2)  # commit ids don't need a lookup
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+from utils import shards
+
+__author__ = 'Kevin Dubois'
+
+
+class HashRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hosts = ['web{}.prod'.format(i) for i in range(200)]
+
+    def test_same_node_every_time(self):
+        ring = shards.HashRing(range(1, 5))
+        again = shards.HashRing(range(1, 5))
+        for host in self.hosts:
+            self.assertEqual(ring.node(host), again.node(host))
+
+    def test_spreads_keys_over_every_node(self):
+        ring = shards.HashRing(range(1, 5))
+        counts = {}
+        for host in self.hosts:
+            counts[ring.node(host)] = counts.get(ring.node(host), 0) + 1
+        self.assertEqual(sorted(counts), [1, 2, 3, 4])
+        for count in counts.values():
+            self.assertGreater(count, len(self.hosts) / 4 / 2)
+
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        before = shards.HashRing(range(1, 5))
+        after = shards.HashRing(range(1, 6))
+        for host in self.hosts:
+            if before.node(host) != after.node(host):
+                self.assertEqual(after.node(host), 5)
+
+
+class PartitionTest(unittest.TestCase):
+
+    def test_every_target_in_exactly_one_shard(self):
+        targets = [('alias', 'web{}.prod'.format(i), 'www-data') for i in range(50)]
+        parts = [shards.partition(targets, index, 3) for index in range(1, 4)]
+        self.assertEqual(sorted(target for part in parts for target in part), sorted(targets))
+
+    def test_parse_shard(self):
+        self.assertEqual(shards.parse_shard('2/4'), (2, 4))
+        self.assertRaises(ValueError, shards.parse_shard, '0/4')
+        self.assertRaises(ValueError, shards.parse_shard, '5/4')
+        self.assertRaises(ValueError, shards.parse_shard, 'x')
+
+
+class StripOptionsTest(unittest.TestCase):
+
+    def test_strips_options_and_their_values(self):
+        args = ['-s', 'prod', '--shards', '4', '--results-file=out.json', '-j', '8', '--metrics', 'm.prom']
+        self.assertEqual(shards.strip_options(args, ['--shards', '--results-file', '--metrics']),
+                         ['-s', 'prod', '-j', '8'])
+
+    def test_keeps_options_that_only_share_a_prefix(self):
+        self.assertEqual(shards.strip_options(['--shard', '1/2', '--shards', '2'], ['--shards']),
+                         ['--shard', '1/2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+import threading
+import time
+
+from utils.config import Config
+from utils.host_health import remote_host
+
+__author__ = 'Kevin Dubois'
+
+# limits for remotes that aren't configured under Throttle in settings.yaml
+DEFAULT_LIMITS = {'concurrency': 16, 'rate': 10, 'burst': 20}
+
+# the adaptive limits never go below these
+MIN_CONCURRENCY = 1
+MIN_RATE = 0.2
+
+# git subcommands that talk to a remote
+NETWORK_COMMANDS = ('fetch', 'pull', 'clone', 'push', 'ls-remote')
+
+# error messages that mean the remote wants us to slow down
+THROTTLE_ERRORS = [
+    'too many requests',
+    'rate limit',
+    'returned error: 429',
+    'returned error: 503',
+    'service unavailable',
+    'server is busy',
+    'try again later',
+    'timed out',
+]
+
+
+def is_throttled(result):
+    """
+    Check whether the output or error of a git command means the remote is throttling us or overloaded
+    :param result: Exception | string output | None
+    :return: bool
+    """
+    if isinstance(result, Exception):
+        output = getattr(result, 'output', None)
+        result = output if output is not None else str(result)
+    if not result:
+        return False
+    if isinstance(result, bytes):
+        result = result.decode('UTF-8', 'replace')
+
+    result = result.lower()
+    return any(message in result for message in THROTTLE_ERRORS)
+
+
+def is_network_command(command):
+    """
+    Check whether a git command talks to a remote, eg. 'git -c x=y fetch origin'
+    :param command: string
+    :return: bool
+    """
+    args = command.split()
+    if not args or args[0] != 'git':
+        return False
+
+    i = 1
+    while i < len(args) and args[i].startswith('-'):
+        i += 2 if args[i] in ('-c', '-C') else 1
+
+    return i < len(args) and args[i] in NETWORK_COMMANDS
+
+
+class RemoteLimit(object):
+    """
+    Concurrency cap and token bucket of a single remote. Both back off multiplicatively when the remote
+    throttles us, and grow back additively while it doesn't (AIMD).
+    """
+    def __init__(self, concurrency, rate, burst=None):
+        self.max_concurrency = max(MIN_CONCURRENCY, int(concurrency))
+        self.max_rate = max(MIN_RATE, float(rate))
+        self.burst = float(burst if burst is not None else max(1, rate))
+
+        self.concurrency = float(self.max_concurrency)
+        self.rate = self.max_rate
+        self.tokens = self.burst
+        self.refilled_at = time.time()
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def acquire(self):
+        """
+        Wait for a free slot and a token
+        :return: void
+        """
+        with self.condition:
+            while True:
+                self.refill()
+                if self.active < int(self.concurrency) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.active += 1
+                    return
+                if self.active >= int(self.concurrency):
+                    self.condition.wait()  # until a running operation finishes
+                else:
+                    self.condition.wait((1 - self.tokens) / self.rate)  # until the next token
+
+    def release(self, throttled=False):
+        """
+        Free a slot, and adapt the limits to how the operation went
+        :param throttled: bool whether the remote throttled or timed out on us
+        :return: void
+        """
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.concurrency = max(MIN_CONCURRENCY, self.concurrency / 2)
+                self.rate = max(MIN_RATE, self.rate / 2)
+                self.tokens = 0  # and pause until the next token
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+            self.condition.notify_all()
+
+
+class AdmissionController(object):
+    """
+    Admission control for network git operations (fetch, pull, clone, push, ls-remote), per remote host,
+    shared by every thread of this process.
+    """
+    def __init__(self, limits=None):
+        """
+        :param limits: dict of remote host (or 'default') => dict with concurrency, rate and burst
+        """
+        if limits is None:
+            limits = Config().get_throttle()
+
+        self.limits = limits
+        self.remotes = {}
+        self.lock = threading.Lock()
+        # number of processes the limits are split between, see share
+        self.shares = 1
+
+    def share(self, count):
+        """
+        Split the limits of every remote between this many processes that admit operations on the same remotes
+        (eg. the shards of a run), so together they stay within the configured limits
+        :param count: int
+        :return: void
+        """
+        with self.lock:
+            self.shares = max(1, int(count))
+            self.remotes = {}
+
+    def limit(self, remote):
+        """
+        :param remote: string remote url or host
+        :return: RemoteLimit
+        """
+        host = remote_host(remote) if remote else 'localhost'
+        with self.lock:
+            if host not in self.remotes:
+                settings = dict(DEFAULT_LIMITS)
+                settings.update(self.limits.get('default') or {})
+                settings.update(self.limits.get(host) or {})
+                burst = settings.get('burst')
+                if burst is not None:
+                    burst = max(1, float(burst) / self.shares)
+                self.remotes[host] = RemoteLimit(float(settings['concurrency']) / self.shares,
+                                                 float(settings['rate']) / self.shares, burst)
+            return self.remotes[host]
+
+    def run(self, remote, func, check_output=False, judge=None):
+        """
+        Call func once the remote admits it
+        :param remote: string remote url or host
+        :param func: callable without arguments that runs a single network operation
+        :param check_output: bool also look for throttling in the output func returns, for commands that don't
+        raise when they fail; otherwise only the output of a failed command counts
+        :param judge: callable that tells from what func returns whether the remote throttled it, eg. for
+        func that runs several operations and reports on each of them
+        :return: whatever func returns
+        """
+        limit = self.limit(remote)
+        limit.acquire()
+        throttled = False
+        try:
+            result = func()
+            if judge is not None:
+                throttled = judge(result)
+            else:
+                throttled = check_output and is_throttled(result)
+            return result
+        except Exception as e:
+            throttled = is_throttled(e)
+            raise
+        finally:
+            limit.release(throttled)
+
+
+shared_controller = None
+shared_lock = threading.Lock()
+
+
+def admission():
+    """
+    Get the admission controller shared by everything in this process
+    :return: AdmissionController
+    """
+    global shared_controller
+    with shared_lock:
+        if shared_controller is None:
+            shared_controller = AdmissionController()
+        return shared_controller
@@ -0,0 +1,89 @@
+import os
+import shlex
+import subprocess
+import threading
+
+from utils.mirror import MirrorCache
+
+__author__ = 'Kevin Dubois'
+
+# max number of commits to list in a single changelog
+MAX_COMMITS = 50
+
+
+class ChangelogCache(object):
+    """
+    Commit logs and diffstats of sha transitions, computed once from the controller's mirrors.
+    Transitions between two commits never change, so they are cached on disk next to the mirrors.
+    """
+    def __init__(self, mirrors=None):
+        if mirrors is None:
+            mirrors = MirrorCache()
+
+        self.mirrors = mirrors
+        self.cache_dir = os.path.join(mirrors.mirror_dir, 'changelogs')
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def get(self, repo, old, new):
+        """
+        Get the changelog of a repository going from one commit to another
+        :param repo: string mirror name
+        :param old: string sha
+        :param new: string sha
+        :return: string | None if it couldn't be computed
+        """
+        key = (repo, old, new)
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+
+        cache_file = os.path.join(self.cache_dir, repo, "{}_{}.txt".format(old, new))
+        if os.path.isfile(cache_file):
+            with open(cache_file, 'r') as f:
+                changelog = f.read()
+        else:
+            changelog = self.compute(repo, old, new)
+            if changelog is not None:
+                self.write(cache_file, changelog)
+
+        with self.lock:
+            self.cache[key] = changelog
+
+        return changelog
+
+    def compute(self, repo, old, new):
+        """
+        Compute a changelog from the mirror, fetching the mirror first (at most once per run)
+        :return: string | None
+        """
+        path = self.mirrors.update(repo)
+        if path is False:
+            return None
+
+        git = "git --git-dir={}".format(path)
+        try:
+            log = self.exec_shell("{} log --oneline --no-decorate -n {} {}..{}".format(git, MAX_COMMITS, old, new))
+            stat = self.exec_shell("{} diff --stat {} {}".format(git, old, new))
+        except subprocess.CalledProcessError:
+            return None  # one of the commits isn't in the mirror, eg. a local commit on the server
+
+        return log + stat
+
+    def write(self, cache_file, changelog):
+        try:
+            directory = os.path.dirname(cache_file)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # write to a temp file first, so a half written changelog never ends up in the cache
+            with open(cache_file + '.tmp', 'w') as f:
+                f.write(changelog)
+            os.rename(cache_file + '.tmp', cache_file)
+        except (IOError, OSError):
+            pass  # it's just a cache
+
+    def exec_shell(self, command):
+        """Execute a shell command and get the output."""
+        result = subprocess.check_output(shlex.split(command), stderr=subprocess.STDOUT)
+
+        return result.decode('UTF-8')
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+__author__ = 'Kevin Dubois'
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS checkpoints
+        (key TEXT UNIQUE NOT NULL, command TEXT, params TEXT, started_at REAL, updated_at REAL, status TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS checkpoint_items
+        (key TEXT NOT NULL, item TEXT NOT NULL, completed INTEGER NOT NULL, result TEXT, finished_at REAL,
+         UNIQUE (key, item))''',
+    '''CREATE TABLE IF NOT EXISTS checkpoint_values
+        (key TEXT NOT NULL, name TEXT NOT NULL, value TEXT, UNIQUE (key, name))''',
+]
+
+
+class Checkpoint(object):
+    """
+    Durable record of which hosts or repositories a run has completed, and with what result, so an interrupted
+    or partially failed run can be resumed with the same parameters without redoing what already succeeded.
+    Every item is committed as soon as it's done, so even a crash only loses the items that were in progress.
+    """
+    def __init__(self, command, params, resume=False, db_path=None):
+        """
+        :param command: string eg. 'gpull'
+        :param params: dict of the parameters of the run; only a run with the same parameters can be resumed
+        :param resume: bool pick up where the last run with these parameters left off, instead of starting over
+        :param db_path: string
+        """
+        this_dir = os.path.dirname(os.path.abspath(__file__))
+
+        if db_path is None:
+            db_path = os.path.join(this_dir, 'checkpoints.db')
+
+        self.key = hashlib.sha1(json.dumps([command, params], sort_keys=True).encode('UTF-8')).hexdigest()
+        # number of items the resumed run had completed
+        self.resumed = 0
+
+        self.conn = None
+        # the connection is shared by every thread updating a host
+        self.lock = threading.Lock()
+        try:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row  # return select results as a dict instead of a tuple
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+            self.conn.commit()
+        except Exception as e:
+            print("Checkpoint error: {0}".format(e))
+            self.conn = None
+            return
+
+        if resume:
+            row = self.conn.execute("SELECT COUNT(*) AS items FROM checkpoint_items WHERE key = ? AND completed = 1",
+                                    (self.key, )).fetchone()
+            self.resumed = row['items']
+        else:
+            self.clear()
+
+        self.execute('''INSERT OR REPLACE INTO checkpoints (key, command, params, started_at, updated_at, status)
+                        VALUES (?, ?, ?, COALESCE((SELECT started_at FROM checkpoints WHERE key = ?), ?), ?, ?)''',
+                     (self.key, command, json.dumps(params, sort_keys=True), self.key, time.time(), time.time(),
+                      'running'))
+
+    def completed(self, item):
+        """
+        Get the result of an item that was completed successfully
+        :param item: string eg. a host url
+        :return: dict result | None if the item still needs to be done
+        """
+        if self.conn is None:
+            return None
+
+        with self.lock:
+            row = self.conn.execute("SELECT result FROM checkpoint_items WHERE key = ? AND item = ? AND completed = 1",
+                                    (self.key, item)).fetchone()
+
+        return json.loads(row['result']) if row is not None else None
+
+    def save(self, item, completed, result=None):
+        """
+        Record an item as done
+        :param item: string
+        :param completed: bool False if it failed, so a resumed run tries it again
+        :param result: dict
+        :return: void
+        """
+        self.execute('''INSERT OR REPLACE INTO checkpoint_items (key, item, completed, result, finished_at)
+                        VALUES (?, ?, ?, ?, ?)''',
+                     (self.key, item, 1 if completed else 0, json.dumps(result), time.time()))
+
+    def remember(self, name, value):
+        """
+        Keep something the run decided on before doing any items, so a resumed run does the rest the same way
+        :param name: string eg. 'converge'
+        :param value: anything json can encode
+        :return: void
+        """
+        self.execute("INSERT OR REPLACE INTO checkpoint_values (key, name, value) VALUES (?, ?, ?)",
+                     (self.key, name, json.dumps(value)))
+
+    def recall(self, name):
+        """
+        :param name: string
+        :return: the value the run that is being resumed remembered | None
+        """
+        if self.conn is None:
+            return None
+
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM checkpoint_values WHERE key = ? AND name = ?",
+                                    (self.key, name)).fetchone()
+
+        return json.loads(row['value']) if row is not None else None
+
+    def finish(self, status):
+        """
+        Forget the checkpoint of a run that completed everything; keep it for --resume otherwise
+        :param status: string 'finished' if everything succeeded, eg. 'failed' or 'interrupted' if not
+        :return: void
+        """
+        if status == 'finished':
+            self.clear()
+        else:
+            self.execute("UPDATE checkpoints SET updated_at = ?, status = ? WHERE key = ?",
+                         (time.time(), status, self.key))
+
+    def clear(self):
+        self.execute("DELETE FROM checkpoint_items WHERE key = ?", (self.key, ))
+        self.execute("DELETE FROM checkpoint_values WHERE key = ?", (self.key, ))
+        self.execute("DELETE FROM checkpoints WHERE key = ?", (self.key, ))
+
+    def execute(self, query, params):
+        if self.conn is None:
+            return
+
+        try:
+            with self.lock, self.conn:
+                self.conn.execute(query, params)
+        except Exception as e:
+            print("Checkpoint error: {0}".format(e))
@@ -0,0 +1,243 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from utils.cli.output import out, blue, yellow, green, bold, red
+
+__author__ = 'Kevin Dubois'
+
+# max number of times per second the dashboard gets redrawn
+MAX_FPS = 4
+
+# row states, in the order they are usually gone through
+WAITING = 'waiting'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+FINISHED_STATES = (DONE, FAILED, SKIPPED)
+
+STATE_COLORS = {
+    WAITING: lambda t: t,
+    RUNNING: yellow,
+    DONE: green,
+    FAILED: red,
+    SKIPPED: red,
+}
+
+
+def terminal_size():
+    """
+    Get the size of the terminal
+    :return: tuple (columns, lines)
+    """
+    try:
+        import shutil
+        size = shutil.get_terminal_size()
+        return size.columns, size.lines
+    except (ImportError, AttributeError):
+        # python 2
+        return int(os.environ.get('COLUMNS', 80)), int(os.environ.get('LINES', 24))
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return "{}:{:02d}".format(minutes, seconds)
+
+
+class Row(object):
+    def __init__(self, label):
+        self.label = label
+        self.state = WAITING
+        self.step = ''
+        # number of items (eg. repositories) this row has finished
+        self.done = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def elapsed(self):
+        if self.started_at is None:
+            return 0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def throughput(self):
+        """
+        :return: string items per minute, or '' when there is nothing to measure yet
+        """
+        elapsed = self.elapsed()
+        if not self.done or elapsed <= 0:
+            return ''
+        return "{:.1f}/min".format(self.done * 60.0 / elapsed)
+
+
+class Dashboard(object):
+    """
+    Live overview with one row per host or repository, redrawn in place at most MAX_FPS times per second.
+    When stdout isn't a terminal (cron, pipes, ...) it falls back to plain, append-only log lines.
+    Anything that would otherwise be printed with out() while the dashboard is running should go through log(),
+    so it ends up above the live rows instead of in the middle of them.
+    """
+    def __init__(self, title, stream=None, interactive=None, fps=MAX_FPS):
+        self.title = title
+        self.stream = sys.stdout if stream is None else stream
+        if interactive is None:
+            interactive = os.name != 'nt' and hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.interactive = interactive
+        self.interval = 1.0 / fps
+
+        self.rows = OrderedDict()
+        self.lock = threading.RLock()
+        self.dirty = False
+        # number of lines the last frame took up, so it can be erased before the next one
+        self.drawn_lines = 0
+        self.started_at = None
+        self.running = False
+        self.thread = None
+
+    def add(self, key, label=None):
+        """
+        Add a row
+        :param key: string unique key of the row, eg. the host url
+        :param label: string to show, defaults to the key
+        :return: void
+        """
+        with self.lock:
+            self.rows[key] = Row(label or key)
+            self.dirty = True
+
+    def update(self, key, state=None, step=None, advance=0):
+        """
+        Update a row
+        :param key: string
+        :param state: string new state, see WAITING, RUNNING, ...
+        :param step: string what the row is currently doing, eg. 'gpull: fetch'
+        :param advance: int number of items the row just finished
+        :return: void
+        """
+        with self.lock:
+            if key not in self.rows:
+                self.add(key)
+            row = self.rows[key]
+
+            if state is not None and state != row.state:
+                if state == RUNNING and row.started_at is None:
+                    row.started_at = time.time()
+                if state in FINISHED_STATES:
+                    row.finished_at = time.time()
+                    row.step = ''
+                row.state = state
+                if not self.interactive:
+                    out(1, "{}: {}".format(bold(row.label), STATE_COLORS[state](state)) +
+                        (" ({})".format(format_duration(row.elapsed())) if state in FINISHED_STATES else ""))
+
+            if step is not None:
+                row.step = step
+            row.done += advance
+            self.dirty = True
+
+    def log(self, indent, msg):
+        """
+        Print a message at a given indentation level, above the live rows
+        :param indent: int
+        :param msg: string
+        :return: void
+        """
+        with self.lock:
+            if self.interactive and self.running:
+                self.erase()
+                out(indent, msg)
+                self.render()
+            else:
+                out(indent, msg)
+
+    def start(self):
+        """
+        Start drawing the dashboard in the background
+        :return: void
+        """
+        self.started_at = time.time()
+        self.running = True
+
+        if not self.interactive:
+            out(0, yellow(self.title))
+            return
+
+        self.thread = threading.Thread(target=self.draw_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop drawing, leaving the final state of the dashboard on screen
+        :return: void
+        """
+        if not self.running:
+            return
+
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        with self.lock:
+            if self.interactive:
+                self.erase()
+                self.render()
+            else:
+                out(0, self.summary())
+
+    def draw_loop(self):
+        while self.running:
+            with self.lock:
+                if self.dirty and self.running:
+                    self.erase()
+                    self.render()
+            time.sleep(self.interval)
+
+    def erase(self):
+        """Move the cursor back up to where the last frame started, and clear everything below it."""
+        if self.drawn_lines:
+            self.stream.write("\x1b[{}F\x1b[J".format(self.drawn_lines))
+            self.drawn_lines = 0
+
+    def render(self):
+        """Draw a single frame"""
+        columns, lines = terminal_size()
+        rows = list(self.rows.values())
+
+        # when there are more rows than fit on the screen, show the ones that are running or failed first
+        max_rows = max(1, lines - 4)
+        if len(rows) > max_rows:
+            priority = {RUNNING: 0, FAILED: 1, SKIPPED: 1, WAITING: 2, DONE: 3}
+            rows = sorted(rows, key=lambda r: priority[r.state])[:max_rows]
+
+        label_width = min(40, max([len(row.label) for row in rows] + [4]))
+        frame = ["", bold(self.title) + "  " + self.summary()]
+        for row in rows:
+            line = "{} {} {:>6} {:>10} {}".format(
+                row.label[:label_width].ljust(label_width), row.state.ljust(8), format_duration(row.elapsed()),
+                row.throughput(), row.step)
+            # cut off before coloring, so escape codes don't count towards the width
+            line = line[:columns - 1]
+            frame.append(STATE_COLORS[row.state](line) if row.state != WAITING else line)
+
+        self.stream.write("\n".join(frame) + "\n")
+        self.stream.flush()
+        self.drawn_lines = len(frame)
+        self.dirty = False
+
+    def summary(self):
+        """
+        :return: string count of rows per state, and the total elapsed time
+        """
+        counts = OrderedDict((state, 0) for state in (RUNNING, WAITING, DONE, FAILED, SKIPPED))
+        for row in self.rows.values():
+            counts[row.state] += 1
+
+        parts = ["{} {}".format(count, state) for state, count in counts.items() if count]
+        elapsed = time.time() - self.started_at if self.started_at else 0
+
+        return blue(", ".join(parts)) + " in " + format_duration(elapsed)
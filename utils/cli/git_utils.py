@@ -1,18 +1,62 @@
 import getpass
 import os
-import pipes
 import shlex
 import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from shlex import quote
+except ImportError:  # python 2
+    from pipes import quote
 
 import paramiko
 
-from output import out, blue, yellow, green, red
+import report
+from dashboard import Dashboard, RUNNING, DONE, FAILED, SKIPPED
+from output import out, blue, yellow, green, bold, red
 from utils import server_config
+from utils.admission import admission, is_network_command
+from utils.changelog import ChangelogCache
 from utils.config import Config
+from utils.host_health import HostHealth, is_transient, retry
+from utils.inventory import Inventory
+from utils import manifest
+from utils.mirror import MirrorCache, mirror_name
+from utils.relay import FetchRelay
+from utils.run_history import RunHistory, STATUS_FAILED, STATUS_SKIPPED
+from utils import shards
 from .. import user_settings
 
 __author__ = 'Kevin Dubois'
 
+# seconds to wait for a server to accept the ssh connection
+SSH_TIMEOUT = 10
+
+# attempts to make at connecting to a server before giving up on it for this run
+SSH_ATTEMPTS = 3
+
+# phases of a two-phase update, see update_two_phase
+PREFETCH = 'prefetch'
+APPLY = 'apply'
+
+# record gpull_local.py --prefetch ends with, with the number of repositories it prefetched
+PREFETCHED = 'prefetched'
+
+# status of a repository gpull_local.py --prefetch made ready to apply
+READY = 'ready'
+
+# record gpull_local.py --inventory ends with, with the number of repositories it found
+INVENTORIED = 'inventoried'
+
+
+def is_host_throttled(host_result):
+    """
+    :param host_result: dict of results of a server, see GitUtils.update_server
+    :return: bool whether the git server throttled the fetches or pulls of one of its repositories
+    """
+    return any(repo_result.get('throttled') for repo_result in host_result['repos'])
+
 
 class GitUtils(object):
     """
@@ -61,10 +105,64 @@ class GitUtils(object):
         # dict of open ssh connections, so we can recycle the ones we already have open
         self.connections = {}
 
-        # key to current ssh connection in the connections list
-        self.current_conn_key = None
+        # number of servers to update at the same time
+        self.jobs = 1
+
+        # live overview of the servers or repositories being updated, see utils/cli/dashboard.py
+        self.dashboard = None
+
+        # results of every host we updated, see update_server
+        self.results = []
+
+        # failure history of the servers, to skip the ones that keep failing
+        self.health = HostHealth()
+
+        # fetch from the controller's mirrors instead of having every server fetch from the git server
+        self.use_relay = False
+        self.relay = None
+
+        # have gpull_local.py skip untracked files when checking for local changes
+        self.fast_status = False
 
-    def remote_pull(self, paths, branch, force, servers, remote_user, pw, all_dirs=False, remote_path=None):
+        # have every server print its own changelog, instead of showing each change once for all servers
+        self.host_changelogs = False
+
+        # the controller's mirrors of the repositories, shared by the relay and the changelogs
+        self.mirrors = None
+
+        # only update the servers that have these repositories, according to the inventory
+        self.repos = None
+        # refresh the inventory of every server (and don't update anything)
+        self.crawl = False
+        # paths to update per server, when they were selected from the inventory
+        self.target_paths = {}
+
+        # Prometheus metrics of this run (utils.metrics.Metrics), or None
+        self.metrics = None
+        # results of every repository git_merge_all merged
+        self.merge_results = []
+
+        # fetch on every server first, and only update the working trees once every server is ready
+        self.two_phase = False
+        # results of the first phase of a two-phase update, per server
+        self.prefetch_results = []
+
+        # only update the servers of this shard, a tuple (index, count), see utils.shards
+        self.shard = None
+        # write the results of the run to this file, for merge_shard_results
+        self.results_file = None
+
+        # which servers (or repositories, for git_merge_all) this run already completed (utils.checkpoint.Checkpoint)
+        self.checkpoint = None
+
+        # converge every server on the commits of this environment's manifest, instead of pulling
+        self.manifest = None
+        # the commits of the manifest, per repository, see resolve_manifest
+        self.converge = None
+
+    def remote_pull(self, paths, branch, force, servers, remote_user, pw, all_dirs=False, remote_path=None,
+                    relay=False, jobs=1, fast_status=False, host_changelogs=False, repos=None, crawl=False,
+                    two_phase=False):
         """
         Do a git pull on remote servers
         :param paths: list of paths to update
@@ -75,6 +173,13 @@ class GitUtils(object):
         :param pw: string ssh password
         :param all_dirs:
         :param remote_path
+        :param relay: bool if true, fetch every repository once on this machine and let the servers fetch from here
+        :param jobs: int number of servers to update at the same time
+        :param fast_status: bool if true, use gpull_local.py's fast status checks in every repository
+        :param host_changelogs: bool if true, show the changelog of every server instead of once per change
+        :param repos: list of repository names; only update the servers that have them, and only these repositories
+        :param crawl: bool if true, only refresh the inventory of the servers
+        :param two_phase: bool if true, fetch on every server first and then update all working trees at once
         :return:
         """
 
@@ -112,6 +217,13 @@ class GitUtils(object):
             self.ssh_user = settings.get_ssh_user()
 
         self.pw = pw
+        self.use_relay = relay
+        self.jobs = max(1, jobs)
+        self.fast_status = fast_status
+        self.host_changelogs = host_changelogs
+        self.repos = repos
+        self.crawl = crawl
+        self.two_phase = two_phase
 
         self.update_servers(servers)
 
@@ -122,54 +234,465 @@ class GitUtils(object):
         :return: void
         """
 
-        if servers is None:
-            # run locally
-            self.update_server(None, 'localhost')
+        history = RunHistory()
+        history.start_run('gpull', self.branch, self.ssh_user)
+        started_at = time.time()
+        status = 'failed'
+        try:
+            if self.manifest is not None and not self.resolve_manifest():
+                return
+            if self.use_relay:
+                self.start_relay()
+            self.update_server_list(servers)
+            status = 'finished'
+        finally:
+            self.stop_relay()
+            if self.results_file is not None:
+                # the changelogs get computed once, when the results of all shards are merged
+                shards.write_results(self.results_file, self.shard, started_at, status, self.results)
+            elif not self.host_changelogs:
+                self.report_changes()
+            self.report_skipped()
+            if self.checkpoint is not None:
+                failed = status != 'finished' or any(host_result['status'] != 'finished'
+                                                     for host_result in self.results)
+                self.checkpoint.finish('failed' if failed else 'finished')
+                if failed and self.results:
+                    out(0, yellow("Run python gpull.py again with the same arguments and --resume to only retry "
+                                  "the servers that didn't finish."))
+            for host_result in self.results:
+                history.record_host(host_result['host'], host_result['alias'], host_result['status'],
+                                    host_result['started_at'], host_result['duration'], host_result['error'])
+                for repo_result in host_result['repos']:
+                    history.record_repo(host_result['host'], repo_result)
+            history.finish_run(status)
+            if self.metrics is not None:
+                self.metrics.record_run(started_at, [repo_result for host_result in self.results
+                                                     for repo_result in host_result['repos']], self.results)
+                self.metrics.write()
+
+    def resolve_manifest(self):
+        """
+        Resolve the refs of the manifest to commits once, so every server converges on the same commits.
+        A resumed run converges on the commits the run it resumes resolved, even if a branch moved since.
+        :return: bool False if some refs couldn't be resolved
+        """
+        def ls_remote(command):
+            return admission().run(self.git_server, lambda: self.exec_shell(command), check_output=True)
+
+        converge = self.checkpoint.recall('converge') if self.checkpoint is not None else None
+        if converge is not None:
+            self.converge = converge
+            title = "converging on the manifest of {}, as resolved by the run that is being resumed:"
         else:
-            for srv in servers:
-                # if the server is an actual server and not a group of servers:
-                if srv in self.server_aliases:
-                    for url in self.server_aliases[srv]['url']:
-                        # grab configuration from the server aliases dictionary, and run the script on the server
-                        self.update_server(
-                            srv,
-                            url)
-                # if this is a server group alias
-                elif srv in self.group_aliases:
-
-                        # we need to run through each server individually
-                        for srv_alias in self.group_aliases[srv]['servers']:
-                            for url in self.server_aliases[srv_alias]['url']:
-                                # legacy servers require direct ssh connection
-                                self.update_server(
-                                    srv_alias,
-                                    url,
-                                    self.server_aliases[srv_alias]['git_user'])
+            self.converge, errors = manifest.resolve(self.config.get_manifest(self.manifest),
+                                                     lambda repo: self.git_server + '/' + repo + '.git', ls_remote)
+            for repo, error in sorted(errors.items()):
+                out(0, red("manifest of {}: ".format(self.manifest)) + "{}: {}".format(bold(repo), error))
+            if errors:
+                return False
+            if self.checkpoint is not None:
+                self.checkpoint.remember('converge', self.converge)
+            title = "converging on the manifest of {}:"
 
+        out(0, green(title.format(self.manifest)))
+        for repo, commit in sorted(self.converge.items()):
+            out(1, bold(repo) + ": " + commit[:8])
+
+        return True
+
+    def update_server_list(self, servers):
+        """
+        loop through servers, and run commands on them.
+        :param servers: list of servers
+        :return: void
+        """
+        targets = self.get_targets(servers)
+        if self.shard is not None:
+            index, count = self.shard
+            # the other shards update their servers from the same git server at the same time
+            admission().share(count)
+            all_targets = len(targets)
+            targets = shards.partition(targets, index, count)
+            out(0, yellow("shard {}/{}: {} of {} server(s)".format(index, count, len(targets), all_targets)))
+        if self.checkpoint is not None and self.checkpoint.resumed:
+            remaining = [target for target in targets if self.checkpoint.completed(target[1]) is None]
+            out(0, yellow("resuming: {} of {} server(s) were already updated".format(
+                len(targets) - len(remaining), len(targets))))
+            targets = remaining
+
+        try:
+            if self.crawl or self.repos:
+                # crawl everything when asked to, otherwise only the servers we don't know enough about
+                self.crawl_inventory(targets, self.crawl)
+                if self.crawl:
+                    return
+                targets = self.select_targets(targets)
+
+            if self.two_phase:
+                self.update_two_phase(targets)
+            else:
+                self.run_targets("gpull: updating {} server(s)", self.update_server, targets)
+        finally:
             # at the end of the loop, close all connection instances
             for connection in self.connections.values():
                 connection.close()
 
-    def update_server(self, ssh_alias=None, url=None, git_user='www-data'):
+    def update_two_phase(self, targets):
+        """
+        Fetch everything the update needs on every server first, without touching the working trees.
+        Only once every server is ready, fast-forward or check out the working trees on all of them at the same time,
+        so the servers run different versions for as short as possible.
+        :param targets: list of (ssh alias, url, git user) tuples
+        :return: bool True if the update got applied
+        """
+        self.run_targets("gpull: prefetching on {} server(s)",
+                         lambda ssh_alias, url, git_user: self.update_server(ssh_alias, url, git_user, PREFETCH),
+                         targets)
+
+        not_ready = [host_result for host_result in self.prefetch_results if host_result['status'] != 'finished' or
+                     any(repo_result.get('status') != READY for repo_result in host_result['repos'])]
+        if not_ready or len(self.prefetch_results) < len(targets):
+            out(0, red("Not applying the update, {} server(s) are not ready:".format(len(not_ready))))
+            for host_result in not_ready:
+                out(1, red(host_result['host']) + ": " + (host_result['error'] or 'failed'))
+                for repo_result in host_result['repos']:
+                    if repo_result.get('status') == STATUS_FAILED:
+                        out(2, bold(repo_result['repo']) + ": " + repo_result.get('error', ''))
+            # the servers that aren't ready are the ones that failed this run
+            self.results.extend(not_ready)
+            return False
+
+        # the working tree updates are local and quick, so do all of them at once
+        jobs = self.jobs
+        self.jobs = len(targets)
+        try:
+            self.run_targets("gpull: applying on {} server(s)",
+                             lambda ssh_alias, url, git_user: self.update_server(ssh_alias, url, git_user, APPLY),
+                             targets)
+        finally:
+            self.jobs = jobs
+
+        if self.results:
+            window = max(host_result['started_at'] + (host_result['duration'] or 0) for host_result in self.results) - \
+                min(host_result['started_at'] for host_result in self.results)
+            out(0, green("Applied on {} server(s) within {:.1f}s".format(len(self.results), window)))
+
+        return True
+
+    def run_targets(self, title, func, targets):
+        """
+        Call func for every target, self.jobs at a time, while showing the dashboard
+        :param title: string dashboard title, with a {} for the number of targets
+        :param func: callable that gets the ssh alias, url and git user of a target
+        :param targets: list of (ssh alias, url, git user) tuples
+        :return: void
+        """
+        self.dashboard = Dashboard(title.format(len(targets)))
+        for ssh_alias, url, git_user in targets:
+            self.dashboard.add(url)
+        self.dashboard.start()
+
+        try:
+            if self.jobs > 1 and len(targets) > 1:
+                pool = ThreadPool(min(self.jobs, len(targets)))
+                try:
+                    pool.map(lambda target: func(*target), targets)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for target in targets:
+                    func(*target)
+        finally:
+            self.dashboard.stop()
+            self.dashboard = None
+
+    def crawl_inventory(self, targets, force=False):
+        """
+        Record which repositories exist on which servers
+        :param targets: list of (ssh alias, url, git user) tuples
+        :param force: bool crawl every server, instead of only the ones that weren't crawled recently
+        :return: void
+        """
+        inventory = Inventory()
+        targets = [target for target in targets if force or inventory.needs_crawl(target[1])]
+        if not targets:
+            return
+
+        self.run_targets("gpull: crawling {} server(s)",
+                         lambda ssh_alias, url, git_user: self.crawl_server(inventory, ssh_alias, url, git_user),
+                         targets)
+
+    def crawl_server(self, inventory, ssh_alias=None, url=None, git_user='www-data'):
+        """
+        Record which repositories exist on a single server
+        :return: void
+        """
+        self.update_dashboard(url, state=RUNNING, step='connecting')
+
+        command = "python -u " + self.gpull_local_location + " --report --inventory -a 1"
+        if ssh_alias is not None:
+            command += " -u {}".format(git_user)
+            if self.start_ssh(url) is False:
+                inventory.save_host(url, ssh_alias, [], 'failed', 'ssh connection failed')
+                self.update_dashboard(url, state=SKIPPED if url in self.health.skipped else FAILED)
+                return
+        command += " -p {}".format(' '.join(self.dir))
+
+        self.update_dashboard(url, step='listing repositories')
+        output = self.exec_shell(command, url if ssh_alias is not None else None)
+        text, records = report.parse(output or '')
+        inventoried = report.filter_records(records, INVENTORIED)
+        records = report.filter_records(records, 'inventory')
+        if not inventoried or inventoried[-1]['repos'] != len(records):
+            # keep what we knew about the host, and crawl it again on the next run
+            inventory.save_host(url, ssh_alias, [], 'failed', 'gpull_local.py did not finish listing repositories')
+            self.log(0, red("{}: ".format(url)) + "could not list the repositories:\n" + text)
+            self.update_dashboard(url, state=FAILED)
+            return
+        inventory.save_host(url, ssh_alias, records)
+
+        self.log(0, green("{}: ".format(url)) + "{} repositories".format(len(records)))
+        self.update_dashboard(url, state=DONE, advance=len(records))
+
+    def select_targets(self, targets):
+        """
+        Keep only the servers that have the requested repositories, and remember which paths to update on each
+        :param targets: list of (ssh alias, url, git user) tuples
+        :return: list of (ssh alias, url, git user) tuples
+        """
+        self.target_paths = Inventory().find(self.repos, [url for ssh_alias, url, git_user in targets])
+        selected = [target for target in targets if target[1] in self.target_paths]
+
+        out(0, yellow("{} found on {} of {} server(s)".format(", ".join(self.repos), len(selected), len(targets))))
+
+        return selected
+
+    def get_targets(self, servers):
+        """
+        Resolve server and group aliases to the individual servers to update
+        :param servers: list of server or group aliases, or None to run locally
+        :return: list of (ssh alias, url, git user) tuples
+        """
+        if servers is None:
+            # run locally
+            return [(None, 'localhost', 'www-data')]
+
+        targets = []
+        for srv in servers:
+            # if the server is an actual server and not a group of servers:
+            if srv in self.server_aliases:
+                for url in self.server_aliases[srv]['url']:
+                    # grab configuration from the server aliases dictionary, and run the script on the server
+                    targets.append((srv, url, 'www-data'))
+            # if this is a server group alias
+            elif srv in self.group_aliases:
+
+                    # we need to run through each server individually
+                    for srv_alias in self.group_aliases[srv]['servers']:
+                        for url in self.server_aliases[srv_alias]['url']:
+                            # legacy servers require direct ssh connection
+                            targets.append((srv_alias, url, self.server_aliases[srv_alias]['git_user']))
+
+        return targets
+
+    def merge_shard_results(self, paths):
+        """
+        Merge the results of the shards of a run into one report
+        :param paths: list of results files written by the shards
+        :return: bool True if every server of every shard was updated
+        """
+        shard_results, missing = shards.read_results(paths)
+        started_at = min([shard['started_at'] for shard in shard_results] or [time.time()])
+        self.results = [host_result for shard in shard_results for host_result in shard['results']]
+
+        out(0, green("Merged results of {} of {} shard(s):".format(len(shard_results), len(paths))))
+        for path, error in sorted(missing.items()):
+            out(1, red("missing results of a shard: ") + "{} ({})".format(path, error))
+
+        counts = {}
+        for host_result in self.results:
+            counts[host_result['status']] = counts.get(host_result['status'], 0) + 1
+        out(1, blue(", ".join("{} {}".format(count, status) for status, count in sorted(counts.items())) or
+                    "no servers"))
+        for host_result in sorted(self.results, key=lambda result: result['host']):
+            if host_result['status'] in (STATUS_FAILED, STATUS_SKIPPED):
+                out(1, red(host_result['host']) + ": " + (host_result['error'] or host_result['status']))
+
+        if not self.host_changelogs:
+            self.report_changes()
+
+        if self.metrics is not None:
+            self.metrics.record_run(started_at, [repo_result for host_result in self.results
+                                                 for repo_result in host_result['repos']], self.results)
+            self.metrics.write()
+
+        return not missing and all(shard['status'] == 'finished' for shard in shard_results) and \
+            not any(host_result['status'] == STATUS_FAILED for host_result in self.results)
+
+    def log(self, indent, msg):
+        """
+        Print a message, above the dashboard if there is one
+        :param indent: int
+        :param msg: string
+        :return: void
+        """
+        if self.dashboard is not None:
+            self.dashboard.log(indent, msg)
+        else:
+            out(indent, msg)
+
+    def update_dashboard(self, key, **kwargs):
+        if self.dashboard is not None:
+            self.dashboard.update(key, **kwargs)
+
+    def track_progress(self, url, line):
+        """
+        Follow the records gpull_local.py prints while it works, to show what it is doing on the dashboard
+        :param url: string server the line came from
+        :param line: string line of output
+        :return: void
+        """
+        for record in report.parse(line)[1]:
+            if record['kind'] == 'step':
+                self.update_dashboard(url, step="{}: {}".format(record['repo'], record['step']))
+            elif record['kind'] in ('repo', PREFETCH):
+                self.update_dashboard(url, advance=1)
+
+    def report_skipped(self):
+        """
+        Tell the user which servers were not even tried because they kept failing
+        :return: void
+        """
+        if not self.health.skipped:
+            return
+
+        out(0, red("Skipped {} server(s) that failed on previous runs:".format(len(self.health.skipped))))
+        for url, reason in sorted(self.health.skipped.items()):
+            out(1, red(url) + ": " + reason)
+
+    def report_changes(self):
+        """
+        Show the changelog of every repository that moved from one commit to another, once for all the servers
+        that made the same move.
+        :return: void
+        """
+        transitions = {}
+        for host_result in self.results:
+            for repo_result in host_result['repos']:
+                old, new = repo_result.get('sha_before'), repo_result.get('sha_after')
+                if not old or not new or old == new:
+                    continue
+                repo = mirror_name(repo_result.get('origin_url'), repo_result['repo'])
+                transitions.setdefault((repo, old, new), []).append(host_result['host'])
+
+        if not transitions:
+            return
+
+        changelogs = ChangelogCache(self.get_mirrors())
+        out(0, green("Changes:"))
+        for (repo, old, new), hosts in sorted(transitions.items()):
+            out(1, bold(repo) + " {}..{} on {}:".format(old[:8], new[:8], ", ".join(sorted(set(hosts)))))
+            changelog = changelogs.get(repo, old, new)
+            if changelog is None:
+                out(2, yellow("could not compute the changes from the mirror"))
+            else:
+                out(2, blue(changelog.rstrip()))
+
+    def get_mirrors(self):
+        """
+        :return: MirrorCache
+        """
+        if self.mirrors is None:
+            self.mirrors = MirrorCache()
+
+        return self.mirrors
+
+    def start_relay(self):
+        """
+        Fetch all configured repositories into the local mirrors, and start serving them
+        :return: void
+        """
+        mirrors = self.get_mirrors()
+        out(0, green("updating mirrors in " + mirrors.mirror_dir))
+        updated = {}
+        for repo, path in sorted(mirrors.update_all(self.config.repositories).items()):
+            if path is False:
+                out(1, yellow("warning: ") + "could not mirror {}, servers will fetch it from origin:\n{}".format(
+                    repo, mirrors.failed[repo]))
+            else:
+                updated[repo] = path
+
+        if not updated:
+            out(1, yellow("warning: ") + "no mirrors to relay, servers will fetch everything from origin")
+            return
+
+        self.relay = FetchRelay(mirrors.mirror_dir, updated)
+        self.relay.start()
+
+    def stop_relay(self):
+        """
+        Stop serving the local mirrors
+        :return: void
+        """
+        if self.relay is not None:
+            self.relay.close()
+            self.relay = None
+
+    def update_server(self, ssh_alias=None, url=None, git_user='www-data', phase=None):
         """
         Update Individual Server
         :param ssh_alias:
         :param url:
         :param git_user:
-        :return:
+        :param phase: None to update in one go, or PREFETCH or APPLY for one phase of a two-phase update
+        :return: dict of results for this server
         """
+        host_result = {
+            'host': url,
+            'alias': ssh_alias,
+            'status': 'finished',
+            'started_at': time.time(),
+            'duration': None,
+            'error': None,
+            'repos': [],
+        }
+        if phase == PREFETCH:
+            self.prefetch_results.append(host_result)
+        else:
+            self.results.append(host_result)
+        self.update_dashboard(url, state=RUNNING, step='connecting')
+
         # run this file on the desired server.
-        command = "python -u " + self.gpull_local_location
+        command = "python -u " + self.gpull_local_location + " --report"
 
         if ssh_alias is not None:
             # start a remote connection to the server
             command += " -u {} -e {} -n '{}' ".format(git_user, self.email_to, self.ssh_user)
             if self.start_ssh(url) is False:
                 # failed connection, so don't continue updating directories
-                return False
+                if url in self.health.skipped:
+                    host_result['status'] = STATUS_SKIPPED
+                    host_result['error'] = self.health.skipped[url]
+                else:
+                    host_result['status'] = STATUS_FAILED
+                    host_result['error'] = 'ssh connection failed'
+                host_result['duration'] = time.time() - host_result['started_at']
+                self.update_dashboard(url, state=SKIPPED if host_result['status'] == STATUS_SKIPPED else FAILED)
+                self.save_checkpoint(url, host_result, phase)
+                return host_result
+
+        if self.relay is not None and phase != APPLY:
+            if ssh_alias is None:
+                relay_url = self.relay.url()
+            else:
+                relay_url = self.relay.url(self.relay.forward(self.connections[url]))
+            # only the repositories whose mirrors are up to date get fetched from the relay
+            command += " --relay {} --relay-repos {}".format(relay_url, ' '.join(sorted(self.relay.repos)))
 
         # add path:
-        command += " -p {}".format(' '.join(self.dir))
+        command += " -p {}".format(' '.join(self.target_paths.get(url, self.dir)))
 
         # run through optional commands (force, branch)
         if self.branch is not None:
@@ -181,9 +704,69 @@ class GitUtils(object):
         if self.all_dirs:
             command += " -a "
 
-        out(0, green("running git updates on " + url))
+        if self.fast_status:
+            command += " --fast-status "
+
+        if not self.host_changelogs:
+            command += " --no-changelog "
+
+        if phase is not None:
+            command += " --{} ".format(phase)
 
-        out(0, self.exec_shell(command))
+        if self.converge:
+            command += " --converge {} ".format(manifest.format_targets(self.converge))
+
+        if phase == APPLY:
+            # the working trees get updated without talking to the git server
+            self.run_gpull_local(url, ssh_alias, command, host_result, phase)
+        else:
+            # the servers only admit their own fetches, one at a time; this admits the servers that fetch
+            # from the git server at the same time, over all threads of this run
+            self.update_dashboard(url, step='waiting for ' + self.git_server)
+            admission().run(self.git_server,
+                            lambda: self.run_gpull_local(url, ssh_alias, command, host_result, phase),
+                            judge=is_host_throttled)
+        if host_result['status'] != STATUS_FAILED and \
+                any(repo_result.get('status') == STATUS_FAILED for repo_result in host_result['repos']):
+            host_result['status'] = STATUS_FAILED
+            host_result['error'] = 'one or more repositories failed to update'
+        host_result['duration'] = time.time() - host_result['started_at']
+        self.update_dashboard(url, state=FAILED if host_result['status'] == STATUS_FAILED else DONE)
+        self.save_checkpoint(url, host_result, phase)
+
+        return host_result
+
+    def run_gpull_local(self, url, ssh_alias, command, host_result, phase=None):
+        """
+        Run gpull_local.py on a server, and collect the results of its repositories
+        :return: dict host_result, with the repository results
+        """
+        self.update_dashboard(url, step='starting gpull_local')
+        output = self.exec_shell(command, url if ssh_alias is not None else None,
+                                 lambda line: self.track_progress(url, line))
+        text, records = report.parse(output or '')
+
+        self.log(0, green("running git updates on " + url))
+        self.log(0, text)
+
+        host_result['repos'] = report.filter_records(records, PREFETCH if phase == PREFETCH else 'repo')
+        if phase == PREFETCH:
+            # without it, gpull_local.py stopped halfway or doesn't know --prefetch, and some repositories
+            # may not have been fetched at all
+            prefetched = report.filter_records(records, PREFETCHED)
+            if not prefetched or prefetched[-1]['repos'] != len(host_result['repos']):
+                host_result['status'] = STATUS_FAILED
+                host_result['error'] = 'gpull_local.py did not finish prefetching'
+
+        return host_result
+
+    def save_checkpoint(self, url, host_result, phase=None):
+        """
+        Remember that a server is done, so a resumed run can skip it if it was updated
+        :return: void
+        """
+        if self.checkpoint is not None and phase != PREFETCH:
+            self.checkpoint.save(url, host_result['status'] == 'finished', host_result)
 
     def git_merge_all(self, from_branch, to_branch, working_path='/var/release'):
         """
@@ -199,42 +782,97 @@ class GitUtils(object):
 
         os.chdir(working_path)
 
+        self.dashboard = Dashboard("git_merge_all: merging {} into {}".format(from_branch, to_branch))
+        for repo in self.config.repositories:
+            self.dashboard.add(repo)
+        self.dashboard.start()
+
+        started_at = time.time()
+        try:
+            return self.merge_repositories(from_branch, to_branch, working_path)
+        finally:
+            self.dashboard.stop()
+            self.dashboard = None
+            if self.metrics is not None:
+                self.metrics.record_run(started_at, self.merge_results)
+                self.metrics.write()
+
+    def merge_repositories(self, from_branch, to_branch, working_path):
+        """
+        Merge every configured repository, one after the other, in the working path
+        :return: string output of the last repository | False
+        """
+        output = ''
         for repo in self.config.repositories:
             os.chdir(working_path)
-            out(1, blue("\n------- REPO: " + repo + " -------"))
+            self.log(1, blue("\n------- REPO: " + repo + " -------"))
+            checkpoint_item = "{}..{}:{}".format(from_branch, to_branch, repo)
+            if self.checkpoint is not None and self.checkpoint.completed(checkpoint_item) is not None:
+                self.log(2, green("already merged by the run that is being resumed"))
+                self.update_dashboard(repo, state=DONE)
+                continue
+            self.update_dashboard(repo, state=RUNNING)
             # see if the repo exists
             path = working_path+'/'+repo
 
             output = ''
+            result = {'repo': repo, 'status': 'failed', 'started_at': time.time(), 'fetch_duration': 0}
+            self.merge_results.append(result)
             try:
                 if not os.path.exists(path):
+                    self.update_dashboard(repo, step='clone')
                     output += self.exec_shell('git clone '+self.git_server+'/'+repo+'.git ' + path)
 
                     if 'Access denied.' in output:
-                        out(2, yellow('skipped'))
+                        self.log(2, yellow('skipped'))
+                        self.update_dashboard(repo, state=SKIPPED)
+                        result['status'] = STATUS_SKIPPED
                         continue
 
                 os.chdir(path)
 
-                output += self.exec_shell('git reset --hard HEAD')
-                output += self.exec_shell('git checkout --force {}'.format(from_branch))
-                output += self.exec_shell('git pull')
-                output += self.exec_shell('git checkout --force {}'.format(to_branch))
-                output += self.exec_shell('git pull')
-                output += self.exec_shell('git merge {}'.format(from_branch))
-                output += self.exec_shell('git push origin {}'.format(to_branch))
+                steps = [
+                    ('reset', 'git reset --hard HEAD'),
+                    ('checkout ' + from_branch, 'git checkout --force {}'.format(from_branch)),
+                    ('pull ' + from_branch, 'git pull'),
+                    ('checkout ' + to_branch, 'git checkout --force {}'.format(to_branch)),
+                    ('pull ' + to_branch, 'git pull'),
+                    ('merge', 'git merge {}'.format(from_branch)),
+                    ('push', 'git push origin {}'.format(to_branch)),
+                ]
+                for step, command in steps:
+                    self.update_dashboard(repo, step=step)
+                    step_start = time.time()
+                    if is_network_command(command):
+                        output += admission().run(self.git_server, lambda: self.exec_shell(command),
+                                                  check_output=True)
+                    else:
+                        output += self.exec_shell(command)
+                    if command.startswith('git pull'):
+                        result['fetch_duration'] += time.time() - step_start
+                    elif command.startswith('git push'):
+                        result['push_duration'] = time.time() - step_start
 
+                failed = False
                 for line in output.splitlines(True):
                     if line.startswith('error') or line.startswith('CONFLICT'):
-                        out(2, red(line))
+                        self.log(2, red(line))
+                        failed = True
                     else:
-                        out(2, green(line))
+                        self.log(2, green(line))
+                self.update_dashboard(repo, state=FAILED if failed else DONE, advance=1)
+                result['status'] = 'failed' if failed else 'merged'
 
             except Exception as e:
-                out(2, red('Error: '))
-                out(2, red(output))
-                out(2, red(e))
+                self.log(2, red('Error: '))
+                self.log(2, red(output))
+                self.log(2, red(e))
+                self.update_dashboard(repo, state=FAILED)
                 return False
+            finally:
+                result['duration'] = time.time() - result['started_at']
+                if self.checkpoint is not None:
+                    self.checkpoint.save(checkpoint_item, result['status'] in ('merged', STATUS_SKIPPED), result)
         return output
 
     def start_ssh(self, url):
@@ -249,55 +887,90 @@ class GitUtils(object):
 
         # if we haven't already started this connection, start it
         if url not in self.connections:
-            try:
+            # don't bother with servers that keep failing, until it's time to probe them again
+            if not self.health.allow(url):
+                self.log(0, red("Skipping {}: ".format(url)) + self.health.skipped[url])
+                return False
+
+            def connect():
+                connect_start = time.time()
                 # paramiko.util.log_to_file("paramiko.log")
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.allow_agent = False
-                ssh.connect(url, username=self.ssh_user, password=self.pw)
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                client.allow_agent = False
+                # urls may come with a port, eg. for servers behind a jump host's port forwards
+                host, _, port = url.partition(':')
+                client.connect(host, port=int(port or 22), username=self.ssh_user, password=self.pw,
+                               timeout=SSH_TIMEOUT, banner_timeout=SSH_TIMEOUT, auth_timeout=SSH_TIMEOUT)
+                if self.metrics is not None:
+                    self.metrics.observe('gpull_ssh_connect_duration_seconds', time.time() - connect_start,
+                                         {'host': url})
+                return client
+
+            def on_retry(attempt, e, delay):
+                if self.metrics is not None:
+                    self.metrics.inc('gpull_retries_total', {'operation': 'ssh'})
+                self.log(0, yellow("SSH connection to {} failed ({}), retrying in {:.1f}s".format(url, e, delay)))
 
+            try:
+                ssh = retry(connect, SSH_ATTEMPTS, on_retry=on_retry)
             except Exception as e:
-                out(0, red("SSH connection to {} failed: ".format(url)))
-                print(e)
+                # only count network trouble against the server: a wrong password or host key would otherwise
+                # have the whole fleet skipped on the next runs
+                if is_transient(e):
+                    self.health.record_failure(url, e)
+                self.log(0, red("SSH connection to {} failed: ".format(url)) + str(e))
                 return False
+
+            self.health.record_success(url)
             # add this connection to the list of open connections
             self.connections[url] = ssh
 
-        # set ssh_alias as the current connection key to be used in exec_shell
-        self.current_conn_key = url
-
         return True
 
-    def exec_shell(self, command):
+    def exec_shell(self, command, conn_key=None, on_line=None):
         """
         Execute a shell command and get the output.
         :param command: script command
+        :param conn_key: url of the ssh connection to run the command on, or None to run it locally
+        :param on_line: optional callable that gets every line of output as soon as it comes in
         :return: string | False
         """
-        if self.current_conn_key:
-            ssh = self.connections[self.current_conn_key]
-            encoded = pipes.quote(self.pw)
+        lines = []
+
+        if conn_key:
+            ssh = self.connections[conn_key]
+            encoded = quote(self.pw)
             sudo_cmd = "echo {pw} | sudo -S ".format(pw=encoded)
 
             stdin, stdout, stderr = ssh.exec_command(sudo_cmd + command, get_pty=True)
-            out(0, stdout.read())
+            for line in stdout:
+                lines.append(line)
+                if on_line is not None:
+                    on_line(line)
 
             if stderr:
                 for line in stderr.readlines():
                     line = line.strip()
                     # ignore sudo password prompts
                     if '[sudo] password for' not in line:
-                        out(0, line)
+                        self.log(0, line)
+
+            return "".join(lines)
         else:
             try:
                 # try to run the process, or return an error
                 process = subprocess.Popen(shlex.split(command), bufsize=0,
                                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-                stdout, stderr = process.communicate()
+                for line in iter(process.stdout.readline, b''):
+                    line = line.decode('UTF-8')
+                    lines.append(line)
+                    if on_line is not None:
+                        on_line(line)
+                process.wait()
 
-                if stdout is not None:
-                    return stdout
+                return "".join(lines)
             except subprocess.CalledProcessError as e:
                 print("Could not finish your request: " + e.output.decode('UTF-8'))
                 return False
@@ -0,0 +1,57 @@
+import json
+import sys
+
+__author__ = 'Kevin Dubois'
+
+"""
+Machine readable records that gpull_local.py prints alongside its normal output,
+so that the controller (gpull.py) can tell what happened on each host.
+"""
+
+# every record is printed on its own line, starting with this marker
+PREFIX = '##gpull '
+
+
+def emit(kind, **data):
+    """
+    Print a single record on stdout
+    :param kind: string type of record, eg. 'repo'
+    :param data: json serializable values
+    :return: void
+    """
+    data['kind'] = kind
+    sys.stdout.flush()
+    print(PREFIX + json.dumps(data, sort_keys=True))
+    sys.stdout.flush()
+
+
+def parse(text):
+    """
+    Split the output of gpull_local.py into human readable text and records
+    :param text: string output
+    :return: tuple (string text, list of record dicts)
+    """
+    lines = []
+    records = []
+
+    for line in text.splitlines(True):
+        stripped = line.strip(' \t\b\n\r')
+        if stripped.startswith(PREFIX):
+            try:
+                records.append(json.loads(stripped[len(PREFIX):]))
+                continue
+            except ValueError:
+                pass  # not one of ours after all, so just show it
+        lines.append(line)
+
+    return "".join(lines), records
+
+
+def filter_records(records, kind):
+    """
+    Get only the records of a given kind
+    :param records: list of record dicts
+    :param kind: string
+    :return: list
+    """
+    return [record for record in records if record.get('kind') == kind]
@@ -1,6 +1,8 @@
 import os
 import yaml
 
+from utils.hooks import dependency_levels
+
 CONFIG_FILE = 'settings.yaml'
 
 
@@ -103,6 +105,105 @@ class Config(object):
 
         return repositories
 
+    def get_mirror_dir(self):
+        """Directory where the controller keeps bare mirrors of the repositories"""
+        if self.config.get('MirrorDir') is None:
+            return os.path.join(os.path.expanduser('~'), '.gpull', 'mirrors')
+        else:
+            return self.config['MirrorDir']
+
+    def get_fast_status(self):
+        """Repositories to use the fast status checks for, see gpull_local.py --fast-status; True for all of them"""
+        fast_status = self.config.get('FastStatus')
+        if fast_status is None or fast_status is False:
+            return []
+        elif fast_status is True:
+            return True
+        elif not isinstance(fast_status, list):
+            raise AttributeError(
+                'FastStatus in config file must be of type list or bool, {} given'.format(type(fast_status))
+            )
+        else:
+            return fast_status
+
+    def get_metrics_dir(self):
+        """Directory to write Prometheus metrics files in after every run (eg. node_exporter's textfile directory)"""
+        return self.config.get('MetricsDir')
+
+    def get_throttle(self):
+        """Limits for network git operations per git server, see Throttle in settings_example.yaml"""
+        throttle = self.config.get('Throttle')
+        if throttle is None:
+            return {}
+        elif not isinstance(throttle, dict):
+            raise AttributeError(
+                'Throttle in config file must be of type dict, {} given'.format(type(throttle))
+            )
+        else:
+            return throttle
+
+    def get_post_update_hooks(self, repo):
+        """Hooks to run in a repository after a pull, see PostUpdateHooks in settings_example.yaml"""
+        hooks = self.config.get('PostUpdateHooks')
+        if hooks is None:
+            return []
+        elif not isinstance(hooks, dict):
+            raise AttributeError(
+                'PostUpdateHooks in config file must be of type dict, {} given'.format(type(hooks))
+            )
+
+        repo_hooks = hooks.get(repo) or []
+        for hook in repo_hooks:
+            if not isinstance(hook, dict) or 'name' not in hook or 'command' not in hook:
+                raise AttributeError('Every post-update hook of {} needs a name and a command'.format(repo))
+            # a single path or dependency may be given as a string
+            for key in ('paths', 'after'):
+                if isinstance(hook.get(key), str):
+                    hook[key] = [hook[key]]
+            timeout = hook.get('timeout')
+            if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or
+                                        timeout <= 0):
+                raise AttributeError('The timeout of post-update hook {} of {} must be a number of seconds'.format(
+                    hook['name'], repo))
+
+        try:
+            dependency_levels(repo_hooks)
+        except ValueError as e:
+            raise AttributeError('Post-update hooks of {}: {}'.format(repo, e))
+
+        return repo_hooks
+
+    def get_manifest(self, environment):
+        """Commit or ref every repository should be on in an environment, see Manifests in settings_example.yaml"""
+        manifests = self.config.get('Manifests')
+        if manifests is None:
+            return {}
+        elif not isinstance(manifests, dict):
+            raise AttributeError(
+                'Manifests in config file must be of type dict, {} given'.format(type(manifests))
+            )
+
+        manifest = manifests.get(environment) or {}
+        if not isinstance(manifest, dict):
+            raise AttributeError(
+                'The manifest of {} in config file must be of type dict, {} given'.format(environment, type(manifest))
+            )
+
+        # yaml reads eg. a tag like 1.10 as a number
+        return dict((repo, str(ref)) for repo, ref in manifest.items())
+
+    def get_worktrees(self, repo):
+        """Branches of a repository to keep a worktree of, see Worktrees in settings_example.yaml"""
+        worktrees = self.config.get('Worktrees')
+        if worktrees is None:
+            return []
+        elif not isinstance(worktrees, dict):
+            raise AttributeError(
+                'Worktrees in config file must be of type dict, {} given'.format(type(worktrees))
+            )
+
+        return worktrees.get(repo) or []
+
     def get_git_server(self):
         if self.config['GitServer'] is None:
             raise AttributeError(
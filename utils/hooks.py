@@ -0,0 +1,151 @@
+import fnmatch
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from shlex import quote
+except ImportError:  # python 2
+    from pipes import quote
+
+__author__ = 'Kevin Dubois'
+
+# max number of hooks of a repository to run at the same time
+JOBS = 4
+
+# seconds a hook may run before it gets killed, for hooks without a timeout of their own
+TIMEOUT = 600
+
+# seconds a killed hook gets to exit before it's killed for good
+KILL_AFTER = 10
+
+STATUS_DONE = 'done'
+STATUS_SKIPPED = 'skipped'
+STATUS_FAILED = 'failed'
+
+
+def matches(path, patterns):
+    """
+    Check whether a changed file matches any of a hook's path globs.
+    A glob ending in / matches everything below that directory, and * also matches across directories.
+    :param path: string path relative to the repository root
+    :param patterns: list of globs, eg. ['composer.*', 'assets/']
+    :return: bool
+    """
+    for pattern in patterns:
+        if pattern.endswith('/') and path.startswith(pattern):
+            return True
+        if fnmatch.fnmatch(path, pattern):
+            return True
+
+    return False
+
+
+def dependency_levels(hooks):
+    """
+    Group hooks in levels, so every hook comes after all the hooks it runs 'after'
+    :param hooks: list of hook dicts
+    :return: list of lists of hook dicts
+    """
+    names = [hook['name'] for hook in hooks]
+    for hook in hooks:
+        for dependency in hook.get('after', []):
+            if dependency not in names:
+                raise ValueError("hook {} runs after unknown hook {}".format(hook['name'], dependency))
+
+    levels = []
+    placed = set()
+    remaining = list(hooks)
+    while remaining:
+        level = [hook for hook in remaining if all(dependency in placed for dependency in hook.get('after', []))]
+        if not level:
+            raise ValueError("hooks {} depend on each other".format(", ".join(hook['name'] for hook in remaining)))
+        levels.append(level)
+        placed.update(hook['name'] for hook in level)
+        remaining = [hook for hook in remaining if hook['name'] not in placed]
+
+    return levels
+
+
+class HookRunner(object):
+    """
+    Run the post-update hooks of a repository whose paths were touched by a pull.
+    Hooks that don't depend on each other run at the same time; a hook that runs 'after' a failed hook is skipped.
+    """
+    def __init__(self, exec_shell, jobs=JOBS, timeout=TIMEOUT):
+        """
+        :param exec_shell: callable that runs a command in the repository and returns its output, raising
+        subprocess.CalledProcessError when it fails
+        :param jobs: int max number of hooks to run at the same time
+        :param timeout: int seconds a hook may run, unless it sets its own timeout
+        """
+        self.exec_shell = exec_shell
+        self.jobs = jobs
+        self.timeout = timeout
+
+    def run(self, hooks, changed_files, on_result=None):
+        """
+        :param hooks: list of hook dicts with a name, a command and optionally paths, the hooks to run after and
+        a timeout
+        :param changed_files: list of paths changed by the pull, or None to run every hook whatever its paths
+        :param on_result: optional callable that gets every result dict as soon as it's known
+        :return: list of result dicts, in the order of the hooks
+        """
+        results = {}
+
+        def report(result):
+            results[result['name']] = result
+            if on_result is not None:
+                on_result(result)
+
+        for level in dependency_levels(hooks):
+            to_run = []
+            for hook in level:
+                failed = [dependency for dependency in hook.get('after', [])
+                          if results[dependency]['status'] == STATUS_FAILED or results[dependency].get('blocked')]
+                if failed:
+                    report({'name': hook['name'], 'status': STATUS_SKIPPED, 'blocked': True,
+                            'error': 'hook {} failed'.format(failed[0])})
+                elif hook.get('paths') and changed_files is not None and \
+                        not any(matches(path, hook['paths']) for path in changed_files):
+                    report({'name': hook['name'], 'status': STATUS_SKIPPED, 'error': 'no matching changes'})
+                else:
+                    to_run.append(hook)
+
+            if len(to_run) > 1 and self.jobs > 1:
+                pool = ThreadPool(min(self.jobs, len(to_run)))
+                try:
+                    for result in pool.map(self.run_hook, to_run):
+                        report(result)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for hook in to_run:
+                    report(self.run_hook(hook))
+
+        return [results[hook['name']] for hook in hooks]
+
+    def run_hook(self, hook):
+        """
+        Run a single hook through the shell
+        :param hook: dict
+        :return: dict result
+        """
+        result = {'name': hook['name'], 'status': STATUS_DONE, 'started_at': time.time()}
+        timeout = hook.get('timeout') or self.timeout
+        try:
+            # timeout(1) kills the hook and everything it started, so a hung hook can't hold up the whole run
+            self.exec_shell("timeout -k {} {} sh -c {}".format(KILL_AFTER, timeout, quote(hook['command'])))
+        except subprocess.CalledProcessError as e:
+            result['status'] = STATUS_FAILED
+            if time.time() - result['started_at'] >= timeout:
+                result['error'] = 'timed out after {}s'.format(timeout)
+            else:
+                result['error'] = e.output.decode('UTF-8').strip() or 'exit status {}'.format(e.returncode)
+        except OSError as e:
+            result['status'] = STATUS_FAILED
+            result['error'] = str(e)
+        result['duration'] = time.time() - result['started_at']
+
+        return result
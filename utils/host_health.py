@@ -0,0 +1,265 @@
+import errno
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+
+__author__ = 'Kevin Dubois'
+
+# consecutive failures after which we stop trying a host or remote for a while
+FAILURE_THRESHOLD = 3
+
+# how long an open circuit stays open, in seconds; doubles with every further failure, up to the max
+COOLDOWN = 60
+MAX_COOLDOWN = 3600
+
+# error messages that mean trying again later might work
+TRANSIENT_ERRORS = [
+    'timed out',
+    'connection reset',
+    'connection refused',
+    'failed to connect',
+    "couldn't connect to server",
+    'connection closed',
+    'could not resolve host',
+    'temporary failure in name resolution',
+    'the remote end hung up unexpectedly',
+    'early eof',
+    'error reading ssh protocol banner',
+    'no route to host',
+    'network is unreachable',
+    'rpc failed',
+    'service unavailable',
+    'too many requests',
+]
+
+# errno values of OSErrors (socket.error on python 3) that are network trouble rather than a local problem
+TRANSIENT_ERRNOS = (errno.ECONNREFUSED, errno.ECONNRESET, errno.ECONNABORTED, errno.ETIMEDOUT, errno.EHOSTUNREACH,
+                    errno.ENETUNREACH, errno.ENETDOWN, errno.EPIPE)
+
+
+def is_transient(error):
+    """
+    Guess whether an error is worth retrying
+    :param error: Exception | string
+    :return: bool
+    """
+    if isinstance(error, (socket.timeout, socket.gaierror, socket.herror)):
+        return True
+    if isinstance(error, EnvironmentError) and getattr(error, 'errno', None) in TRANSIENT_ERRNOS:
+        return True
+    # paramiko's NoValidConnectionsError, with the error of every address it tried to connect to
+    errors = getattr(error, 'errors', None)
+    if isinstance(errors, dict) and errors:
+        return any(is_transient(e) for e in errors.values())
+
+    output = getattr(error, 'output', None)
+    if output is not None:
+        if isinstance(output, bytes):
+            output = output.decode('UTF-8', 'replace')
+        text = output
+    else:
+        text = str(error)
+
+    text = text.lower()
+    return any(message in text for message in TRANSIENT_ERRORS)
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=30.0):
+    """
+    Exponential backoff with full jitter
+    :param attempt: int number of attempts made so far, starting at 1
+    :return: float seconds to wait before the next attempt
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def retry(func, attempts=3, base_delay=1.0, max_delay=30.0, transient=is_transient, on_retry=None):
+    """
+    Call func until it succeeds, retrying transient errors with exponential backoff and jitter
+    :param func: callable without arguments
+    :param attempts: int max number of calls
+    :param transient: callable that gets the exception and returns whether to retry it
+    :param on_retry: optional callable that gets the attempt number, exception and delay before each retry
+    :return: whatever func returns
+    """
+    attempt = 1
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= attempts or not transient(e):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            if on_retry is not None:
+                on_retry(attempt, e, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def remote_host(url):
+    """
+    Get the host of a git remote url, so all repositories on the same server share their health
+    :param url: string eg. git@github.com:kdubois/gpull.git or https://github.com/kdubois/gpull.git
+    :return: string
+    """
+    if '://' in url:
+        host = url.split('://', 1)[1].split('/', 1)[0]
+    elif ':' in url.split('/', 1)[0]:
+        host = url.split(':', 1)[0]  # scp-like syntax
+    else:
+        return 'localhost'  # a path on this machine
+
+    return host.split('@')[-1].split(':')[0]
+
+
+class HostHealth(object):
+    """
+    Remember failures of hosts and remotes across runs, and open a circuit breaker on the ones that keep
+    failing so they can be skipped quickly. Once the cooldown has passed, a single probe is let through:
+    if it succeeds the circuit closes again, if not it stays open for (twice) as long.
+    """
+    def __init__(self, db_path=None):
+        this_dir = os.path.dirname(os.path.abspath(__file__))
+
+        if db_path is None:
+            db_path = os.path.join(this_dir, 'host_health.db')
+
+        self.conn = None
+        # the connection is shared by every thread updating a host
+        self.lock = threading.Lock()
+        try:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row  # return select results as a dict instead of a tuple
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS host_health
+                                 (name TEXT UNIQUE NOT NULL, failures INTEGER NOT NULL DEFAULT 0,
+                                  last_failure REAL, last_success REAL, opened_at REAL, last_error TEXT)''')
+            self.conn.commit()
+        except Exception as e:
+            print("Host health error: {0}".format(e))
+            self.conn = None
+
+        # hosts or remotes that got skipped during this run, and why
+        self.skipped = {}
+
+    def get(self, name):
+        """
+        Get the health record of a host or remote
+        :param name: string
+        :return: sqlite3.Row | None
+        """
+        if self.conn is None:
+            return None
+
+        try:
+            with self.lock:
+                return self.conn.execute("SELECT * FROM host_health WHERE name = ?", (name, )).fetchone()
+        except Exception:
+            return None
+
+    def cooldown(self, failures):
+        """
+        How long the circuit stays open after a given number of consecutive failures
+        :param failures: int
+        :return: float seconds
+        """
+        return min(MAX_COOLDOWN, COOLDOWN * 2 ** max(0, failures - FAILURE_THRESHOLD))
+
+    def retry_at(self, name, record=None):
+        """
+        When an open circuit lets the next probe through
+        :param name: string
+        :param record: sqlite3.Row health record of the host or remote, if the caller already has it
+        :return: float unix timestamp | None if the circuit is closed
+        """
+        if record is None:
+            record = self.get(name)
+        if record is None or record['opened_at'] is None:
+            return None
+
+        return record['last_failure'] + self.cooldown(record['failures'])
+
+    def allow(self, name):
+        """
+        Check whether we should try a host or remote now. Records it as skipped if not.
+        :param name: string
+        :return: bool
+        """
+        record = self.get(name)
+        retry_at = self.retry_at(name, record)
+        if retry_at is None:
+            return True  # closed
+
+        if time.time() >= retry_at:
+            if self.claim_probe(name, record['last_failure']):
+                return True  # open long enough to let a probe through
+            self.skipped[name] = "failed {} times in a row, last error: {}; being probed by someone else".format(
+                record['failures'], record['last_error'])
+            return False
+
+        self.skipped[name] = "failed {} times in a row, last error: {}; next try after {}".format(
+            record['failures'], record['last_error'], time.strftime('%H:%M:%S', time.localtime(retry_at)))
+        return False
+
+    def claim_probe(self, name, last_failure):
+        """
+        Claim the single probe of an open circuit whose cooldown has passed, by moving its last failure to now:
+        only the caller that still sees the old last failure gets it, in this process or any other
+        :param name: string
+        :param last_failure: float the last failure the caller saw
+        :return: bool
+        """
+        if self.conn is None:
+            return True
+
+        try:
+            with self.lock, self.conn:
+                cursor = self.conn.execute("UPDATE host_health SET last_failure = ? WHERE name = ? AND last_failure = ?",
+                                           (time.time(), name, last_failure))
+            return cursor.rowcount == 1
+        except Exception as e:
+            print("Host health error: {0}".format(e))
+            return True
+
+    def record_success(self, name):
+        """
+        Close the circuit of a host or remote
+        :param name: string
+        :return: void
+        """
+        self.execute('''INSERT OR REPLACE INTO host_health (name, failures, last_failure, last_success, opened_at,
+                                                             last_error)
+                        VALUES (?, 0, NULL, ?, NULL, NULL)''', (name, time.time()))
+
+    def record_failure(self, name, error):
+        """
+        Count a failure of a host or remote, and open its circuit once it keeps failing
+        :param name: string
+        :param error: Exception | string
+        :return: void
+        """
+        record = self.get(name)
+        failures = (record['failures'] if record is not None else 0) + 1
+        now = time.time()
+
+        opened_at = record['opened_at'] if record is not None else None
+        if failures >= FAILURE_THRESHOLD and opened_at is None:
+            opened_at = now
+
+        self.execute('''INSERT OR REPLACE INTO host_health (name, failures, last_failure, last_success, opened_at,
+                                                             last_error)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                     (name, failures, now, record['last_success'] if record is not None else None, opened_at,
+                      str(error).strip()[:500]))
+
+    def execute(self, query, params):
+        if self.conn is None:
+            return
+
+        try:
+            with self.lock, self.conn:
+                self.conn.execute(query, params)
+        except Exception as e:
+            print("Host health error: {0}".format(e))
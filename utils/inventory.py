@@ -0,0 +1,140 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+__author__ = 'Kevin Dubois'
+
+# hosts crawled longer ago than this (seconds) get crawled again when the inventory is refreshed
+MAX_AGE = 86400
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS hosts
+        (host TEXT UNIQUE NOT NULL, alias TEXT, crawled_at REAL, status TEXT, error TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS repos
+        (host TEXT NOT NULL, path TEXT NOT NULL, repo TEXT NOT NULL, origin_url TEXT, branch TEXT, head TEXT,
+         branches TEXT, remotes TEXT, seen_at REAL, UNIQUE (host, path))''',
+    'CREATE INDEX IF NOT EXISTS repos_repo ON repos (repo)',
+    'CREATE INDEX IF NOT EXISTS repos_host ON repos (host)',
+]
+
+
+class Inventory(object):
+    """
+    Which repositories, paths, remotes and branches exist on which hosts, as found by the last crawl of each host.
+    """
+    def __init__(self, db_path=None):
+        this_dir = os.path.dirname(os.path.abspath(__file__))
+
+        if db_path is None:
+            db_path = os.path.join(this_dir, 'inventory.db')
+
+        self.conn = None
+        # the connection is shared by the threads crawling hosts
+        self.lock = threading.Lock()
+        try:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row  # return select results as a dict instead of a tuple
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+            self.conn.commit()
+        except Exception as e:
+            print("Inventory error: {0}".format(e))
+            self.conn = None
+
+    def needs_crawl(self, host, max_age=MAX_AGE):
+        """
+        Check whether a host has never been crawled successfully, or not recently enough
+        :param host: string
+        :param max_age: int seconds
+        :return: bool
+        """
+        if self.conn is None:
+            return False
+
+        with self.lock:
+            record = self.conn.execute("SELECT crawled_at, status FROM hosts WHERE host = ?", (host, )).fetchone()
+
+        return record is None or record['status'] != 'ok' or time.time() - record['crawled_at'] >= max_age
+
+    def save_host(self, host, alias, repos, status='ok', error=None):
+        """
+        Replace everything we know about a host with the results of a crawl
+        :param host: string
+        :param alias: string server alias
+        :param repos: list of inventory record dicts, as reported by gpull_local.py --inventory
+        :param status: string 'ok' or 'failed'
+        :param error: string
+        :return: void
+        """
+        if self.conn is None:
+            return
+
+        now = time.time()
+        try:
+            with self.lock, self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO hosts (host, alias, crawled_at, status, error) "
+                                  "VALUES (?, ?, ?, ?, ?)", (host, alias, now, status, error))
+                if status != 'ok':
+                    return  # keep what we knew before
+                self.conn.execute("DELETE FROM repos WHERE host = ?", (host, ))
+                self.conn.executemany(
+                    '''INSERT OR REPLACE INTO repos (host, path, repo, origin_url, branch, head, branches, remotes,
+                                                     seen_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                    [(host, repo['path'], repo['repo'], repo.get('origin_url'), repo.get('branch'), repo.get('head'),
+                      json.dumps(repo.get('branches', [])), json.dumps(repo.get('remotes', {})), now)
+                     for repo in repos])
+        except Exception as e:
+            print("Inventory error: {0}".format(e))
+
+    def find(self, repos, hosts=None):
+        """
+        Find where repositories live
+        :param repos: list of repository names
+        :param hosts: optional list of hosts to limit the search to
+        :return: dict of host => list of repository paths
+        """
+        if self.conn is None or not repos:
+            return {}
+
+        query = "SELECT host, path FROM repos WHERE repo IN ({})".format(', '.join('?' * len(repos)))
+        params = list(repos)
+        if hosts is not None:
+            query += " AND host IN ({})".format(', '.join('?' * len(hosts)))
+            params += list(hosts)
+        query += " ORDER BY host, path"
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+
+        paths = {}
+        for row in rows:
+            paths.setdefault(row['host'], []).append(row['path'])
+
+        return paths
+
+    def repos(self, host=None, repo=None):
+        """
+        List the repositories in the inventory
+        :param host: string optional host filter
+        :param repo: string optional repository filter
+        :return: list of rows
+        """
+        if self.conn is None:
+            return []
+
+        query = "SELECT * FROM repos WHERE 1 = 1"
+        params = []
+        if host is not None:
+            query += " AND host = ?"
+            params.append(host)
+        if repo is not None:
+            query += " AND repo = ?"
+            params.append(repo)
+        query += " ORDER BY host, path"
+
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
@@ -0,0 +1,267 @@
+import os
+import shlex
+import sqlite3
+import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+__author__ = 'Kevin Dubois'
+
+# a repository needs maintenance once it has this many loose objects or packs ...
+LOOSE_OBJECTS_THRESHOLD = 1000
+PACKS_THRESHOLD = 10
+# ... or when it hasn't been maintained for this long (seconds)
+MAX_AGE = 7 * 86400
+# but never more often than this (seconds)
+MIN_INTERVAL = 3600
+
+# lock files that mean someone (eg. a gpull update) is working in the repository right now
+BUSY_LOCKS = ['index.lock', 'HEAD.lock', 'shallow.lock']
+
+# maintenance steps, in order; none of these take the locks that git fetch, checkout or pull need.
+# git maintenance needs git 2.30 or newer
+TASKS = [
+    # pack the loose objects, and delete loose objects that are already in a pack
+    ('loose-objects', "git -c gc.auto=0 maintenance run --task=loose-objects --quiet"),
+    # write the multi-pack-index, and combine small packs into bigger ones
+    ('incremental-repack', "git -c gc.auto=0 maintenance run --task=incremental-repack --quiet"),
+    ('commit-graph', "git -c gc.auto=0 maintenance run --task=commit-graph --quiet"),
+    # objects only get pruned when they are old enough that no running fetch can still be about to reference them
+    ('prune', "git -c gc.auto=0 prune --expire=2.weeks.ago"),
+]
+
+# errors that just mean a task had nothing to do
+NOTHING_TO_DO = ['no pack files to index']
+
+STATUS_DONE = 'done'
+STATUS_SKIPPED = 'skipped'
+STATUS_FAILED = 'failed'
+
+
+def find_executable(name):
+    """
+    :return: string path to the executable | None
+    """
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+class MaintenanceState(object):
+    """
+    Per repository maintenance state, so every repository is only maintained when it needs it
+    """
+    def __init__(self, db_path=None):
+        this_dir = os.path.dirname(os.path.abspath(__file__))
+
+        if db_path is None:
+            db_path = os.path.join(this_dir, 'maintenance.db')
+
+        self.conn = None
+        # the connection is shared by the worker threads
+        self.lock = threading.Lock()
+        try:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row  # return select results as a dict instead of a tuple
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS repo_maintenance
+                                 (path TEXT UNIQUE NOT NULL, last_run REAL, status TEXT, duration REAL,
+                                  loose_objects INTEGER, packs INTEGER, error TEXT)''')
+            self.conn.commit()
+        except Exception as e:
+            print("Maintenance state error: {0}".format(e))
+            self.conn = None
+
+    def get(self, path):
+        """
+        :param path: string repository path
+        :return: sqlite3.Row | None
+        """
+        if self.conn is None:
+            return None
+
+        with self.lock:
+            return self.conn.execute("SELECT * FROM repo_maintenance WHERE path = ?", (path, )).fetchone()
+
+    def save(self, path, status, duration, loose_objects, packs, error=None):
+        if self.conn is None:
+            return
+
+        try:
+            with self.lock, self.conn:
+                self.conn.execute('''INSERT OR REPLACE INTO repo_maintenance
+                                     (path, last_run, status, duration, loose_objects, packs, error)
+                                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                                  (path, time.time(), status, duration, loose_objects, packs, error))
+        except Exception as e:
+            print("Maintenance state error: {0}".format(e))
+
+
+class MaintenanceScheduler(object):
+    """
+    Run incremental repacks, commit-graph and multi-pack-index writes and pruning on a list of repositories,
+    a few at a time, within a time budget and at idle io priority.
+    """
+    def __init__(self, git_user=None, state=None, jobs=2, budget=600, force=False):
+        """
+        :param git_user: string run git as this user (with sudo -u)
+        :param state: MaintenanceState
+        :param jobs: int number of repositories to maintain at the same time
+        :param budget: int seconds after which no new maintenance gets started
+        :param force: bool maintain every repository, whether it needs it or not
+        """
+        self.git_user = git_user
+        self.state = state if state is not None else MaintenanceState()
+        self.jobs = jobs
+        self.budget = budget
+        self.force = force
+        self.deadline = None
+
+        # run at the lowest cpu and io priority, so the web server on the same machine doesn't notice
+        self.prefix = []
+        if find_executable('ionice'):
+            self.prefix += ['ionice', '-c3']
+        if find_executable('nice'):
+            self.prefix += ['nice', '-n', '19']
+
+    def run(self, repositories, on_result=None):
+        """
+        Maintain the repositories that need it, the ones that need it most first
+        :param repositories: list of (path, name) tuples
+        :param on_result: optional callable that gets every result dict as soon as it's known
+        :return: list of result dicts
+        """
+        self.deadline = time.time() + self.budget
+
+        candidates = []
+        results = []
+        for path, name in repositories:
+            stats = self.count_objects(path)
+            reason = self.needs_maintenance(path, stats)
+            if reason:
+                candidates.append((stats['count'] + stats['packs'] * 100, path, name, stats, reason))
+            else:
+                results.append({'repo': name, 'path': path, 'status': STATUS_SKIPPED, 'reason': 'not needed'})
+        candidates.sort(reverse=True)
+
+        def maintain(candidate):
+            result = self.maintain(*candidate[1:])
+            if on_result is not None:
+                on_result(result)
+            return result
+
+        if candidates:
+            pool = ThreadPool(min(self.jobs, len(candidates)))
+            try:
+                results += pool.map(maintain, candidates)
+            finally:
+                pool.close()
+                pool.join()
+
+        return results
+
+    def needs_maintenance(self, path, stats):
+        """
+        :param path: string repository path
+        :param stats: dict as returned by count_objects
+        :return: string reason why the repository needs maintenance | None
+        """
+        record = self.state.get(path)
+        last_run = record['last_run'] if record is not None else None
+
+        if self.force:
+            return 'forced'
+        if last_run is not None and time.time() - last_run < MIN_INTERVAL:
+            return None
+        if stats['count'] >= LOOSE_OBJECTS_THRESHOLD:
+            return '{} loose objects'.format(stats['count'])
+        if stats['packs'] >= PACKS_THRESHOLD:
+            return '{} packs'.format(stats['packs'])
+        if last_run is None or time.time() - last_run >= MAX_AGE:
+            return 'not maintained recently'
+
+        return None
+
+    def maintain(self, path, name, stats, reason):
+        """
+        Maintain a single repository
+        :return: dict result
+        """
+        result = {'repo': name, 'path': path, 'status': STATUS_DONE, 'reason': reason, 'tasks': []}
+        start = time.time()
+
+        for task, command in TASKS:
+            if time.time() >= self.deadline:
+                result['status'] = STATUS_SKIPPED
+                result['error'] = 'out of time'
+                break
+            if self.is_busy(path):
+                # an update is running in this repository, so leave it alone for now
+                result['status'] = STATUS_SKIPPED
+                result['error'] = 'repository is busy'
+                break
+
+            try:
+                self.exec_shell(command, path)
+                result['tasks'].append(task)
+            except subprocess.CalledProcessError as e:
+                error = e.output.decode('UTF-8').strip()
+                if any(message in error for message in NOTHING_TO_DO):
+                    continue
+                result['status'] = STATUS_FAILED
+                result['error'] = error
+                break
+
+        result['duration'] = time.time() - start
+        after = self.count_objects(path)
+        result['loose_objects'] = (stats['count'], after['count'])
+        result['packs'] = (stats['packs'], after['packs'])
+
+        if result['tasks'] or result['status'] == STATUS_FAILED:
+            self.state.save(path, result['status'], result['duration'], after['count'], after['packs'],
+                            result.get('error'))
+
+        return result
+
+    def is_busy(self, path):
+        """
+        Check whether git is working in a repository, by the locks it holds
+        :param path: string repository path
+        :return: bool
+        """
+        try:
+            # worktrees keep their index and HEAD in the main repository, and only have a .git file
+            locks = self.exec_shell("git rev-parse " + " ".join("--git-path " + lock for lock in BUSY_LOCKS),
+                                    path).splitlines()
+        except subprocess.CalledProcessError:
+            return True  # leave it alone if git can't even tell where its locks are
+
+        return any(os.path.exists(os.path.join(path, lock)) for lock in locks)
+
+    def count_objects(self, path):
+        """
+        :param path: string repository path
+        :return: dict with (at least) the number of loose objects ('count') and packs ('packs')
+        """
+        stats = {'count': 0, 'packs': 0}
+        try:
+            for line in self.exec_shell("git count-objects -v", path).splitlines():
+                key, _, value = line.partition(':')
+                if value.strip().isdigit():
+                    stats[key.strip().replace('-', '_')] = int(value.strip())
+        except subprocess.CalledProcessError:
+            pass  # not much we can do; treat it as empty
+
+        return stats
+
+    def exec_shell(self, command, path):
+        """Execute a shell command in a repository, at low priority, and get the output."""
+        args = shlex.split(command)
+        if self.git_user:
+            args = ['sudo', '-u', self.git_user] + args
+
+        result = subprocess.check_output(self.prefix + args, cwd=path, stderr=subprocess.STDOUT)
+
+        return result.decode('UTF-8')
@@ -0,0 +1,80 @@
+import re
+
+__author__ = 'Kevin Dubois'
+
+# a full commit id; anything else in a manifest is a ref (branch or tag) that needs resolving
+COMMIT_ID = re.compile(r'^[0-9a-f]{40}$')
+
+
+def is_commit_id(ref):
+    return COMMIT_ID.match(ref) is not None
+
+
+def parse_targets(values):
+    """
+    Parse the targets of gpull_local.py --converge
+    :param values: list of strings of the form repo=commit, eg. ['gpull=1f0c...', 'repo2=v1.2.0']
+    :return: dict of repo => commit id or ref
+    """
+    targets = {}
+    for value in values:
+        repo, _, ref = value.partition('=')
+        if not repo or not ref:
+            raise ValueError("{} is not of the form repo=commit".format(value))
+        targets[repo] = ref
+
+    return targets
+
+
+def format_targets(targets):
+    """
+    :param targets: dict of repo => commit id or ref
+    :return: string arguments for gpull_local.py --converge
+    """
+    return ' '.join('{}={}'.format(repo, ref) for repo, ref in sorted(targets.items()))
+
+
+def pick_ref(ls_remote, ref):
+    """
+    Find the commit a ref points to in the output of git ls-remote, preferring branches over tags,
+    and the commit an annotated tag points to over the tag itself
+    :param ls_remote: string output of git ls-remote <url> <ref>
+    :param ref: string eg. master, v1.2.0 or refs/heads/master
+    :return: string commit id | None
+    """
+    refs = {}
+    for line in ls_remote.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and is_commit_id(parts[0]):
+            refs[parts[1]] = parts[0]
+
+    for name in (ref, 'refs/heads/' + ref, 'refs/tags/' + ref + '^{}', 'refs/tags/' + ref):
+        if name in refs:
+            return refs[name]
+
+    return None
+
+
+def resolve(manifest, repo_url, ls_remote):
+    """
+    Resolve the refs in a manifest to the commits they point to right now, so every server converges on the
+    same commits even when a branch moves during the run
+    :param manifest: dict of repo => commit id or ref
+    :param repo_url: callable that gets the url of a repository
+    :param ls_remote: callable that runs a git ls-remote command and returns its output
+    :return: tuple (dict of repo => commit id, dict of repo => error for the refs that couldn't be resolved)
+    """
+    resolved = {}
+    errors = {}
+    for repo, ref in sorted(manifest.items()):
+        if is_commit_id(ref):
+            resolved[repo] = ref
+            continue
+
+        commit = pick_ref(ls_remote("git ls-remote {} {}".format(repo_url(repo), ref)) or '', ref)
+        if commit is None:
+            errors[repo] = "{} not found on {}".format(ref, repo_url(repo))
+        else:
+            resolved[repo] = commit
+
+    return resolved, errors
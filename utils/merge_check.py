@@ -0,0 +1,102 @@
+import shlex
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+from utils.mirror import MirrorCache
+
+__author__ = 'Kevin Dubois'
+
+# possible outcomes of a merge check
+CLEAN = 'clean'
+CONFLICTED = 'conflicted'
+ALREADY_MERGED = 'already merged'
+MISSING_BRANCH = 'missing branch'
+ERROR = 'error'
+
+
+class MergeCheck(object):
+    """
+    Find out what merging one branch into another would do for every repository, without a working tree:
+    both branches are fetched into the bare mirrors, and the merge is computed in memory by git merge-tree.
+    Needs git 2.38 or newer.
+    """
+    def __init__(self, mirrors=None):
+        if mirrors is None:
+            mirrors = MirrorCache()
+
+        self.mirrors = mirrors
+
+    def check_all(self, repos, from_branch, to_branch, processes=8):
+        """
+        Check a list of repositories concurrently
+        :param repos: list of repository names
+        :param from_branch: What branch to merge from
+        :param to_branch: What branch to merge into
+        :param processes: int max number of repositories to check at the same time
+        :return: list of result dicts, in the same order as repos
+        """
+        if not repos:
+            return []
+
+        pool = ThreadPool(min(processes, len(repos)))
+        try:
+            return pool.map(lambda repo: self.check(repo, from_branch, to_branch), repos)
+        finally:
+            pool.close()
+            pool.join()
+
+    def check(self, repo, from_branch, to_branch):
+        """
+        Check what merging from_branch into to_branch would do in a single repository
+        :param repo: string repository name
+        :param from_branch: What branch to merge from
+        :param to_branch: What branch to merge into
+        :return: dict with the repo, status, and the conflicting files or missing branches if any
+        """
+        result = {'repo': repo, 'status': ERROR, 'files': [], 'branches': [], 'error': None}
+
+        path = self.mirrors.update(repo)
+        if path is False:
+            result['error'] = self.mirrors.failed[repo]
+            return result
+
+        git = "git --git-dir={}".format(path)
+
+        # both branches need to exist before there is anything to merge
+        for branch in (from_branch, to_branch):
+            try:
+                self.exec_shell("{} rev-parse --verify --quiet refs/heads/{}".format(git, branch))
+            except subprocess.CalledProcessError:
+                result['branches'].append(branch)
+        if result['branches']:
+            result['status'] = MISSING_BRANCH
+            return result
+
+        try:
+            self.exec_shell("{} merge-base --is-ancestor refs/heads/{} refs/heads/{}".format(git, from_branch, to_branch))
+            result['status'] = ALREADY_MERGED
+            return result
+        except subprocess.CalledProcessError:
+            pass  # not an ancestor, so there is something to merge
+
+        try:
+            self.exec_shell("{} merge-tree --write-tree --name-only --no-messages refs/heads/{} refs/heads/{}".format(
+                git, to_branch, from_branch))
+            result['status'] = CLEAN
+        except subprocess.CalledProcessError as e:
+            output = e.output.decode('UTF-8')
+            if e.returncode != 1:
+                # anything other than 1 means git could not compute the merge at all
+                result['error'] = output
+                return result
+            # the first line is the resulting tree, the rest are the conflicting files
+            result['status'] = CONFLICTED
+            result['files'] = [line for line in output.splitlines()[1:] if line.strip()]
+
+        return result
+
+    def exec_shell(self, command):
+        """Execute a shell command and get the output."""
+        result = subprocess.check_output(shlex.split(command), stderr=subprocess.STDOUT)
+
+        return result.decode('UTF-8')
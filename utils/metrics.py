@@ -0,0 +1,230 @@
+import json
+import os
+import threading
+import time
+
+from utils.config import Config
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    # python 2
+    from urllib2 import Request, urlopen
+
+__author__ = 'Kevin Dubois'
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# every metric we export: name => (type, help)
+METRICS = {
+    'gpull_run_duration_seconds': (HISTOGRAM, 'Duration of whole runs'),
+    'gpull_runs_total': (COUNTER, 'Number of runs, per final status'),
+    'gpull_last_run_timestamp_seconds': (GAUGE, 'When the last run finished'),
+    'gpull_last_run_duration_seconds': (GAUGE, 'Duration of the last run'),
+    'gpull_last_run_success': (GAUGE, '1 if nothing failed during the last run, 0 otherwise'),
+    'gpull_last_run_repos': (GAUGE, 'Number of repositories per status during the last run'),
+    'gpull_last_run_hosts': (GAUGE, 'Number of hosts per status during the last run'),
+    'gpull_repo_updates_total': (COUNTER, 'Number of repository updates or merges, per status'),
+    'gpull_repo_duration_seconds': (HISTOGRAM, 'Duration of updating or merging a single repository'),
+    'gpull_repo_fetch_duration_seconds': (HISTOGRAM, 'Duration of fetching a single repository'),
+    'gpull_repo_pull_duration_seconds': (HISTOGRAM, 'Duration of pulling a single repository'),
+    'gpull_repo_push_duration_seconds': (HISTOGRAM, 'Duration of pushing a single repository'),
+    'gpull_fetched_bytes_total': (COUNTER, 'Bytes added to the object stores of the repositories by fetches'),
+    'gpull_ssh_connect_duration_seconds': (HISTOGRAM, 'Duration of setting up ssh connections'),
+    'gpull_retries_total': (COUNTER, 'Number of retried operations, per operation'),
+}
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, escape(value)) for key, value in sorted(labels.items())) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """
+    Prometheus text format metrics of a command, written to a file for node_exporter's textfile collector
+    and/or pushed to a Pushgateway at the end of every run.
+    Counters and histograms add up across runs, so their state is kept in a json file next to the metrics file.
+    """
+    def __init__(self, command, path=None, push_url=None, disabled=False):
+        """
+        :param command: string eg. 'gpull_local'; every sample gets it as its command label
+        :param path: string .prom file, or a directory to write <command>.prom in; defaults to MetricsDir
+        :param push_url: string Pushgateway base url, eg. http://localhost:9091
+        :param disabled: bool don't write or push anything, not even to MetricsDir
+        """
+        if disabled:
+            path, push_url = None, None
+        elif path is None:
+            path = Config().get_metrics_dir()
+        if path is not None and not path.endswith('.prom'):
+            path = os.path.join(path, command + '.prom')
+
+        self.command = command
+        self.path = path
+        self.push_url = push_url
+        self.state_path = path[:-len('.prom')] + '.state.json' if path is not None else None
+
+        # name => {label json => value | histogram dict}
+        self.series = {}
+        # metrics get recorded by every thread updating a host
+        self.lock = threading.Lock()
+        self.load()
+
+    def enabled(self):
+        return self.path is not None or self.push_url is not None
+
+    def key(self, labels):
+        labels = dict(labels or {})
+        labels['command'] = self.command
+        return json.dumps(labels, sort_keys=True)
+
+    def inc(self, name, labels=None, value=1):
+        key = self.key(labels)
+        with self.lock:
+            series = self.series.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        key = self.key(labels)
+        with self.lock:
+            self.series.setdefault(name, {})[key] = value
+
+    def observe(self, name, value, labels=None):
+        if value is None:
+            return
+        key = self.key(labels)
+        with self.lock:
+            series = self.series.setdefault(name, {})
+            histogram = series.setdefault(key, {'buckets': [0] * len(BUCKETS), 'sum': 0, 'count': 0})
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def reset(self, name):
+        """Forget every series of a metric, eg. a per-run gauge before setting this run's values"""
+        self.series[name] = {}
+
+    def render(self):
+        """
+        :return: string metrics in the Prometheus text format
+        """
+        lines = []
+        for name in sorted(self.series):
+            if not self.series[name]:
+                continue
+            metric_type, help_text = METRICS[name]
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for key, value in sorted(self.series[name].items()):
+                labels = json.loads(key)
+                if metric_type != HISTOGRAM:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+                    continue
+                for bound, count in zip(BUCKETS + (float('inf'), ), value['buckets'] + [value['count']]):
+                    bucket_labels = dict(labels, le=format_value(float(bound)))
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(bucket_labels), count))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(float(value['sum']))))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), value['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def load(self):
+        if self.state_path is None or not os.path.isfile(self.state_path):
+            return
+
+        try:
+            with open(self.state_path, 'r') as f:
+                self.series = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            print("Metrics error: {0}".format(e))
+
+    def write(self):
+        """
+        Write the metrics file (atomically, so the collector never reads half a file) and push them
+        :return: void
+        """
+        if self.path is not None:
+            try:
+                directory = os.path.dirname(self.path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                for path, content in ((self.state_path, json.dumps(self.series)), (self.path, self.render())):
+                    with open(path + '.tmp', 'w') as f:
+                        f.write(content)
+                    os.rename(path + '.tmp', path)
+            except (IOError, OSError) as e:
+                print("Metrics error: {0}".format(e))
+
+        if self.push_url is not None:
+            self.push()
+
+    def push(self):
+        """
+        Replace this command's metrics on a Pushgateway
+        :return: void
+        """
+        url = '{}/metrics/job/gpull/command/{}'.format(self.push_url.rstrip('/'), self.command)
+        request = Request(url, data=self.render().encode('UTF-8'),
+                          headers={'Content-Type': 'text/plain; version=0.0.4'})
+        request.get_method = lambda: 'PUT'
+        try:
+            urlopen(request, timeout=10).close()
+        except Exception as e:
+            print("Metrics error: could not push to {0}: {1}".format(url, e))
+
+    def record_run(self, started_at, repos, hosts=None):
+        """
+        Record the results of a whole run
+        :param started_at: float unix timestamp
+        :param repos: list of repository result dicts, with at least a repo and a status
+        :param hosts: optional list of host result dicts, with at least a status
+        :return: void
+        """
+        duration = time.time() - started_at
+        failed = any(result.get('status') == 'failed' for result in (hosts or []) + repos)
+        status = 'failed' if failed else 'finished'
+
+        self.observe('gpull_run_duration_seconds', duration)
+        self.inc('gpull_runs_total', {'status': status})
+        self.set('gpull_last_run_timestamp_seconds', time.time())
+        self.set('gpull_last_run_duration_seconds', duration)
+        self.set('gpull_last_run_success', 0 if failed else 1)
+
+        for name, results in (('gpull_last_run_repos', repos), ('gpull_last_run_hosts', hosts)):
+            if results is None:
+                continue
+            self.reset(name)
+            counts = {}
+            for result in results:
+                counts[result.get('status')] = counts.get(result.get('status'), 0) + 1
+            for result_status, count in counts.items():
+                self.set(name, count, {'status': result_status})
+
+        for result in repos:
+            labels = {'repo': result['repo']}
+            self.inc('gpull_repo_updates_total', dict(labels, status=result.get('status')))
+            self.observe('gpull_repo_duration_seconds', result.get('duration'), labels)
+            self.observe('gpull_repo_fetch_duration_seconds', result.get('fetch_duration'), labels)
+            self.observe('gpull_repo_pull_duration_seconds', result.get('pull_duration'), labels)
+            self.observe('gpull_repo_push_duration_seconds', result.get('push_duration'), labels)
+            if result.get('bytes_fetched') is not None:
+                self.inc('gpull_fetched_bytes_total', labels, result['bytes_fetched'])
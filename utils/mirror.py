@@ -0,0 +1,116 @@
+import os
+import shlex
+import subprocess
+import threading
+from multiprocessing.pool import ThreadPool
+
+from utils.admission import admission
+from utils.config import Config
+
+__author__ = 'Kevin Dubois'
+
+
+def mirror_name(origin_url, default=None):
+    """
+    Get the name of the mirror of a repository from its origin url, eg. gpull for git@github.com:kdubois/gpull.git
+    :param origin_url: string | None
+    :param default: string name to use when there is no origin url
+    :return: string
+    """
+    if not origin_url:
+        return default
+
+    name = origin_url.rstrip('/').split('/')[-1].split(':')[-1]
+    if name.endswith('.git'):
+        name = name[:-len('.git')]
+
+    return name
+
+
+class MirrorCache(object):
+    """
+    Bare mirrors of the configured repositories, kept on the controller.
+    Each mirror is fetched from the GitServer at most once per run, no matter how many times it's asked for.
+    """
+    def __init__(self, mirror_dir=None, git_server=None):
+        config = Config()
+
+        if mirror_dir is None:
+            mirror_dir = config.get_mirror_dir()
+        if git_server is None:
+            git_server = config.get_git_server()
+
+        self.mirror_dir = mirror_dir
+        self.git_server = git_server
+
+        # repositories that have already been fetched during this run, and the ones that failed
+        self.updated = set()
+        self.failed = {}
+        self.lock = threading.Lock()
+        # one lock per repository, so the same mirror never gets fetched twice at the same time
+        self.repo_locks = {}
+
+    def path(self, repo):
+        """
+        Location of the bare mirror of a repository
+        :param repo: string repository name
+        :return: string
+        """
+        return os.path.join(self.mirror_dir, repo + '.git')
+
+    def update(self, repo):
+        """
+        Clone or fetch the mirror of a repository, unless that already happened during this run
+        :param repo: string repository name
+        :return: string path to the mirror | False
+        """
+        with self.lock:
+            repo_lock = self.repo_locks.setdefault(repo, threading.Lock())
+
+        with repo_lock:
+            if repo in self.updated:
+                return self.path(repo)
+            if repo in self.failed:
+                return False
+
+            path = self.path(repo)
+            if os.path.isdir(path):
+                command = "git --git-dir={} fetch --prune --quiet origin".format(path)
+            else:
+                if not os.path.isdir(self.mirror_dir):
+                    os.makedirs(self.mirror_dir)
+                command = "git clone --mirror --quiet {}/{}.git {}".format(self.git_server, repo, path)
+
+            try:
+                admission().run(self.git_server, lambda: self.exec_shell(command))
+            except subprocess.CalledProcessError as e:
+                self.failed[repo] = e.output.decode('UTF-8')
+                return False
+
+            self.updated.add(repo)
+            return path
+
+    def update_all(self, repos, processes=4):
+        """
+        Update the mirrors of a list of repositories concurrently
+        :param repos: list of repository names
+        :param processes: int max number of fetches to run at the same time
+        :return: dict of repository name => path to the mirror | False
+        """
+        if not repos:
+            return {}
+
+        pool = ThreadPool(min(processes, len(repos)))
+        try:
+            paths = pool.map(self.update, repos)
+        finally:
+            pool.close()
+            pool.join()
+
+        return dict(zip(repos, paths))
+
+    def exec_shell(self, command):
+        """Execute a shell command and get the output."""
+        result = subprocess.check_output(shlex.split(command), stderr=subprocess.STDOUT)
+
+        return result.decode('UTF-8')
@@ -0,0 +1,154 @@
+import select
+import socket
+import subprocess
+import threading
+import time
+
+__author__ = 'Kevin Dubois'
+
+"""
+Fetch relay: serve the controller's mirrors to the servers we update, so that the GitServer only
+gets fetched once per repository instead of once per repository per server.
+"""
+
+# how long to wait for git daemon to start listening, in seconds
+DAEMON_START_TIMEOUT = 10
+
+
+class FetchRelay(object):
+    """
+    Runs a git daemon on the controller that serves the mirror directory on localhost, and makes it
+    reachable from the remote servers through reverse port forwards on the existing ssh connections.
+    """
+    def __init__(self, mirror_dir, repos):
+        """
+        :param mirror_dir: string directory of the mirrors
+        :param repos: dict of repository name => path of its mirror; only these get served, so a mirror that
+        couldn't be updated during this run is never served with stale refs
+        """
+        self.mirror_dir = mirror_dir
+        self.repos = repos
+        self.port = None
+        self.daemon = None
+        # reverse port forwards we requested, as (transport, remote port) tuples
+        self.forwards = []
+
+    def start(self):
+        """
+        Start git daemon on a free local port
+        :return: int local port
+        """
+        if not self.repos:
+            raise ValueError("there are no mirrors to serve")
+
+        self.port = find_free_port()
+        # --export-all only skips the git-daemon-export-ok check; the whitelist of mirrors (matched exactly,
+        # --strict-paths) decides what gets served
+        self.daemon = subprocess.Popen(
+            ['git', 'daemon', '--reuseaddr', '--export-all', '--strict-paths', '--listen=127.0.0.1',
+             '--port={}'.format(self.port), '--base-path={}'.format(self.mirror_dir)] + sorted(self.repos.values()),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        # wait until the daemon accepts connections
+        deadline = time.time() + DAEMON_START_TIMEOUT
+        while time.time() < deadline:
+            if self.daemon.poll() is not None:
+                raise Exception("git daemon exited: " + self.daemon.stdout.read().decode('UTF-8'))
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return self.port
+            except socket.error:
+                time.sleep(0.1)
+
+        self.close()
+        raise Exception("git daemon did not start listening on port {}".format(self.port))
+
+    def url(self, port=None):
+        """
+        Base url of the relay, as seen from a server
+        :param port: int remote port of the forward, or None when running locally
+        :return: string
+        """
+        return "git://127.0.0.1:{}".format(self.port if port is None else port)
+
+    def forward(self, ssh):
+        """
+        Make the relay reachable on a remote server through its ssh connection
+        :param ssh: paramiko.SSHClient
+        :return: int port on the remote server
+        """
+        transport = ssh.get_transport()
+        remote_port = transport.request_port_forward('127.0.0.1', 0, self.handle_channel)
+        self.forwards.append((transport, remote_port))
+
+        return remote_port
+
+    def handle_channel(self, channel, origin, server):
+        """
+        Called by paramiko for every connection to a forwarded port; this runs in the transport thread,
+        so hand the actual work off to a thread of its own.
+        """
+        thread = threading.Thread(target=self.pipe, args=(channel,))
+        thread.daemon = True
+        thread.start()
+
+    def pipe(self, channel):
+        """
+        Copy data between a forwarded ssh channel and the local git daemon until either side closes
+        :param channel: paramiko.Channel
+        :return: void
+        """
+        try:
+            sock = socket.create_connection(('127.0.0.1', self.port))
+        except socket.error:
+            channel.close()
+            return
+
+        try:
+            while True:
+                readable = select.select([sock, channel], [], [])[0]
+                if sock in readable:
+                    data = sock.recv(32768)
+                    if not data:
+                        break
+                    channel.sendall(data)
+                if channel in readable:
+                    data = channel.recv(32768)
+                    if not data:
+                        break
+                    sock.sendall(data)
+        except Exception:
+            pass  # either side went away, nothing left to relay
+        finally:
+            channel.close()
+            sock.close()
+
+    def close(self):
+        """
+        Cancel the port forwards and stop git daemon
+        :return: void
+        """
+        for transport, remote_port in self.forwards:
+            try:
+                transport.cancel_port_forward('127.0.0.1', remote_port)
+            except Exception:
+                pass  # connection is already gone
+        self.forwards = []
+
+        if self.daemon is not None and self.daemon.poll() is None:
+            self.daemon.terminate()
+            self.daemon.wait()
+        self.daemon = None
+
+
+def find_free_port():
+    """
+    Ask the OS for a port nobody is listening on
+    :return: int
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
@@ -0,0 +1,287 @@
+import getpass
+import os
+import sqlite3
+import time
+
+__author__ = 'Kevin Dubois'
+
+# statuses a repository can end up in after a run
+STATUS_UNCHANGED = 'unchanged'
+STATUS_UPDATED = 'updated'
+STATUS_FAILED = 'failed'
+STATUS_SKIPPED = 'skipped'
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS runs
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, started_at REAL NOT NULL, finished_at REAL,
+         command TEXT, branch TEXT, user TEXT, status TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS hosts
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, run_id INTEGER NOT NULL, host TEXT NOT NULL, alias TEXT,
+         status TEXT, started_at REAL, duration REAL, error TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS repos
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, run_id INTEGER NOT NULL, host TEXT NOT NULL, repo TEXT NOT NULL,
+         path TEXT, branch_before TEXT, branch_after TEXT, sha_before TEXT, sha_after TEXT, status TEXT,
+         started_at REAL, duration REAL, fetch_duration REAL, error TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS hooks
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, run_id INTEGER NOT NULL, host TEXT NOT NULL, repo TEXT NOT NULL,
+         name TEXT NOT NULL, status TEXT, started_at REAL, duration REAL, error TEXT)''',
+    'CREATE INDEX IF NOT EXISTS runs_started_at ON runs (started_at)',
+    'CREATE INDEX IF NOT EXISTS hosts_run_id ON hosts (run_id)',
+    'CREATE INDEX IF NOT EXISTS hosts_host_started_at ON hosts (host, started_at)',
+    'CREATE INDEX IF NOT EXISTS repos_run_id ON repos (run_id)',
+    'CREATE INDEX IF NOT EXISTS repos_repo_started_at ON repos (repo, started_at)',
+    'CREATE INDEX IF NOT EXISTS repos_host_started_at ON repos (host, started_at)',
+    'CREATE INDEX IF NOT EXISTS repos_started_at ON repos (started_at)',
+    'CREATE INDEX IF NOT EXISTS hooks_name_started_at ON hooks (repo, name, started_at)',
+]
+
+HOST_COLUMNS = ('run_id', 'host', 'alias', 'status', 'started_at', 'duration', 'error')
+
+REPO_COLUMNS = ('run_id', 'host', 'repo', 'path', 'branch_before', 'branch_after', 'sha_before', 'sha_after',
+                'status', 'started_at', 'duration', 'fetch_duration', 'error')
+
+HOOK_COLUMNS = ('run_id', 'host', 'repo', 'name', 'status', 'started_at', 'duration', 'error')
+
+
+def parse_since(since):
+    """
+    Convert a relative time such as '90s', '15m', '1h', '7d' or '2w' into a unix timestamp
+    :param since: string
+    :return: float
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+    since = since.strip()
+    if since[-1:] in units:
+        seconds = float(since[:-1]) * units[since[-1]]
+    else:
+        seconds = float(since)
+
+    return time.time() - seconds
+
+
+class RunHistory(object):
+    """
+    Keep track of what every run did to every repo on every host.
+    Rows are buffered in memory and written in a single transaction when the run is flushed,
+    so recording doesn't slow down the run itself.
+    """
+    def __init__(self, db_path=None):
+        this_dir = os.path.dirname(os.path.abspath(__file__))
+
+        if db_path is None:
+            db_path = os.path.join(this_dir, 'run_history.db')
+
+        self.run_id = None
+        self.hosts = []
+        self.repos = []
+        self.hooks = []
+        self.conn = None
+
+        try:
+            self.conn = sqlite3.connect(db_path)
+            self.conn.row_factory = sqlite3.Row  # return select results as a dict instead of a tuple
+            # WAL lets us append while someone else is querying, and NORMAL sync is durable enough for a log
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.create_tables()
+        except Exception as e:
+            print("Run history error: {0}".format(e))
+            self.conn = None
+
+    def create_tables(self):
+        """
+        Create the runs, hosts and repos tables and their indexes if they don't exist yet
+        :return: void
+        """
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def start_run(self, command, branch=None, user=None):
+        """
+        Register a new run
+        :param command: string description of what was run, eg. 'gpull' or 'gpull_local'
+        :param branch: string branch that was requested, if any
+        :param user: string user that started the run
+        :return: int run id | None
+        """
+        if self.conn is None:
+            return None
+
+        if user is None:
+            user = getpass.getuser()
+
+        try:
+            cursor = self.conn.execute(
+                "INSERT INTO runs (started_at, command, branch, user, status) VALUES (?, ?, ?, ?, 'running')",
+                (time.time(), command, branch, user))
+            self.conn.commit()
+            self.run_id = cursor.lastrowid
+        except Exception as e:
+            print("Run history error: {0}".format(e))
+
+        return self.run_id
+
+    def record_host(self, host, alias=None, status=None, started_at=None, duration=None, error=None):
+        """
+        Buffer the result of updating a single host
+        :return: void
+        """
+        self.hosts.append((self.run_id, host, alias, status, started_at, duration, error))
+
+    def record_repo(self, host, result):
+        """
+        Buffer the result of updating a single repository
+        :param host: string host the repository lives on
+        :param result: dict as reported by gpull_local.py
+        :return: void
+        """
+        row = [self.run_id, host]
+        row.extend(result.get(column) for column in REPO_COLUMNS[2:])
+        self.repos.append(tuple(row))
+
+        for hook in result.get('hooks') or []:
+            self.hooks.append((self.run_id, host, result.get('repo'), hook['name'], hook['status'],
+                               hook.get('started_at'), hook.get('duration'), hook.get('error')))
+
+    def flush(self):
+        """
+        Write all buffered rows in one transaction
+        :return: void
+        """
+        if self.conn is None or self.run_id is None:
+            return
+
+        try:
+            with self.conn:
+                if self.hosts:
+                    self.conn.executemany(
+                        "INSERT INTO hosts ({}) VALUES ({})".format(
+                            ', '.join(HOST_COLUMNS), ', '.join('?' * len(HOST_COLUMNS))),
+                        self.hosts)
+                if self.repos:
+                    self.conn.executemany(
+                        "INSERT INTO repos ({}) VALUES ({})".format(
+                            ', '.join(REPO_COLUMNS), ', '.join('?' * len(REPO_COLUMNS))),
+                        self.repos)
+                if self.hooks:
+                    self.conn.executemany(
+                        "INSERT INTO hooks ({}) VALUES ({})".format(
+                            ', '.join(HOOK_COLUMNS), ', '.join('?' * len(HOOK_COLUMNS))),
+                        self.hooks)
+            self.hosts = []
+            self.repos = []
+            self.hooks = []
+        except Exception as e:
+            print("Run history error: {0}".format(e))
+
+    def finish_run(self, status='finished'):
+        """
+        Flush the buffered rows and mark the run as finished
+        :param status: string
+        :return: void
+        """
+        self.flush()
+
+        if self.conn is None or self.run_id is None:
+            return
+
+        try:
+            with self.conn:
+                self.conn.execute("UPDATE runs SET finished_at = ?, status = ? WHERE id = ?",
+                                  (time.time(), status, self.run_id))
+        except Exception as e:
+            print("Run history error: {0}".format(e))
+
+    def recent_changes(self, since, host=None, repo=None):
+        """
+        Get repositories that moved to a different commit, also when the update failed after moving them
+        :param since: float unix timestamp
+        :param host: string optional host filter
+        :param repo: string optional repository filter
+        :return: list of rows
+        """
+        query = '''SELECT started_at, host, repo, path, branch_before, branch_after, sha_before, sha_after, status
+                   FROM repos
+                   WHERE started_at >= ? AND sha_before IS NOT sha_after'''
+        params = [since]
+
+        if host is not None:
+            query += ' AND host = ?'
+            params.append(host)
+        if repo is not None:
+            query += ' AND repo = ?'
+            params.append(repo)
+
+        query += ' ORDER BY started_at DESC'
+
+        return self.conn.execute(query, params).fetchall()
+
+    def slowest_repos(self, since, limit=10, column='duration', repo=None):
+        """
+        Get the slowest repository updates
+        :param since: float unix timestamp
+        :param limit: int
+        :param column: string 'duration' or 'fetch_duration'
+        :param repo: string optional repository filter
+        :return: list of rows
+        """
+        if column not in ('duration', 'fetch_duration'):
+            raise ValueError('Cannot sort by {}'.format(column))
+
+        query = '''SELECT repo, COUNT(*) AS updates, AVG({0}) AS average, MAX({0}) AS slowest
+                   FROM repos
+                   WHERE started_at >= ? AND {0} IS NOT NULL'''.format(column)
+        params = [since]
+
+        if repo is not None:
+            query += ' AND repo = ?'
+            params.append(repo)
+
+        query += ' GROUP BY repo ORDER BY average DESC LIMIT ?'
+        params.append(limit)
+
+        return self.conn.execute(query, params).fetchall()
+
+    def slowest_hooks(self, since, limit=10, repo=None):
+        """
+        Get the slowest post-update hooks
+        :param since: float unix timestamp
+        :param limit: int
+        :param repo: string optional repository filter
+        :return: list of rows
+        """
+        query = '''SELECT repo, name, COUNT(*) AS runs, AVG(duration) AS average, MAX(duration) AS slowest,
+                          SUM(CASE WHEN status = ? THEN 1 ELSE 0 END) AS failed
+                   FROM hooks
+                   WHERE started_at >= ? AND duration IS NOT NULL'''
+        params = [STATUS_FAILED, since]
+
+        if repo is not None:
+            query += ' AND repo = ?'
+            params.append(repo)
+
+        query += ' GROUP BY repo, name ORDER BY average DESC LIMIT ?'
+        params.append(limit)
+
+        return self.conn.execute(query, params).fetchall()
+
+    def failure_rates(self, since, by='repo'):
+        """
+        Get failure rates per repository or per host
+        :param since: float unix timestamp
+        :param by: string 'repo' or 'host'
+        :return: list of rows
+        """
+        if by not in ('repo', 'host'):
+            raise ValueError('Cannot group by {}'.format(by))
+
+        query = '''SELECT {0} AS name, COUNT(*) AS total,
+                          SUM(CASE WHEN status = ? THEN 1 ELSE 0 END) AS failed
+                   FROM {1}
+                   WHERE started_at >= ?
+                   GROUP BY {0}
+                   ORDER BY CAST(failed AS REAL) / total DESC, failed DESC'''.format(by, by + 's')
+
+        return self.conn.execute(query, (STATUS_FAILED, since)).fetchall()
@@ -0,0 +1,176 @@
+import bisect
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+from utils.cli.dashboard import Dashboard, RUNNING, DONE, FAILED
+
+__author__ = 'Kevin Dubois'
+
+# points every shard gets on the hash ring; more points spread the servers more evenly
+REPLICAS = 100
+
+# environment variable the ssh password is handed to the shard processes in, so it never shows up in ps
+PASSWORD_ENV = 'GPULL_SSH_PASSWORD'
+
+
+def hash_key(key):
+    return int(hashlib.md5(str(key).encode('UTF-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys (server urls) onto nodes (shards): adding or removing a shard only moves the servers
+    of that shard, and every controller computes the same partition without having to talk to the others.
+    """
+    def __init__(self, nodes, replicas=REPLICAS):
+        self.ring = sorted((hash_key("{}-{}".format(node, i)), node) for node in nodes for i in range(replicas))
+        self.keys = [key for key, node in self.ring]
+
+    def node(self, key):
+        """
+        :param key: string
+        :return: the node the key belongs to
+        """
+        i = bisect.bisect(self.keys, hash_key(key)) % len(self.keys)
+        return self.ring[i][1]
+
+
+def parse_shard(value):
+    """
+    Parse a shard of the form index/count, eg. 2/4 for the second of four shards
+    :param value: string
+    :return: tuple (index, count)
+    """
+    index, _, count = value.partition('/')
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        raise ValueError("shard {} is not between 1 and {}".format(index, count))
+
+    return index, count
+
+
+def partition(targets, index, count):
+    """
+    Keep only the targets of one shard
+    :param targets: list of (ssh alias, url, git user) tuples
+    :param index: int shard, starting at 1
+    :param count: int number of shards
+    :return: list of (ssh alias, url, git user) tuples
+    """
+    ring = HashRing(range(1, count + 1))
+    return [target for target in targets if ring.node(target[1]) == index]
+
+
+def write_results(path, shard, started_at, status, results):
+    """
+    Write the results of a (shard of a) run, for merge_results
+    :param path: string
+    :param shard: tuple (index, count) | None
+    :param started_at: float unix timestamp
+    :param status: string
+    :param results: list of host result dicts
+    :return: void
+    """
+    data = {
+        'shard': list(shard) if shard is not None else None,
+        'started_at': started_at,
+        'finished_at': time.time(),
+        'status': status,
+        'results': results,
+    }
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError) as e:
+        print("Shard results error: {0}".format(e))
+
+
+def read_results(paths):
+    """
+    Read the results of several shards
+    :param paths: list of results files
+    :return: tuple (list of shard result dicts, dict of path => error for the files that couldn't be read)
+    """
+    shards = []
+    missing = {}
+    for path in paths:
+        try:
+            with open(path, 'r') as f:
+                shards.append(json.load(f))
+        except (IOError, OSError, ValueError) as e:
+            missing[path] = str(e)
+
+    return shards, missing
+
+
+def strip_options(args, options):
+    """
+    Remove options and their values from a list of command line arguments
+    :param args: list of strings
+    :param options: list of option names that take a value, eg. ['--shards']
+    :return: list of strings
+    """
+    stripped = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in options:
+            skip = True
+        elif arg.split('=', 1)[0] not in options:
+            stripped.append(arg)
+
+    return stripped
+
+
+def run_shards(script, args, count, work_dir, password=None):
+    """
+    Run a command as several shard processes on this machine, each with its own part of the servers
+    :param script: string path to gpull.py
+    :param args: list of command line arguments for every shard, without --shard and --results-file
+    :param count: int number of shards
+    :param work_dir: string directory for the results and logs of the shards
+    :param password: string ssh password, handed to the shards in their environment
+    :return: list of results files, one per shard
+    """
+    env = dict(os.environ)
+    if password is not None:
+        env[PASSWORD_ENV] = password
+
+    dashboard = Dashboard("gpull: running {} shard(s), logs in {}".format(count, work_dir))
+    processes = []
+    for index in range(1, count + 1):
+        results_file = os.path.join(work_dir, "shard-{}.json".format(index))
+        log = open(os.path.join(work_dir, "shard-{}.log".format(index)), 'w')
+        command = [sys.executable, '-u', script] + args + \
+            ['--shard', "{}/{}".format(index, count), '--results-file', results_file]
+        processes.append((index, results_file, log,
+                          subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env)))
+        dashboard.add(index, "shard {}/{}".format(index, count))
+
+    dashboard.start()
+    running = list(processes)
+    try:
+        for index, results_file, log, process in processes:
+            dashboard.update(index, state=RUNNING)
+        while running:
+            for shard in list(running):
+                index, results_file, log, process = shard
+                if process.poll() is not None:
+                    log.close()
+                    dashboard.update(index, state=DONE if process.returncode == 0 else FAILED)
+                    running.remove(shard)
+            time.sleep(0.2)
+    finally:
+        # don't leave shards behind when we get interrupted
+        for index, results_file, log, process in running:
+            process.terminate()
+            log.close()
+        dashboard.stop()
+
+    return [results_file for index, results_file, log, process in processes]
@@ -0,0 +1,119 @@
+import os
+import subprocess
+
+try:
+    from shlex import quote
+except ImportError:  # python 2
+    from pipes import quote
+
+__author__ = 'Kevin Dubois'
+
+# directory next to the served repositories that holds their worktrees, one per branch
+WORKTREE_DIR = '.gpull-worktrees'
+
+# suffix of the symlink that gets renamed over the served path
+SWAP_SUFFIX = '.gpull-swap'
+
+
+def swap_symlink(path, target):
+    """
+    Atomically point a symlink (or replace a directory entry) at a target: rename(2) replaces the old entry in one
+    step, so whoever serves the path sees either the old or the new target, never something in between
+    :param path: string
+    :param target: string
+    :return: void
+    """
+    tmp = path + SWAP_SUFFIX
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    os.rename(tmp, path)
+
+
+class Worktrees(object):
+    """
+    A git worktree per configured branch of a repository, next to the path the repository is served from.
+    The served path is a symlink to the worktree of the branch that is live, so switching branches is a symlink
+    swap that takes the same (tiny) time however much differs between the branches.
+    The repository that was served before the worktrees were set up becomes the worktree of the branch it was on.
+    """
+    def __init__(self, served_path, exec_shell):
+        """
+        :param served_path: string path the repository is served from, eg. /var/www/repo2
+        :param exec_shell: callable that runs a command and returns its output, raising CalledProcessError
+        """
+        self.served_path = os.path.abspath(served_path)
+        self.exec_shell = exec_shell
+        self.root = os.path.join(os.path.dirname(self.served_path), WORKTREE_DIR, os.path.basename(self.served_path))
+
+    def path(self, branch):
+        return os.path.join(self.root, branch)
+
+    def is_set_up(self):
+        """
+        :return: bool whether the served path is a symlink to one of our worktrees
+        """
+        return os.path.islink(self.served_path) and \
+            os.path.realpath(self.served_path).startswith(os.path.realpath(self.root) + os.sep)
+
+    def exists(self, branch):
+        return os.path.exists(os.path.join(self.path(branch), '.git'))
+
+    def served_branch(self):
+        """
+        :return: string branch of the worktree that is being served | None
+        """
+        if not self.is_set_up():
+            return None
+
+        return os.path.relpath(os.path.realpath(self.served_path), os.path.realpath(self.root))
+
+    def git(self, branch, command):
+        return self.exec_shell("git -C {} {}".format(quote(self.path(branch)), command))
+
+    def set_up(self, branch):
+        """
+        Move the served repository into the worktree directory, as the worktree of the branch it's on,
+        and serve it through a symlink from then on
+        :param branch: string branch the served repository is on
+        :return: void
+        """
+        self.exec_shell("mkdir -p {}".format(quote(self.root)))
+        # point the symlink at where the repository is going to be before moving it, so the served path
+        # only disappears for as long as it takes to rename the symlink over it
+        tmp = self.served_path + SWAP_SUFFIX
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(self.path(branch), tmp)
+        os.rename(self.served_path, self.path(branch))
+        os.rename(tmp, self.served_path)
+
+    def add(self, branch):
+        """
+        Check a branch out in its own worktree, tracking origin/<branch> if there's no local branch yet
+        :param branch: string
+        :return: string output
+        """
+        main = self.served_branch()
+        path = quote(self.path(branch))
+        try:
+            self.git(main, "rev-parse --verify --quiet refs/heads/" + branch)
+            return self.git(main, "worktree add {} {}".format(path, branch))
+        except subprocess.CalledProcessError:
+            return self.git(main, "worktree add --track -b {} {} origin/{}".format(branch, path, branch))
+
+    def update(self, branch):
+        """
+        Fast-forward the worktree of a branch to what was fetched from origin
+        :param branch: string
+        :return: string output
+        """
+        return self.git(branch, "merge --ff-only origin/" + branch)
+
+    def switch(self, branch):
+        """
+        Serve the worktree of another branch
+        :param branch: string
+        :return: void
+        """
+        swap_symlink(self.served_path, self.path(branch))